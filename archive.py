@@ -0,0 +1,238 @@
+import json, os, pathlib, sqlite3
+
+import pytz
+
+from data import *
+from db import types as content_types
+import render
+from search import word_regex
+
+# The archive is an SQLite database of the exported messages of one thread for
+# browsing them with server.py. The messages are stored as processed for the
+# output: with the display names of the contacts, the mentions replaced and
+# the paths of the attachments in the output directory. The messages are
+# numbered by their positions in the thread.
+
+ARCHIVE_FILE_NAME = "archive.sqlite"
+# The version of the format of the archive. Version 2 added the thumbnails of
+# the attachments.
+ARCHIVE_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE sender (id INTEGER PRIMARY KEY, name TEXT, avatar_file_name TEXT, color TEXT);
+CREATE TABLE message (position INTEGER PRIMARY KEY, id INTEGER, date INTEGER, sender_id INTEGER, body TEXT, quote TEXT, reactions TEXT, attachments TEXT);
+CREATE TABLE day (day TEXT PRIMARY KEY, position INTEGER) WITHOUT ROWID;
+"""
+
+# Full text index of the text shown for each message. The index is contentless
+# as only the positions of the matching messages are needed.
+FTS_SCHEMA = "CREATE VIRTUAL TABLE message_text USING fts5(text, content='')"
+
+def archive_version(file_name):
+    """Return the version of the format of the given archive or None if it
+    cannot be read."""
+
+    try:
+        db = sqlite3.connect("{}?mode=ro".format(pathlib.Path(file_name).resolve().as_uri()), uri=True)
+        try:
+            row = db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        finally:
+            db.close()
+    except sqlite3.Error:
+        return None
+    return json.loads(row[0]) if row is not None else None
+
+class ArchiveWriter:
+    """Writes the messages of one thread to an archive. The messages are
+    inserted in chunks of chunk_size messages. If append is True, the messages
+    are added to an existing archive as in SearchIndexWriter."""
+
+    def __init__(self, file_name, recipient, timezone_name, append=False, chunk_size=10000):
+        if not append and os.path.exists(file_name):
+            os.remove(file_name)
+        self.db = sqlite3.connect(file_name)
+        if not append:
+            self.db.executescript(SCHEMA)
+            try:
+                self.db.execute(FTS_SCHEMA)
+            except sqlite3.OperationalError:
+                self.db.close()
+                os.remove(file_name)
+                raise SystemExit("The SQLite library of Python does not support FTS5 which is needed for the archive.")
+
+        meta = {"version": ARCHIVE_VERSION, "name": recipient.name, "avatar_file_name": recipient.avatar_file_name, "timezone": timezone_name}
+        self.db.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", ((key, json.dumps(value)) for key, value in meta.items()))
+
+        self.chunk_size = chunk_size
+        # The contacts are written when the archive is closed as the colors of
+        # the senders are assigned during the export.
+        self.senders = {}
+        self.messages = []
+        self.texts = []
+        self.days = []
+
+    def add_sender(self, contact):
+        if contact.id not in self.senders:
+            self.senders[contact.id] = contact
+        return contact.id
+
+    def add(self, position, message, day, text, attachment_file_names, thumbnail_file_names):
+        """Add a message at the given position of the thread. The day is the
+        local date of the message, text is the text searched for the message
+        and attachment_file_names and thumbnail_file_names are the paths of the
+        attachments of the message and their thumbnails (or None) relative to
+        the output directory. The mentions of the message must have been
+        replaced."""
+
+        quote = None
+        if message.quote is not None:
+            quote = json.dumps([self.add_sender(message.quote.sender), round(message.quote.date*1000), message.quote.message], ensure_ascii=False)
+        reactions = None
+        if len(message.reactions) > 0:
+            reactions = json.dumps([[self.add_sender(reaction.contact), reaction.emoji] for reaction in message.reactions], ensure_ascii=False)
+        attachments = None
+        if message.attachments:
+            attachments = json.dumps([[file_name, attachment.content_type, thumbnail] for attachment, file_name, thumbnail in zip(message.attachments, attachment_file_names, thumbnail_file_names)])
+
+        self.messages.append((position, message.id, round(message.date*1000), self.add_sender(message.sender), message.message, quote, reactions, attachments))
+        self.texts.append((position, text))
+        self.days.append((day, position))
+
+        if len(self.messages) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        self.db.executemany("INSERT OR REPLACE INTO message VALUES (?, ?, ?, ?, ?, ?, ?, ?)", self.messages)
+        self.db.executemany("INSERT INTO message_text (rowid, text) VALUES (?, ?)", self.texts)
+        # The first position of each day.
+        self.db.executemany("INSERT OR IGNORE INTO day VALUES (?, ?)", self.days)
+        self.messages = []
+        self.texts = []
+        self.days = []
+
+    def close(self):
+        self.flush()
+        self.db.executemany("INSERT OR REPLACE INTO sender VALUES (?, ?, ?, ?)", ((contact.id, contact.name, contact.avatar_file_name, contact.color) for contact in self.senders.values()))
+        self.db.commit()
+        self.db.close()
+
+class ArchiveReader:
+    """Reads the messages of an archive written by ArchiveWriter. The archive
+    is opened read-only, so a reader can be used while an incremental export
+    appends to the archive."""
+
+    def __init__(self, file_name):
+        self.db = sqlite3.connect("{}?mode=ro".format(pathlib.Path(file_name).resolve().as_uri()), uri=True)
+        meta = {key: json.loads(value) for key, value in self.db.execute("SELECT key, value FROM meta")}
+        if meta.get("version", None) != ARCHIVE_VERSION:
+            raise SystemExit("Unsupported archive version in '{}'. Export the conversation again.".format(file_name))
+        self.name = meta["name"]
+        self.avatar_file_name = meta["avatar_file_name"]
+        self.timezone_name = meta["timezone"]
+
+    def close(self):
+        self.db.close()
+
+    def count(self):
+        """Return the number of messages in the archive."""
+
+        return self.db.execute("SELECT coalesce(max(position) + 1, 0) FROM message").fetchone()[0]
+
+    def day_position(self, day, after=False):
+        """Return the position of the first message on the given day or later
+        (or the first message after the day if after is True). The day is a
+        local date YYYY-MM-DD."""
+
+        row = self.db.execute("SELECT position FROM day WHERE day {} ? ORDER BY day LIMIT 1".format(">" if after else ">="), (day, )).fetchone()
+        return row[0] if row is not None else self.count()
+
+    def date_range(self):
+        """Return the first and the last day of the messages."""
+
+        first = self.db.execute("SELECT min(day) FROM day").fetchone()[0]
+        last = self.db.execute("SELECT max(day) FROM day").fetchone()[0]
+        return first, last
+
+    def messages(self, start, end):
+        """Return the messages from start up to end (see build_messages)."""
+
+        return self.build_messages(self.db.execute("SELECT * FROM message WHERE position >= ? AND position < ? ORDER BY position", (start, end)).fetchall())
+
+    def search(self, query, start, end, limit):
+        """Return the messages from start up to end (see build_messages) which
+        contain all the words of the query as words or prefixes of words. A
+        query without words is looked up in the text of the messages as in
+        html/script.js. At most limit messages are returned."""
+
+        words = word_regex.findall(query.lower())
+        if len(words) == 0 and len(query) > 0:
+            return self.search_text(query, start, end, limit)
+        if len(words) == 0:
+            return self.messages(start, min(end, start + limit))
+
+        # Each word of the query is matched as a prefix.
+        match = " AND ".join('"{}"*'.format(word) for word in words)
+        rows = self.db.execute("SELECT message.* FROM message_text JOIN message ON message.position = message_text.rowid " \
+                               "WHERE message_text MATCH ? AND message_text.rowid >= ? AND message_text.rowid < ? ORDER BY message_text.rowid LIMIT ?",
+                               (match, start, end, limit)).fetchall()
+        return self.build_messages(rows)
+
+    def search_text(self, query, start, end, limit):
+        """Return the messages from start up to end (see build_messages) whose
+        text for the search contains the query. As the full text index does
+        not keep the text, the text is made again from the messages, so the
+        messages are read until limit messages are found."""
+
+        query = query.lower()
+        format_timestamp = render.TimestampFormatter(pytz.timezone(self.timezone_name)).format
+        names = dict(self.db.execute("SELECT id, name FROM sender"))
+        rows = []
+        for row in self.db.execute("SELECT * FROM message WHERE position >= ? AND position < ? ORDER BY position", (start, end)):
+            position, id, date, sender_id, body, quote, reactions, attachments = row
+            # The text is made as in the export.
+            text = [names[sender_id], format_timestamp(date/1000)]
+            if quote is not None:
+                quote_sender, quote_date, quote_body = json.loads(quote)
+                text += [names[quote_sender], format_timestamp(quote_date/1000), quote_body or ""]
+            if body is not None:
+                text.append(body)
+            if query in " ".join(text).lower():
+                rows.append(row)
+                if len(rows) >= limit: break
+
+        return self.build_messages(rows)
+
+    def build_messages(self, rows):
+        """Return the positions, Message objects, attachment paths and
+        thumbnail paths for the given rows of the table message."""
+
+        # The contacts of the messages.
+        ids = set()
+        for row in rows:
+            ids.add(row[3])
+            if row[5] is not None:
+                ids.add(json.loads(row[5])[0])
+            if row[6] is not None:
+                ids.update(id for id, emoji in json.loads(row[6]))
+        contacts = {}
+        for id, name, avatar_file_name, color in self.db.execute("SELECT * FROM sender WHERE id IN ({})".format(", ".join("?"*len(ids))), list(ids)):
+            contacts[id] = Contact(id=id, name=name, avatar_file_name=avatar_file_name, color=color)
+
+        messages = []
+        for position, id, date, sender_id, body, quote, reactions, attachments in rows:
+            if quote is not None:
+                quote_sender, quote_date, quote_body = json.loads(quote)
+                quote = Message(id=-1, sender=contacts[quote_sender], date=quote_date/1000, message=quote_body)
+            reactions = [Reaction(contact=contacts[contact_id], emoji=emoji, date=None) for contact_id, emoji in json.loads(reactions)] if reactions is not None else ()
+            attachment_file_names = []
+            thumbnail_file_names = []
+            if attachments is not None:
+                attachments = json.loads(attachments)
+                attachment_file_names = [file_name for file_name, content_type, thumbnail in attachments]
+                thumbnail_file_names = [thumbnail for file_name, content_type, thumbnail in attachments]
+                attachments = tuple(content_types.get(content_type, (Attachment, ))[0](file_name, 0, content_type) for file_name, content_type, thumbnail in attachments)
+            message = Message(id=id, sender=contacts[sender_id], date=date/1000, message=body, reactions=reactions, attachments=attachments, quote=quote, mentions=())
+            messages.append((position, message, attachment_file_names, thumbnail_file_names))
+
+        return messages
@@ -0,0 +1,234 @@
+import collections, os, shutil, sqlite3, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+from util import file_hash
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# The ioctl request for cloning a file on Linux (reflink on Btrfs, XFS etc.).
+FICLONE = 0x40049409
+
+def clone_file(source_file_name, target_file_name):
+    """Copy the source file to the target file. A reflink is made if the file
+    system supports it. Otherwise the data is copied in the kernel with
+    os.copy_file_range if possible and with shutil.copyfile if not."""
+
+    with open(source_file_name, mode="rb") as source, open(target_file_name, mode="wb") as target:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+                return
+            except OSError:
+                pass
+
+        if hasattr(os, "copy_file_range"):
+            try:
+                while os.copy_file_range(source.fileno(), target.fileno(), 2**30) > 0:
+                    pass
+                return
+            except OSError:
+                # For example, not supported across file systems on old
+                # kernels.
+                pass
+
+    shutil.copyfile(source_file_name, target_file_name)
+
+class AttachmentStore:
+    """A directory shared by exports in which each attachment is stored once
+    by the hash of its content, so that the same media in several
+    conversations and exports takes space only once. The hashes of the
+    attachment files of the backups are kept in the database hashes.sqlite
+    of the store by the path, the size and the modification time of the
+    files, so each file is hashed only once. The store can be used from
+    several threads and processes."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(path, "hashes.sqlite"), timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        # The hashes can be computed again, so they are not synced to disk
+        # on every commit.
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS hash (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, hash TEXT)")
+        self.db.commit()
+
+    def hash(self, file_name, stat):
+        """Return the hash of the content of the given file with the given
+        os.stat result."""
+
+        path = os.path.realpath(file_name)
+        with self.lock:
+            row = self.db.execute("SELECT hash FROM hash WHERE path = ? AND size = ? AND mtime = ?", (path, stat.st_size, stat.st_mtime_ns)).fetchone()
+        if row is not None:
+            return row[0]
+
+        content_hash = file_hash(file_name)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO hash (path, size, mtime, hash) VALUES (?, ?, ?, ?)", (path, stat.st_size, stat.st_mtime_ns, content_hash))
+            self.db.commit()
+        return content_hash
+
+    def add(self, file_name, stat, extension):
+        """Store the given file with the given os.stat result unless a file
+        with the same content is stored. Returns the name of the stored file
+        and whether it was added."""
+
+        content_hash = self.hash(file_name, stat)
+        stored_file_name = os.path.join(self.path, content_hash[:2], content_hash + extension)
+        if os.path.exists(stored_file_name):
+            return stored_file_name, False
+
+        os.makedirs(os.path.dirname(stored_file_name), exist_ok=True)
+        # Other threads and processes may store the same file.
+        temp_file_name = "{}.{}.{}.tmp".format(stored_file_name, os.getpid(), threading.get_ident())
+        clone_file(file_name, temp_file_name)
+        shutil.copystat(file_name, temp_file_name)
+        os.replace(temp_file_name, stored_file_name)
+        return stored_file_name, True
+
+    def close(self):
+        self.db.close()
+
+def link_file(source_file_name, target_file_name):
+    """Make the target file a hard link to the source file or, if that is not
+    possible (for example across file systems), a symbolic link with a
+    relative path."""
+
+    if os.path.lexists(target_file_name):
+        os.remove(target_file_name)
+    try:
+        os.link(source_file_name, target_file_name)
+    except OSError:
+        os.symlink(os.path.relpath(source_file_name, os.path.dirname(target_file_name)), target_file_name)
+
+def copy_summary(counts):
+    """Return the summary of the given counts of AttachmentCopier.counts."""
+
+    files_copied, bytes_copied, files_skipped, bytes_skipped, files_linked, bytes_linked = counts
+    summary = "Copied {} attachments ({:.1f} MB), skipped {} unchanged attachments ({:.1f} MB)".format(files_copied, bytes_copied/2**20, files_skipped, bytes_skipped/2**20)
+    if files_linked > 0:
+        summary += ", linked {} attachments ({:.1f} MB) to the store".format(files_linked, bytes_linked/2**20)
+    return summary + "."
+
+class AttachmentCopier:
+    """Copies attachment files in a pool of threads so that producing the
+    output does not wait for disk I/O. A target file which exists with the
+    same size and modification time as the source file is not copied again.
+    If link is True, hard links are made instead of copies where possible.
+    If an AttachmentStore is given, the files are copied to the store unless
+    it has them, and the target files are links to the stored files."""
+
+    def __init__(self, threads=8, link=False, store=None):
+        self.link = link
+        self.store = store
+        self.executor = ThreadPoolExecutor(threads)
+        self.pending = collections.deque()
+        self.max_pending = 4*threads
+        self.lock = threading.Lock()
+        self.files_copied = 0
+        self.bytes_copied = 0
+        self.files_skipped = 0
+        self.bytes_skipped = 0
+        # Files linked to files in the store which it had before.
+        self.files_linked = 0
+        self.bytes_linked = 0
+        # Total time of the copy threads.
+        self.seconds = 0
+
+    def copy(self, source_file_name, target_file_name):
+        """Copy the source file to the target file in the background."""
+
+        # Limit the number of pending copies so that they do not pile up in
+        # memory when the disk is slower than producing the output.
+        while len(self.pending) >= self.max_pending:
+            self.pending.popleft().result()
+
+        self.pending.append(self.executor.submit(self._copy, source_file_name, target_file_name))
+
+    def _copy(self, source_file_name, target_file_name):
+        start = time.perf_counter()
+        try:
+            stat = os.stat(source_file_name)
+        except FileNotFoundError:
+            print("Copying attachment '{}' failed. File does not exist.".format(source_file_name))
+            return
+
+        if self.store is not None:
+            self._store(source_file_name, target_file_name, stat, start)
+            return
+
+        try:
+            target_stat = os.stat(target_file_name)
+            skip = target_stat.st_size == stat.st_size and target_stat.st_mtime_ns == stat.st_mtime_ns
+        except FileNotFoundError:
+            skip = False
+
+        if skip:
+            with self.lock:
+                self.files_skipped += 1
+                self.bytes_skipped += stat.st_size
+                self.seconds += time.perf_counter() - start
+            return
+
+        linked = False
+        if self.link:
+            try:
+                if os.path.lexists(target_file_name):
+                    os.remove(target_file_name)
+                os.link(source_file_name, target_file_name)
+                linked = True
+            except OSError:
+                pass
+        if not linked:
+            clone_file(source_file_name, target_file_name)
+            # Keep the modification time so that the file is not copied again.
+            shutil.copystat(source_file_name, target_file_name)
+
+        with self.lock:
+            self.files_copied += 1
+            self.bytes_copied += stat.st_size
+            self.seconds += time.perf_counter() - start
+
+    def _store(self, source_file_name, target_file_name, stat, start):
+        stored_file_name, added = self.store.add(source_file_name, stat, os.path.splitext(target_file_name)[1])
+        try:
+            skip = os.path.samefile(stored_file_name, target_file_name)
+        except FileNotFoundError:
+            skip = False
+        if not skip:
+            link_file(stored_file_name, target_file_name)
+
+        with self.lock:
+            if added:
+                self.files_copied += 1
+                self.bytes_copied += stat.st_size
+            elif skip:
+                self.files_skipped += 1
+                self.bytes_skipped += stat.st_size
+            else:
+                self.files_linked += 1
+                self.bytes_linked += stat.st_size
+            self.seconds += time.perf_counter() - start
+
+    def close(self):
+        """Wait for all copies to finish."""
+
+        while len(self.pending) > 0:
+            self.pending.popleft().result()
+        self.executor.shutdown()
+        if self.store is not None:
+            self.store.close()
+
+    def counts(self):
+        """Return the numbers of files and bytes copied, skipped and linked
+        to the store."""
+
+        return (self.files_copied, self.bytes_copied, self.files_skipped, self.bytes_skipped, self.files_linked, self.bytes_linked)
+
+    def __str__(self):
+        return copy_summary(self.counts())
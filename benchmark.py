@@ -0,0 +1,166 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""Benchmark the stages of producing the output on synthetic databases (see
+synthetic.py). Run ./benchmark.py to time loading the address book, reading
+the messages, replacing the mentions and producing the output file for 10k,
+100k and 1M messages. The results are appended to benchmark.jsonl with the
+current git commit and compared to the latest results of another commit."""
+
+import argparse, gc, importlib, json, multiprocessing, os, shutil, subprocess, sys, time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import pytz
+
+from data import *
+import db, render, synthetic
+from util import load_state
+
+signal_archive = importlib.import_module("signal-archive")
+
+def reset_peak_memory():
+    """Reset the peak memory use of the process if possible (Linux only)."""
+
+    try:
+        with open("/proc/self/clear_refs", mode="w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def peak_memory():
+    """Return the peak resident set size of the process in megabytes or None
+    if it is not available."""
+
+    # On Linux, ru_maxrss includes the memory use of the parent process before
+    # starting this one, so the value of VmHWM is used instead.
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])/1024
+    except OSError:
+        pass
+
+    if resource is None:
+        return None
+    # The value is in kilobytes on Linux and in bytes on macOS.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/(2**20 if sys.platform == "darwin" else 1024)
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_stages(data_path):
+    """Time the stages on the database in the given path. Returns a map from
+    stage names to the numbers of processed items (contacts or messages), the
+    times in seconds and the peak memory use during the stage in megabytes.
+    This is run in its own process so that the peak memory is for one
+    database only."""
+
+    results = {}
+    with open(os.path.join(data_path, "config.json")) as f:
+        config = json.load(f)
+    config["output_path"] = os.path.join(data_path, "benchmark_output")
+    shutil.rmtree(config["output_path"], ignore_errors=True)
+    timezone = pytz.timezone(config["timezone"])
+    cursor = db.setup_db(os.path.join(config["data_path"], config["db_file_name"]))
+
+    def stage(name, f, count):
+        # The function count gives the number of items from the value of f.
+        gc.collect()
+        reset_peak_memory()
+        start = time.perf_counter()
+        value = f()
+        results[name] = {"items": count(value), "seconds": round(time.perf_counter() - start, 3), "peak_memory": peak_memory()}
+        return value
+
+    address_book = stage("from_db_cursor", lambda: AddressBook.from_db_cursor(cursor), lambda x: len(x.contacts))
+    default_recipient = address_book.get_contact(name=config["default_recipient"])[0]
+    recipient = db.find_group(cursor, config["group"])[0]
+    signal_archive.edit_contacts(config, address_book)
+
+    messages = stage("get_messages", lambda: db.get_messages(cursor, recipient, address_book, default_recipient=default_recipient), len)
+
+    def replace_mentions():
+        for message in messages:
+            if message.message is not None and len(message.mentions) > 0:
+                render.replace_mentions(message.message, message.mentions)
+        return len(messages)
+    stage("replace_mentions", replace_mentions, int)
+
+    state = load_state(config["output_path"])
+    stage("produce_output_file", lambda: signal_archive.produce_output_file(config, recipient, messages, timezone, address_book, default_recipient, state), int)
+    shutil.rmtree(config["output_path"])
+
+    return results
+
+def benchmark(sizes, data_path, repeat=1):
+    """Run the benchmark for the given numbers of messages. The databases are
+    generated to subdirectories of data_path unless they exist. Returns a list
+    of results, one for each size and stage."""
+
+    results = []
+    for size in sizes:
+        path = os.path.join(data_path, str(size))
+        if not os.path.exists(os.path.join(path, "config.json")):
+            print("Generating a database with {} messages.".format(size))
+            synthetic.generate(path, size)
+
+        # The best time of the repeats is reported.
+        best = {}
+        for _ in range(repeat):
+            with multiprocessing.get_context("spawn").Pool(1) as pool:
+                for name, result in pool.apply(run_stages, (path, )).items():
+                    if name not in best or result["seconds"] < best[name]["seconds"]:
+                        best[name] = result
+
+        for name, result in best.items():
+            items_per_second = round(result["items"]/result["seconds"]) if result["seconds"] > 0 else None
+            results.append({"messages": size, "stage": name, "items": result["items"], "seconds": result["seconds"], "items_per_second": items_per_second, "peak_memory": result["peak_memory"]})
+
+    return results
+
+def previous_results(file_name, commit):
+    """Return the latest results in the given file of a commit other than the
+    given one as a map from (messages, stage) to results."""
+
+    previous = {}
+    if not os.path.exists(file_name):
+        return previous
+
+    with open(file_name) as f:
+        for line in f:
+            record = json.loads(line)
+            if record["commit"] == commit: continue
+            previous[(record["messages"], record["stage"])] = record
+
+    return previous
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the stages of producing the output on synthetic databases.")
+    parser.add_argument("sizes", type=int, nargs="*", default=[10000, 100000, 1000000], help="numbers of messages (default 10000 100000 1000000)")
+    parser.add_argument("--data-path", default="benchmark_data", help="directory for the generated databases (default benchmark_data)")
+    parser.add_argument("--results", default="benchmark.jsonl", help="file to which the results are appended (default benchmark.jsonl)")
+    parser.add_argument("--repeat", type=int, default=1, help="number of runs of which the best is reported (default 1)")
+    args = parser.parse_args()
+
+    commit = git_commit()
+    previous = previous_results(args.results, commit)
+    results = benchmark(args.sizes, args.data_path, repeat=args.repeat)
+
+    date = time.strftime("%Y-%m-%d %H:%M:%S")
+    with open(args.results, mode="a") as f:
+        for result in results:
+            f.write(json.dumps(dict(commit=commit, date=date, **result)) + "\n")
+
+    print("{:>9} {:20} {:>9} {:>9} {:>11} {:>10}  {}".format("messages", "stage", "items", "seconds", "items/s", "peak MB", "change"))
+    for result in results:
+        old = previous.get((result["messages"], result["stage"]), None)
+        change = "{:+.0f}% ({})".format(100*(result["seconds"]/old["seconds"] - 1), old["commit"]) if old is not None and old["seconds"] > 0 else ""
+        print("{:>9} {:20} {:>9} {:>9.3f} {:>11} {:>10.1f}  {}".format(result["messages"], result["stage"], result["items"], result["seconds"], result["items_per_second"] or "", result["peak_memory"] or 0, change))
@@ -1,5 +1,7 @@
 class Reaction:
 
+  __slots__ = ("contact", "emoji", "date")
+
   def __init__(self, contact, emoji, date):
       self.contact = contact
       self.emoji = emoji
@@ -7,34 +9,46 @@ class Reaction:
 
 class Message:
 
+    # Slots are used as a thread can have millions of messages.
+    __slots__ = ("id", "sender", "date", "message", "reactions", "attachments", "quote", "mentions")
+
     def __init__(self, id, sender, date, message, reactions=None, attachments=None, quote=None, mentions=None):
         self.id = id
         self.sender = sender
         self.date = date
         self.message = message
-        self.reactions = reactions if reactions is not None else []
+        self.reactions = reactions if reactions is not None else ()
         self.attachments = attachments
         self.quote = quote
         self.mentions = mentions
 
 class Attachment:
 
-    def __init__(self, file_name, timestamp, content_type):
+    __slots__ = ("file_name", "timestamp", "content_type", "data_path", "id_offset")
+
+    def __init__(self, file_name, timestamp, content_type, data_path=None, id_offset=0):
         self.file_name = file_name
         self.timestamp = timestamp
         self.content_type = content_type
+        # The directory of the backup containing the file if it is not the
+        # main backup and the offset of the ids of that backup (see
+        # sources.py).
+        self.data_path = data_path
+        self.id_offset = id_offset
 
 class Audio(Attachment):
-    pass
+    __slots__ = ()
 
 class Image(Attachment):
-    pass  
+    __slots__ = ()
 
 class Video(Attachment):
-    pass
+    __slots__ = ()
 
 class Recipient:
 
+    __slots__ = ("id", "name", "alternate_name", "avatar_file_name", "color", "thread_id")
+
     def __init__(self, id, name, alternate_name=None, avatar_file_name=None, color=None):
         # We have alternate_name because Signal has two sources for names. We
         # use name as de facto name and alternate_name is used to perform
@@ -50,18 +64,76 @@ class Recipient:
         return "{},{}".format(self.id, self.name)
 
 class Contact(Recipient):
-    pass
+    __slots__ = ()
 
 class Group(Recipient):
-    pass
+    __slots__ = ()
 
 class AddressBook:
+    """The contacts by id. For finding contacts by name, the address book
+    indexes the trigrams of the casefolded names of the contacts. Names of the
+    contacts must be changed with rename_contact so that the index is kept up
+    to date."""
+
+    # The number of name lookups done by scanning all contacts before the
+    # trigram index is built. Building the index costs about as much as a
+    # hundred scans.
+    scans_before_index = 16
 
     def __init__(self):
         self.contacts = {}
+        # Positions of the contacts in the order in which they were added.
+        self.positions = {}
+        # Map from trigrams to the ids of the contacts whose name or alternate
+        # name contains the trigram. None until the index is built.
+        self.trigrams = None
+        self.name_lookups = 0
+
+    def __getstate__(self):
+        # The index is not pickled as it is larger than the contacts.
+        state = dict(self.__dict__)
+        state["trigrams"] = None
+        state["name_lookups"] = 0
+        return state
+
+    @staticmethod
+    def name_trigrams(name):
+        if name is None:
+            return set()
+        name = name.casefold()
+        return {name[i:i + 3] for i in range(len(name) - 2)}
+
+    def index_contact(self, contact):
+        if self.trigrams is None: return
+        for trigram in self.name_trigrams(contact.name) | self.name_trigrams(contact.alternate_name):
+            self.trigrams.setdefault(trigram, set()).add(contact.id)
+
+    def unindex_contact(self, contact):
+        if self.trigrams is None: return
+        for trigram in self.name_trigrams(contact.name) | self.name_trigrams(contact.alternate_name):
+            ids = self.trigrams.get(trigram, None)
+            if ids is not None:
+                ids.discard(contact.id)
+                if len(ids) == 0:
+                    del self.trigrams[trigram]
 
     def add_contact(self, id=None, name=None, alternate_name=None):
+        if id in self.contacts:
+            self.unindex_contact(self.contacts[id])
+        else:
+            self.positions[id] = len(self.positions)
         self.contacts[id] = Contact(id=id, name=name, alternate_name=alternate_name)
+        self.index_contact(self.contacts[id])
+
+    def rename_contact(self, contact, name=None, alternate_name=None):
+        """Change the name and/or the alternate name of the given contact."""
+
+        self.unindex_contact(contact)
+        if name is not None:
+            contact.name = name
+        if alternate_name is not None:
+            contact.alternate_name = alternate_name
+        self.index_contact(contact)
 
     def get_contact(self, ids=None, name=None):
         if ids is None and name is None:
@@ -78,7 +150,23 @@ class AddressBook:
                     raise Exception("No contact with id '{}'.".format(id))
                 results.append(contact)
         elif name is not None:
-            for contact in self.contacts.values():
+            self.name_lookups += 1
+            if self.trigrams is None and self.name_lookups > self.scans_before_index:
+                self.trigrams = {}
+                for contact in self.contacts.values():
+                    self.index_contact(contact)
+
+            trigrams = self.name_trigrams(name)
+            if self.trigrams is None or len(trigrams) == 0:
+                # No index yet or too short a name for the index.
+                candidates = self.contacts.values()
+            else:
+                # A contact whose name contains the given name has all of its
+                # trigrams. Casefolding maps each character separately, so
+                # this holds for the casefolded names too.
+                ids = set.intersection(*sorted((self.trigrams.get(trigram, set()) for trigram in trigrams), key=len))
+                candidates = [self.contacts[id] for id in sorted(ids, key=self.positions.__getitem__)]
+            for contact in candidates:
                 if (contact.name is not None and name in contact.name) or (contact.alternate_name is not None and name in contact.alternate_name):
                     results.append(contact)
 
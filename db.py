@@ -1,6 +1,7 @@
-import sqlite3
+import os, pathlib, sqlite3, sys
 
 from data import *
+import instrumentation
 
 types = {"application/pdf": (Attachment, "pdf"),
          "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": (Attachment, "xls"),
@@ -32,13 +33,55 @@ types = {"application/pdf": (Attachment, "pdf"),
          "video/quicktime": (Video, "qt"),
          "video/webm": (Video, "webm")}
 
+# The side tables which are queried by message id for each chunk of messages
+# (see iter_messages) and the columns of the queries.
+side_table_lookups = [("reaction", ["message_id"]),
+                      ("attachment", ["message_id"]),
+                      ("mention", ["thread_id", "message_id"])]
+
 def setup_db(db_file_name):
-    """Return a database connection cursor for the given database file."""
+    """Return a database connection cursor for the given database file. The
+    database is opened read-only and as immutable, so SQLite does not lock
+    the file or check whether it has changed. The backup is never modified."""
+
+    if not os.path.exists(db_file_name):
+        raise SystemExit("Database file '{}' does not exist.".format(db_file_name))
 
-    db = sqlite3.connect(db_file_name)
+    uri = "{}?mode=ro&immutable=1".format(pathlib.Path(db_file_name).resolve().as_uri())
+    # The messages can be read in another thread (see pipeline.py).
+    db = sqlite3.connect(uri, uri=True, check_same_thread=False)
     db.row_factory = sqlite3.Row
+    # Map the database file to memory and use a larger page cache (in KiB).
+    db.execute("PRAGMA mmap_size = {}".format(2**30))
+    db.execute("PRAGMA cache_size = -{}".format(2**16))
     return db.cursor()
 
+def has_index(cursor, table, columns):
+    """Return True if the query for the rows of the table with the given
+    values of the columns uses an index for the last column."""
+
+    query = "EXPLAIN QUERY PLAN SELECT * FROM {} WHERE {}".format(table, " AND ".join("{} = ?".format(column) for column in columns))
+    for row in cursor.execute(query, [None]*len(columns)):
+        if " USING " in row["detail"] and "{}=?".format(columns[-1]) in row["detail"]:
+            return True
+
+    return False
+
+def ensure_indexes(cursor):
+    """Make sure that the side tables can be queried by message id without
+    scanning the whole table. Depending on the version of the backup, the
+    tables might have no index for this. As the backup is read-only, such a
+    table is copied to a temporary table with an index. The temporary table
+    has the same name, and SQLite resolves the name to it before the table of
+    the backup."""
+
+    for table, columns in side_table_lookups:
+        if has_index(cursor, table, columns): continue
+        with instrumentation.stage("sqlite_indexes"):
+            cursor.execute("CREATE TEMP TABLE {0} AS SELECT * FROM main.{0}".format(table))
+            cursor.execute("CREATE INDEX temp.{0}_{1}_index ON {0} ({2})".format(table, "_".join(columns), ", ".join(columns)))
+            cursor.connection.commit()
+
 def contact_from_row(row):
     """Return a Contact object based on one row in the table recipient."""
 
@@ -53,19 +96,56 @@ def contact_from_row(row):
 
     return Contact(id=int(row["_id"]), name=name, alternate_name=alternate_name)
 
+def create_name_index(cursor, index, query):
+    """Create the temporary FTS5 table index with trigrams of the names given
+    by the query unless it exists. The query selects the rowid and the names.
+    Returns False if FTS5 trigram tables are not supported."""
+
+    if cursor.execute("SELECT 1 FROM temp.sqlite_master WHERE name = ?", (index, )).fetchone() is not None:
+        return True
+
+    try:
+        cursor.execute("CREATE VIRTUAL TABLE temp.{} USING fts5(name, alternate_name, tokenize = 'trigram')".format(index))
+    except sqlite3.OperationalError:
+        # SQLite older than 3.34 or without FTS5.
+        return False
+    cursor.execute("INSERT INTO temp.{} (rowid, name, alternate_name) {}".format(index, query))
+    cursor.connection.commit()
+
+    return True
+
+def name_search(cursor, index, index_query, query, columns, s):
+    """Execute the query for the rows whose given columns contain the given
+    string. The query has the placeholder {} for the condition. The names are
+    first searched from the FTS5 trigram index (see create_name_index) and the
+    results are checked with LIKE. Strings which are too short for trigrams or
+    contain LIKE wildcards are searched with LIKE only."""
+
+    r = "%{}%".format(s)
+    where = "({})".format(" OR ".join("{} LIKE ?".format(column) for column in columns))
+    if len(s) >= 3 and not "%" in s and not "_" in s and create_name_index(cursor, index, index_query):
+        # The trigram tokenizer folds the case of all letters but LIKE only
+        # of ASCII letters, so the index gives a superset of the LIKE
+        # matches.
+        where = "{}.rowid IN (SELECT rowid FROM temp.{} WHERE {} MATCH ?) AND {}".format(columns[0].split(".")[0], index, index, where)
+        return cursor.execute(query.format(where), ['"{}"'.format(s.replace('"', '""'))] + [r]*len(columns))
+
+    return cursor.execute(query.format(where), [r]*len(columns))
+
 def find_contact(cursor, s):
     """Find all contacts whose name contains the given string."""
 
-    r = "%{}%".format(s)
-    query = "SELECT * FROM recipient WHERE profile_joined_name LIKE ? OR system_joined_name LIKE ?"
-    return [contact_from_row(row) for row in cursor.execute(query, (r, r, ))]
+    rows = name_search(cursor, "recipient_name_index", "SELECT _id, profile_joined_name, system_joined_name FROM recipient",
+            "SELECT * FROM recipient WHERE {} ORDER BY _id", ["recipient.profile_joined_name", "recipient.system_joined_name"], s)
+    return [contact_from_row(row) for row in rows]
 
 def find_group(cursor, s):
     """Find all groups whose name contains the given string."""
 
     results = []
-    query = "SELECT recipient._id, groups.title FROM groups LEFT JOIN recipient ON groups.group_id = recipient.group_id WHERE groups.title LIKE ?"
-    for row in cursor.execute(query, ("%{}%".format(s), )):
+    rows = name_search(cursor, "group_name_index", "SELECT _id, title, NULL FROM groups",
+            "SELECT recipient._id, groups.title FROM groups LEFT JOIN recipient ON groups.group_id = recipient.group_id WHERE {} ORDER BY groups._id", ["groups.title"], s)
+    for row in rows:
         results.append(Group(id=int(row["_id"]), name=row["title"]))
 
     return results
@@ -97,9 +177,44 @@ def find_thread_recipient(cursor, recipient):
 
     recipient.thread_id = rows[0]["_id"]
 
-def get_messages(cursor, recipient, address_book, default_recipient=None):
-    """Return all messages for the given recipient (group or contact) as a list
-    of Message objects ordered by message date."""
+def thread_date_bounds(cursor, recipient, n):
+    """Split the messages of the given recipient into n parts of about the
+    same number of messages by their date_sent values. Returns the number of
+    messages and the n - 1 dates at which the parts after the first one
+    start."""
+
+    if recipient.thread_id is None:
+        find_thread_recipient(cursor, recipient)
+
+    count = cursor.execute("SELECT COUNT(*) FROM message WHERE thread_id = ?", (recipient.thread_id, )).fetchone()[0]
+    positions = {count*i//n for i in range(1, n)}
+    bounds = []
+    # The dates are read in one pass as the messages might not be indexed by
+    # date.
+    for position, row in enumerate(cursor.execute("SELECT date_sent FROM message WHERE thread_id = ? ORDER BY date_sent", (recipient.thread_id, ))):
+        if position in positions:
+            bounds.append(row["date_sent"])
+
+    return count, bounds
+
+def group_by_message_id(rows):
+    """Group the given rows by their message_id column. Returns a dictionary
+    mapping message ids to lists of rows in the original order."""
+
+    result = {}
+    for row in rows:
+        result.setdefault(row["message_id"], []).append(row)
+
+    return result
+
+def iter_messages(cursor, recipient, address_book, default_recipient=None, after=None, before=None, chunk_size=500):
+    """Yield all messages for the given recipient (group or contact) as
+    Message objects ordered by message date. The messages are read from the
+    database in chunks of chunk_size messages, so memory use does not depend
+    on the number of messages in the thread. If after is a pair of a date_sent
+    value and a message id, only the messages after that message are
+    yielded. If before is a date_sent value, only the messages sent before it
+    are yielded."""
 
     """
     My current understanding is the following.
@@ -124,13 +239,12 @@ def get_messages(cursor, recipient, address_book, default_recipient=None):
     though.
     """
 
-    messages = []
-
     if not (isinstance(recipient, Group) or isinstance(recipient, Contact)):
         raise Exception("Unknown recipient type '{}'.".format(type(recipient)))
 
     if recipient.thread_id is None:
         find_thread_recipient(cursor, recipient)
+    ensure_indexes(cursor)
 
     if default_recipient is None:
         default_recipient = Recipient(id=-1, name="UNKNOWN")
@@ -145,60 +259,93 @@ def get_messages(cursor, recipient, address_book, default_recipient=None):
 
     def process_reactions(row):
         reactions = []
-        for row in cursor.execute("SELECT * FROM reaction WHERE message_id = ?", (row["_id"], )).fetchall():
-            reaction = Reaction(contact=address_book.get_contact(ids=int(row["author_id"]))[0], emoji=row["emoji"], date=int(row["date_sent"])/1000)
+        for row in reaction_rows.get(row["_id"], []):
+            reaction = Reaction(contact=address_book.get_contact(ids=int(row["author_id"]))[0], emoji=sys.intern(row["emoji"]), date=int(row["date_sent"])/1000)
             reactions.append(reaction)
 
-        return reactions
-
-    # Get messages.
-    for row in cursor.execute("SELECT * FROM message WHERE thread_id = ?", (recipient.thread_id, )).fetchall():
-        # sender
-        if isinstance(recipient, Group):
-            contact = process_contact_group(row["from_recipient_id"])
-        else:
-            if row["date_server"] == -1:
-                contact = default_recipient
+        return tuple(reactions)
+
+    # Get messages. The messages are read with their own cursor as the side
+    # tables are queried with the given cursor while the messages are read.
+    # Ties in the message date are broken by the message id.
+    message_cursor = cursor.connection.cursor()
+    conditions = ["thread_id = ?"]
+    parameters = [recipient.thread_id]
+    if after is not None:
+        conditions.append("(date_sent > ? OR (date_sent = ? AND _id > ?))")
+        parameters += [after[0], after[0], after[1]]
+    if before is not None:
+        conditions.append("date_sent < ?")
+        parameters.append(before)
+    with instrumentation.stage("sqlite"):
+        message_cursor.execute("SELECT * FROM message WHERE {} ORDER BY date_sent, _id".format(" AND ".join(conditions)), parameters)
+    instrumentation.count("queries")
+    while True:
+        with instrumentation.stage("sqlite"):
+            rows = message_cursor.fetchmany(chunk_size)
+            if len(rows) == 0: break
+
+            # Fetch the reactions, attachments and mentions of the whole
+            # chunk with one query per table instead of querying them
+            # separately for each message.
+            ids = [row["_id"] for row in rows]
+            placeholders = ",".join("?"*len(ids))
+            reaction_rows = group_by_message_id(cursor.execute("SELECT * FROM reaction WHERE message_id IN ({}) ORDER BY _id".format(placeholders), ids))
+            attachment_rows = group_by_message_id(cursor.execute("SELECT * FROM attachment WHERE message_id IN ({}) ORDER BY _id".format(placeholders), ids))
+            mention_rows = group_by_message_id(cursor.execute("SELECT * FROM mention WHERE thread_id = ? AND message_id IN ({}) ORDER BY _id".format(placeholders), [recipient.thread_id] + ids))
+        if instrumentation.enabled:
+            instrumentation.count("queries", 3)
+            instrumentation.count("rows", len(rows) + sum(len(x) for side_rows in (reaction_rows, attachment_rows, mention_rows) for x in side_rows.values()))
+
+        for row in rows:
+            # sender
+            if isinstance(recipient, Group):
+                contact = process_contact_group(row["from_recipient_id"])
             else:
-                contact = address_book.get_contact(int(row["from_recipient_id"]))[0]
-        # If the name is not available, then our best option is to use the
-        # default recipient. It seems that this happens with messages
-        # concerning changes in group settings.
-        if len(contact.name) == 0:
-          contact = default_recipient
-
-        # reactions
-        reactions = process_reactions(row)
-
-        # attachments
-        attachments = []
-        for row_attachment in cursor.execute("SELECT * FROM attachment WHERE message_id = ?", (row["_id"], )):
-            content_type = row_attachment["content_type"]
-            file_name = "Attachment_{}_-1.bin".format(row_attachment["_id"])
-            cls, extensions = types[content_type]
-            attachments.append(cls(file_name=file_name, timestamp=row_attachment["upload_timestamp"], content_type=content_type))
-
-        # quotes
-        if row["quote_id"] is not None and row["quote_id"] > 0:
-            sender = process_contact_group(row["quote_author"])
-            # In my data I have never seen that row["quote_attachment"] != -1,
-            # so I am ignoring quote attachments.
-            quote = Message(id=-1, sender=sender, date=int(row["quote_id"])/1000, message=row["quote_body"])
-        else:
-            quote = None
-
-        # mentions
-        mentions = []
-        if row["body"] is not None:
-            for row_mention in cursor.execute("SELECT * FROM mention WHERE thread_id = ? AND message_id = ?", (recipient.thread_id, row["_id"], )).fetchall():
-                mention_contact = address_book.get_contact(int(row_mention["recipient_id"]))[0]
-                mention_range = [int(row_mention["range_start"]), int(row_mention["range_length"])]
-                mentions.append([mention_contact, mention_range])
-
-        messages.append(Message(id=int(row["_id"]), sender=contact, date=int(row["date_sent"])/1000, message=row["body"], reactions=reactions, attachments=attachments, quote=quote, mentions=mentions))
-
-    # Order by date.
-    messages.sort(key=lambda m: m.date)
-
-    return messages
+                if row["date_server"] == -1:
+                    contact = default_recipient
+                else:
+                    contact = address_book.get_contact(int(row["from_recipient_id"]))[0]
+            # If the name is not available, then our best option is to use the
+            # default recipient. It seems that this happens with messages
+            # concerning changes in group settings.
+            if len(contact.name) == 0:
+              contact = default_recipient
+
+            # reactions
+            reactions = process_reactions(row)
+
+            # attachments
+            attachments = []
+            for row_attachment in attachment_rows.get(row["_id"], []):
+                content_type = row_attachment["content_type"]
+                file_name = "Attachment_{}_-1.bin".format(row_attachment["_id"])
+                cls, extensions = types[content_type]
+                attachments.append(cls(file_name=file_name, timestamp=row_attachment["upload_timestamp"], content_type=sys.intern(content_type)))
+
+            # quotes
+            if row["quote_id"] is not None and row["quote_id"] > 0:
+                sender = process_contact_group(row["quote_author"])
+                # In my data I have never seen that row["quote_attachment"] != -1,
+                # so I am ignoring quote attachments.
+                quote = Message(id=-1, sender=sender, date=int(row["quote_id"])/1000, message=row["quote_body"])
+            else:
+                quote = None
+
+            # mentions
+            mentions = []
+            if row["body"] is not None:
+                for row_mention in mention_rows.get(row["_id"], []):
+                    mention_contact = address_book.get_contact(int(row_mention["recipient_id"]))[0]
+                    mention_range = (int(row_mention["range_start"]), int(row_mention["range_length"]))
+                    mentions.append((mention_contact, mention_range))
+
+            # Tuples are used for the reactions, attachments and mentions as
+            # they are smaller than lists and the empty tuple is shared.
+            yield Message(id=int(row["_id"]), sender=contact, date=int(row["date_sent"])/1000, message=row["body"], reactions=reactions, attachments=tuple(attachments), quote=quote, mentions=tuple(mentions))
+
+def get_messages(cursor, recipient, address_book, default_recipient=None):
+    """Return all messages for the given recipient (group or contact) as a list
+    of Message objects ordered by message date. See iter_messages."""
 
+    return list(iter_messages(cursor, recipient, address_book, default_recipient=default_recipient))
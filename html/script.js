@@ -4,7 +4,7 @@ function enable_reaction_overlay(e) {
     document.getElementById("reaction-box").innerHTML = "";
     data.forEach((e) => {
         var p = document.createElement("p");
-        p.innerHTML = e[0] + " " + e[1];
+        p.textContent = e[0] + " " + e[1];
         document.getElementById("reaction-box").appendChild(p)
     });
 }
@@ -14,85 +14,257 @@ function disable_reaction_overlay(e) {
     document.getElementById("reaction-overlay").style.display = "none";
 }
 
-function live_search() {
-    var messages = document.querySelectorAll(".message-box");
+// When the output is split into pages, the variable pages lists the pages as
+// [file name, first date, last date]. If the selected date is on another page,
+// go to that page and pass the search there.
+function jump_to_page() {
+    if (typeof pages === "undefined") { return false; }
     var query = document.getElementById("search-input").value;
     var from = document.getElementById("search-date-from");
     var to = document.getElementById("search-date-to");
 
-    function check_condition(message, query, to, from) {
-        date = message.getAttribute("data");
-        if (from.value.length > 0 && date <= from.valueAsNumber) { return false; }
-        // Adjust by one day to make the selection inclusive from right.
-        if (to.value.length > 0 && date >= to.valueAsNumber + 24*3600*1000) { return false; }
-        return query.length == 0 || message.innerText.toLowerCase().includes(query.toLowerCase());
+    var date = from.value.length > 0 ? from.value : to.value;
+    if (date.length == 0) { return false; }
+    // The last page starting on or before the date.
+    var page = pages[0];
+    for (var i = 0; i < pages.length; i++) {
+        if (pages[i][1] <= date) { page = pages[i]; }
     }
-    
-    for (var i = 0; i < messages.length; i++) {
-        if (check_condition(messages[i], query, to, from)) {
-            messages[i].classList.remove("is-hidden");
+    if (page[0] == decodeURI(location.pathname.split("/").pop())) { return false; }
+
+    location.href = page[0] + "?" + new URLSearchParams({"q": query, "from": from.value, "to": to.value}).toString();
+    return true;
+}
+
+// The search index produced by search.py. The index file adds its chunks to
+// the array search_chunks. The words of the index are mapped to the positions
+// of the messages (as in message_boxes or virtual_list) which contain them.
+// The words are found by the substrings of up to gram_length characters they
+// contain, so that the vocabulary is not scanned for each query.
+var search_index = null;
+var message_boxes = null;
+
+// The virtual list of virtual.js if the messages are rendered from data.
+var virtual_list = null;
+
+function message_count() {
+    return virtual_list !== null ? virtual_list.messages.length : message_boxes.length;
+}
+
+function message_text(i) {
+    return virtual_list !== null ? virtual_list.text(i) : message_boxes[i].textContent;
+}
+
+function load_search_index() {
+    message_boxes = document.querySelectorAll(".message-box");
+    if (typeof search_chunks === "undefined") { return; }
+
+    var index = {"dates": [], "vocabulary": [], "positions": []};
+    var words = new Map();
+    search_chunks.forEach((chunk) => {
+        chunk.dates.forEach((date) => index.dates.push(date));
+        for (var word in chunk.words) {
+            var w = words.get(word);
+            if (w === undefined) {
+                w = index.vocabulary.length;
+                words.set(word, w);
+                index.vocabulary.push(word);
+                index.positions.push([]);
+            }
+            var positions = index.positions[w];
+            // Undo the delta encoding.
+            var deltas = chunk.words[word];
+            var n = chunk.base;
+            for (var i = 0; i < deltas.length; i++) {
+                n += deltas[i];
+                positions.push(n);
+            }
         }
-        else {
-            messages[i].classList.add("is-hidden");
+    });
+    index.grams = null;
+
+    // Do not use an index which does not match the page.
+    if (index.dates.length == message_count()) {
+        search_index = index;
+        // Index the vocabulary after the page has been shown.
+        setTimeout(search_grams, 0);
+    }
+}
+
+const gram_length = 3;
+
+// Map each substring of up to gram_length characters of the words to the
+// numbers of the words containing it in ascending order.
+function gram_index(vocabulary) {
+    var grams = new Map();
+    for (var w = 0; w < vocabulary.length; w++) {
+        var word = vocabulary[w];
+        for (var n = 1; n <= gram_length; n++) {
+            for (var i = 0; i + n <= word.length; i++) {
+                var gram = word.substr(i, n);
+                var words = grams.get(gram);
+                if (words === undefined) {
+                    grams.set(gram, [w]);
+                }
+                else if (words[words.length - 1] != w) {
+                    words.push(w);
+                }
+            }
         }
     }
+    return grams;
 }
 
-// This is from https://github.com/gilbitron/ui-avatar-svg under MIT licence.
-class UIAvatarSvg {
-    constructor() {
-        this._text = 'AB';
-        this._round = true;
-        this._size = 64;
-        this._bgColor = '#ff0000';
-        this._textColor = '#ffffff';
-        this._fontFamily = "-apple-system, BlinkMacSystemFont, 'Segoe UI', 'Roboto', 'Oxygen', 'Ubuntu', 'Fira Sans', 'Droid Sans', 'Helvetica Neue', sans-serif";
-        this._fontSize = 0.4;
-        this._fontWeight = 'normal';
+// The substrings of the words of the search index, which are indexed when
+// first needed.
+function search_grams() {
+    if (search_index.grams === null) {
+        search_index.grams = gram_index(search_index.vocabulary);
     }
+    return search_index.grams;
+}
 
-    text(text) {
-        this._text = text;
-        return this;
+// The numbers of the words of the index containing the given word. A longer
+// word is looked up by its rarest substring of gram_length characters.
+function matching_words(word) {
+    var grams = search_grams();
+    if (word.length <= gram_length) {
+        return grams.get(word) || [];
+    }
+    var candidates = null;
+    for (var i = 0; i + gram_length <= word.length; i++) {
+        var words = grams.get(word.substr(i, gram_length));
+        if (words === undefined) { return []; }
+        if (candidates === null || words.length < candidates.length) { candidates = words; }
     }
+    return candidates.filter((w) => search_index.vocabulary[w].includes(word));
+}
 
-    round(round) {
-        this._round = round;
-        return this;
+// The first position whose date is greater than the given date (or greater or
+// equal if inclusive is true).
+function date_position(date, inclusive) {
+    var dates = search_index.dates;
+    var low = 0;
+    var high = dates.length;
+    while (low < high) {
+        var middle = (low + high) >> 1;
+        if (dates[middle] < date || (!inclusive && dates[middle] == date)) { low = middle + 1; }
+        else { high = middle; }
     }
+    return low;
+}
 
-    size(size) {
-        this._size = size;
-        return this;
+// Return the positions of the messages matching the search or null if all
+// messages match.
+function indexed_search(query, from, to) {
+    if (query.length == 0 && from.value.length == 0 && to.value.length == 0) { return null; }
+
+    var start = from.value.length > 0 ? date_position(from.valueAsNumber, false) : 0;
+    // Adjust by one day to make the selection inclusive from right.
+    var end = to.value.length > 0 ? date_position(to.valueAsNumber + 24*3600*1000, true) : search_index.dates.length;
+    var matches = [];
+    query = query.toLowerCase();
+    var words = Array.from(new Set(query.match(/[\p{L}\p{N}_]+/gu) || []));
+
+    if (words.length == 0) {
+        for (var i = start; i < end; i++) { matches.push(i); }
+    }
+    else {
+        // Count for each message how many of the words of the query it
+        // contains (as a part of a word).
+        var counts = new Uint8Array(search_index.dates.length);
+        words.slice(0, 255).forEach((word, k) => {
+            matching_words(word).forEach((w) => {
+                var positions = search_index.positions[w];
+                for (var i = 0; i < positions.length; i++) {
+                    if (counts[positions[i]] == k) { counts[positions[i]] = k + 1; }
+                }
+            });
+        });
+        for (var i = start; i < end; i++) {
+            if (counts[i] == Math.min(words.length, 255)) { matches.push(i); }
+        }
     }
 
-    bgColor(bgColor) {
-        this._bgColor = bgColor;
-        return this;
+    // A query without words is looked up in the text of the messages.
+    if (query.length > 0 && words.length == 0) {
+        matches = matches.filter((i) => message_text(i).toLowerCase().includes(query));
     }
 
-    textColor(textColor) {
-        this._textColor = textColor;
-        return this;
+    return matches;
+}
+
+// Show only the messages at the given positions (or all messages if null).
+// Only the messages whose visibility changes are touched.
+var shown_matches = [];
+
+function show_matches(matches) {
+    if (virtual_list !== null) {
+        virtual_list.show(matches);
+        return;
+    }
+
+    var container = document.getElementById("messages");
+    if (matches === null) {
+        shown_matches.forEach((i) => message_boxes[i].classList.remove("match"));
+        container.classList.remove("searching");
+        shown_matches = [];
+        return;
     }
 
-    fontFamily(fontFamily) {
-        this._fontFamily = fontFamily;
-        return this;
+    // Both lists are in ascending order.
+    var i = 0;
+    var j = 0;
+    while (i < shown_matches.length || j < matches.length) {
+        if (j == matches.length || (i < shown_matches.length && shown_matches[i] < matches[j])) {
+            message_boxes[shown_matches[i++]].classList.remove("match");
+        }
+        else if (i == shown_matches.length || matches[j] < shown_matches[i]) {
+            message_boxes[matches[j++]].classList.add("match");
+        }
+        else {
+            i++;
+            j++;
+        }
     }
+    container.classList.add("searching");
+    shown_matches = matches;
+}
+
+function live_search() {
+    if (jump_to_page()) { return; }
 
-    fontSize(fontSize) {
-        this._fontSize = fontSize;
-        return this;
+    var query = document.getElementById("search-input").value;
+    var from = document.getElementById("search-date-from");
+    var to = document.getElementById("search-date-to");
+
+    if (search_index !== null) {
+        show_matches(indexed_search(query, from, to));
+        return;
     }
 
-    fontWeight(fontWeight) {
-        this._fontWeight = fontWeight;
-        return this;
+    // Without a search index, check every message.
+    if (virtual_list !== null) {
+        virtual_list.show(virtual_list.filter(query, from, to));
+        return;
     }
+    var messages = message_boxes;
 
-    generate() {
-        return `<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" width="${this._size}px" height="${this._size}px" viewBox="0 0 ${this._size} ${this._size}" version="1.1"><${this._round ? 'circle' : 'rect'} fill="${this._bgColor}" width="${this._size}" height="${this._size}" cx="${this._size/2}" cy="${this._size/2}" r="${this._size/2}"/><text x="50%" y="50%" style="color: ${this._textColor};line-height: 1;font-family: ${this._fontFamily};" alignment-baseline="middle" text-anchor="middle" font-size="${Math.round(this._size*this._fontSize)}" font-weight="${this._fontWeight}" dy=".1em" dominant-baseline="middle" fill="${this._textColor}">${this._text}</text></svg>`
+    function check_condition(message, query, to, from) {
+        date = message.getAttribute("data");
+        if (from.value.length > 0 && date <= from.valueAsNumber) { return false; }
+        // Adjust by one day to make the selection inclusive from right.
+        if (to.value.length > 0 && date >= to.valueAsNumber + 24*3600*1000) { return false; }
+        return query.length == 0 || message.innerText.toLowerCase().includes(query.toLowerCase());
+    }
+    
+    for (var i = 0; i < messages.length; i++) {
+        if (check_condition(messages[i], query, to, from)) {
+            messages[i].classList.remove("is-hidden");
+        }
+        else {
+            messages[i].classList.add("is-hidden");
+        }
     }
 }
 
@@ -108,18 +280,27 @@ document.getElementById("search-input").addEventListener("keyup", () => {
     timer = setTimeout(live_search, 300);
 });
 
-// Avatar letters.
-var avatars = document.querySelectorAll(".avatar");
-for (var i = 0; i < avatars.length; i++) {
-    child = avatars[i].childNodes[0];
-    if (child.tagName == "SPAN") {
-        child.innerHTML = (new UIAvatarSvg())
-          .text(child.getAttribute("data"))
-          .size(64)
-          .bgColor(child.getAttribute("color"))
-          .textColor("#ffffff")
-          .generate();
-          }
+if (typeof message_chunks !== "undefined") {
+    virtual_list = new VirtualList(document.getElementById("messages"), message_chunks);
+}
+load_search_index();
+
+// Pagination.
+if (typeof pages !== "undefined") {
+    // Allow selecting dates on any page.
+    ["search-date-from", "search-date-to"].forEach((id) => {
+        document.getElementById(id).setAttribute("min", pages[0][1]);
+        document.getElementById(id).setAttribute("max", pages[pages.length - 1][2]);
+    });
+
+    // Search passed from another page.
+    var params = new URLSearchParams(location.search);
+    if (params.has("q") || params.has("from") || params.has("to")) {
+        document.getElementById("search-input").value = params.get("q") || "";
+        document.getElementById("search-date-from").value = params.get("from") || "";
+        document.getElementById("search-date-to").value = params.get("to") || "";
+        live_search();
+    }
 }
 
 // Disable overlays when ESC is pressed.
@@ -0,0 +1,290 @@
+// The virtual list of the messages of output files exported with
+// "virtual_list": true. The data file written by virtual.py adds the chunks of
+// the messages to the array message_chunks. Only the messages near the
+// viewport are rendered: the messages are split into blocks of block_size
+// messages, a block is rendered when it comes near the viewport and its
+// element is reused for another block when it leaves. The heights of the
+// blocks which have not been rendered yet are estimated from the blocks
+// rendered so far.
+
+// The fields of a message and of a contact in the data.
+const DATE = 0, SENDER = 1, DATE_TEXT = 2, BODY = 3, QUOTE = 4, ATTACHMENTS = 5, REACTIONS = 6;
+const NAME = 0, AVATAR = 1;
+
+const html_escapes = {"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#x27;"};
+
+function escape_html(text) {
+    return String(text).replace(/[&<>"']/g, (c) => html_escapes[c]);
+}
+
+function unescape_html(text) {
+    return text.replace(/&(amp|lt|gt|quot|#x27);/g, (entity) => ({"&amp;": "&", "&lt;": "<", "&gt;": ">", "&quot;": '"', "&#x27;": "'"})[entity]);
+}
+
+class VirtualList {
+    constructor(container, chunks, block_size = 50) {
+        this.container = container;
+        this.block_size = block_size;
+        this.contacts = {};
+        this.messages = [];
+        chunks.forEach((chunk) => {
+            Object.assign(this.contacts, chunk.contacts);
+            chunk.messages.forEach((message) => this.messages.push(message));
+        });
+        this.avatars = {};
+
+        // The positions of the shown messages or null if all are shown.
+        this.rows = null;
+        // The rendered blocks and their elements, and the elements which can
+        // be reused.
+        this.rendered = new Map();
+        this.free = [];
+        // Total height and number of messages of the measured blocks.
+        this.measured_height = 0;
+        this.measured_messages = 0;
+        this.reset();
+
+        this.scheduled = false;
+        window.addEventListener("scroll", () => this.schedule());
+        window.addEventListener("resize", () => {
+            // The heights change with the width.
+            this.measured_height = 0;
+            this.measured_messages = 0;
+            this.reset();
+            this.schedule();
+        });
+        this.update();
+    }
+
+    get length() {
+        return this.rows !== null ? this.rows.length : this.messages.length;
+    }
+
+    // Forget the heights of the blocks and the rendered blocks.
+    reset() {
+        this.rendered.forEach((element) => this.recycle(element));
+        this.rendered.clear();
+        var blocks = Math.ceil(this.length / this.block_size);
+        this.heights = new Float64Array(blocks);
+        this.measured = new Uint8Array(blocks);
+        var estimate = this.measured_messages > 0 ? this.measured_height / this.measured_messages : 120;
+        for (var b = 0; b < blocks; b++) {
+            this.heights[b] = estimate * this.block_messages(b);
+        }
+        this.offsets = new Float64Array(blocks + 1);
+        this.layout();
+    }
+
+    block_messages(b) {
+        return Math.min(this.block_size, this.length - b*this.block_size);
+    }
+
+    // Compute the offsets of the blocks and move the rendered blocks there.
+    layout() {
+        for (var b = 0; b < this.heights.length; b++) {
+            this.offsets[b + 1] = this.offsets[b] + this.heights[b];
+        }
+        this.container.style.height = this.offsets[this.heights.length] + "px";
+        this.rendered.forEach((element, b) => element.style.top = this.offsets[b] + "px");
+    }
+
+    // The block at the given offset from the top of the list.
+    block_at(y) {
+        var low = 0;
+        var high = this.heights.length - 1;
+        while (low < high) {
+            var middle = (low + high + 1) >> 1;
+            if (this.offsets[middle] <= y) { low = middle; }
+            else { high = middle - 1; }
+        }
+        return low;
+    }
+
+    recycle(element) {
+        element.style.display = "none";
+        element.innerHTML = "";
+        this.free.push(element);
+    }
+
+    schedule() {
+        if (this.scheduled) { return; }
+        this.scheduled = true;
+        window.requestAnimationFrame(() => {
+            this.scheduled = false;
+            this.update();
+        });
+    }
+
+    // Render the blocks within a screen height of the viewport and recycle
+    // the other blocks.
+    update() {
+        if (this.heights.length == 0) { return; }
+
+        // As the measured heights of the blocks differ from the estimates, the
+        // blocks are rendered until the range of blocks no longer changes.
+        for (var round = 0; round < 4; round++) {
+            var top = window.scrollY - this.container.offsetTop;
+            var first = this.block_at(top - window.innerHeight);
+            var last = this.block_at(top + 2*window.innerHeight);
+            // The block at the top of the viewport stays in place.
+            var anchor = this.block_at(Math.max(0, top));
+            var anchor_offset = this.offsets[anchor] - top;
+
+            this.rendered.forEach((element, b) => {
+                if (b < first || b > last) {
+                    this.recycle(element);
+                    this.rendered.delete(b);
+                }
+            });
+
+            var added = [];
+            for (var b = first; b <= last; b++) {
+                if (this.rendered.has(b)) { continue; }
+                var element = this.free.pop();
+                if (element === undefined) {
+                    element = document.createElement("div");
+                    element.className = "message-block";
+                    this.container.appendChild(element);
+                }
+                element.innerHTML = this.render_block(b);
+                element.style.top = this.offsets[b] + "px";
+                element.style.display = "";
+                this.rendered.set(b, element);
+                added.push(b);
+            }
+            if (added.length == 0) { return; }
+
+            // Measure the new blocks all at once.
+            var changed = false;
+            added.map((b) => [b, this.rendered.get(b).offsetHeight]).forEach(([b, height]) => {
+                if (!this.measured[b]) {
+                    this.measured[b] = 1;
+                    this.measured_height += height;
+                    this.measured_messages += this.block_messages(b);
+                }
+                if (height != this.heights[b]) {
+                    this.heights[b] = height;
+                    changed = true;
+                }
+            });
+            if (!changed) { return; }
+
+            this.layout();
+            if (top > 0) {
+                window.scrollTo(window.scrollX, this.container.offsetTop + this.offsets[anchor] - anchor_offset);
+            }
+        }
+    }
+
+    render_block(b) {
+        var parts = [];
+        var end = b*this.block_size + this.block_messages(b);
+        for (var i = b*this.block_size; i < end; i++) {
+            parts.push(this.render(this.rows !== null ? this.rows[i] : i));
+        }
+        return parts.join("");
+    }
+
+    avatar(id) {
+        var avatar = this.avatars[id];
+        if (avatar === undefined) {
+            avatar = '<div class="avatar"><img src="' + escape_html(this.contacts[id][AVATAR]) + '" /></div>\n';
+            this.avatars[id] = avatar;
+        }
+        return avatar;
+    }
+
+    // Return the HTML of the message at the given position as made by
+    // render.MessageRenderer.
+    render(i) {
+        var message = this.messages[i];
+        var parts = ['<div class="message-box" data="', message[DATE], '">\n', this.avatar(message[SENDER])];
+        parts.push('<div class="sender">', escape_html(this.contacts[message[SENDER]][NAME]), ' (', message[DATE_TEXT], ')</div>\n');
+        parts.push('<div class="message">');
+
+        var quote = message[QUOTE];
+        if (quote) {
+            parts.push('<div class="quote">', escape_html(this.contacts[quote[0]][NAME]), ' (', quote[1], '): ', escape_html(quote[2] || ""), '</div>\n');
+        }
+        if (message[BODY]) {
+            parts.push(message[BODY]);
+        }
+
+        (message[ATTACHMENTS] || []).forEach(([kind, file, type, thumbnail]) => {
+            file = escape_html(file);
+            type = escape_html(type);
+            if (kind == "image" && thumbnail) {
+                parts.push('<a href="', file, '" target="_blank"><img src="', escape_html(thumbnail), '" loading="lazy" style="max-width: 100%" onerror="this.onerror = null; this.src = \'', file, '\'" /></a>\n');
+            }
+            else if (kind == "image") {
+                parts.push('<img src="', file, '" loading="lazy" style="max-width: 100%" />\n');
+            }
+            else if (kind == "video") {
+                parts.push('<video controls preload="none"', thumbnail ? ' poster="' + escape_html(thumbnail) + '"' : '', ' style="width: 100%"><source src="', file, '" type="', type, '">Video of type ', type, ' <span><a href="', file, '" type="', type, '">&#x2913;</a></span></video>\n');
+            }
+            else if (kind == "audio") {
+                parts.push('<audio controls preload="none"><source src="', file, '" type="', type, '">Video of type ', type, ' <span><a href="', file, '" type="', type, '">&#x2913;</a></span></audio>\n');
+            }
+        });
+        parts.push('</div>\n');
+
+        var reactions = message[REACTIONS];
+        if (reactions) {
+            // Group the reactions. The overlay lists them by name.
+            var groups = new Map();
+            var data = [];
+            reactions.forEach(([id, emoji]) => {
+                groups.set(emoji, (groups.get(emoji) || 0) + 1);
+                data.push([this.contacts[id][NAME], emoji]);
+            });
+            data.sort((a, b) => a[0] < b[0] ? -1 : a[0] > b[0] ? 1 : 0);
+            parts.push('<div class="reaction" data="', escape_html(JSON.stringify(data)), '">\n');
+            groups.forEach((count, emoji) => {
+                parts.push('<span onclick="enable_reaction_overlay(event)">', escape_html(emoji), ' ', count == 1 ? '' : count, '</span>\n');
+            });
+            parts.push('</div>');
+        }
+        parts.push('</div>\n\n');
+
+        return parts.join("");
+    }
+
+    // Return the text of the message at the given position as shown.
+    text(i) {
+        var message = this.messages[i];
+        var parts = [this.contacts[message[SENDER]][NAME], " (", message[DATE_TEXT], ")"];
+        var quote = message[QUOTE];
+        if (quote) {
+            parts.push(this.contacts[quote[0]][NAME], " (", quote[1], "): ", quote[2]);
+        }
+        if (message[BODY]) {
+            parts.push(unescape_html(message[BODY].replace(/<[^>]*>/g, "")));
+        }
+        return parts.join("");
+    }
+
+    // Return the positions of the messages containing the query between the
+    // dates of the date inputs from and to. This is used without a search
+    // index.
+    filter(query, from, to) {
+        query = query.toLowerCase();
+        var matches = [];
+        for (var i = 0; i < this.messages.length; i++) {
+            var date = this.messages[i][DATE];
+            if (from.value.length > 0 && date <= from.valueAsNumber) { continue; }
+            // Adjust by one day to make the selection inclusive from right.
+            if (to.value.length > 0 && date >= to.valueAsNumber + 24*3600*1000) { continue; }
+            if (query.length == 0 || this.text(i).toLowerCase().includes(query)) { matches.push(i); }
+        }
+        return matches;
+    }
+
+    // Show only the messages at the given positions (or all messages if null)
+    // starting from the top.
+    show(rows) {
+        this.rows = rows;
+        this.reset();
+        window.scrollTo(window.scrollX, 0);
+        this.update();
+    }
+}
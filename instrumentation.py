@@ -0,0 +1,171 @@
+import collections, contextlib, cProfile, json, os, threading, time
+
+# Timing of the stages of an export and counters of the work done. Nothing is
+# recorded unless enable has been called, so the functions below cost next to
+# nothing when profiling is off. The main thread records to times and
+# counters. Other threads (such as the message reader of pipeline.Prefetcher)
+# record to their own dicts, which are merged when the results are collected,
+# so that the threads do not update the same dicts. The stages of the other
+# threads are reported separately with the name of the thread as a prefix, as
+# their time overlaps the stages of the main thread.
+
+enabled = False
+times = collections.defaultdict(float)
+counters = collections.defaultdict(int)
+profiler = None
+
+# The thread, times and counters of the other threads recording.
+thread_records = []
+thread_records_lock = threading.Lock()
+local = threading.local()
+
+def records():
+    """Return the times and counters of the current thread."""
+
+    try:
+        return local.records
+    except AttributeError:
+        pass
+    thread = threading.current_thread()
+    if thread is threading.main_thread():
+        local.records = (times, counters)
+    else:
+        local.records = (collections.defaultdict(float), collections.defaultdict(int))
+        with thread_records_lock:
+            thread_records.append((thread, ) + local.records)
+    return local.records
+
+def enable(cprofile=False):
+    """Start recording. If cprofile is True, the export is also profiled with
+    cProfile."""
+
+    global enabled, profiler
+    enabled = True
+    if cprofile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+def count(name, n=1):
+    """Add n to the named counter."""
+
+    if enabled:
+        records()[1][name] += n
+
+@contextlib.contextmanager
+def stage(name):
+    """Add the time spent in the with statement to the named stage."""
+
+    if not enabled:
+        yield
+        return
+
+    stage_times = records()[0]
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_times[name] += time.perf_counter() - start
+
+class LapTimer:
+    """Splits the time spent in a loop into stages. Each call of lap adds the
+    time since the previous call to the named stage."""
+
+    __slots__ = ("times", "last")
+
+    def __init__(self):
+        self.times = records()[0]
+        self.last = time.perf_counter()
+
+    def lap(self, name):
+        now = time.perf_counter()
+        self.times[name] += now - self.last
+        self.last = now
+
+class NullTimer:
+
+    __slots__ = ()
+
+    def lap(self, name):
+        pass
+
+def overlap(wall_time, work_time):
+    """Record that stages which would have taken work_time seconds one after
+    another took wall_time seconds as they overlapped. The ratio is reported
+    as the speedup of the pipeline."""
+
+    if enabled:
+        times["pipeline_wall"] += wall_time
+        times["pipeline_work"] += work_time
+
+def timer():
+    """Return a LapTimer or a timer which does nothing if recording is off."""
+
+    return LapTimer() if enabled else NullTimer()
+
+def collect():
+    """Return the times and counters recorded by all threads. The other
+    threads must have finished recording."""
+
+    all_times = dict(times)
+    all_counters = dict(counters)
+    with thread_records_lock:
+        for thread, thread_times, thread_counters in thread_records:
+            for name, seconds in thread_times.items():
+                name = "{}/{}".format(thread.name, name)
+                all_times[name] = all_times.get(name, 0) + seconds
+            for name, n in thread_counters.items():
+                all_counters[name] = all_counters.get(name, 0) + n
+    return all_times, all_counters
+
+def snapshot():
+    """Return the recorded times and counters and reset them. This is used
+    for collecting the results of worker processes."""
+
+    all_times, all_counters = collect()
+    times.clear()
+    counters.clear()
+    with thread_records_lock:
+        for thread, thread_times, thread_counters in thread_records:
+            thread_times.clear()
+            thread_counters.clear()
+        # The records of the finished threads are not needed anymore.
+        thread_records[:] = [record for record in thread_records if record[0].is_alive()]
+    return {"times": all_times, "counters": all_counters}
+
+def merge(result):
+    """Add the times and counters of a snapshot to the recorded ones."""
+
+    for name, seconds in result["times"].items():
+        times[name] += seconds
+    for name, n in result["counters"].items():
+        counters[name] += n
+
+def write_report(output_path, total_time):
+    """Write the report profile.json (and profile.prof if cProfile was used)
+    to the output path and print a summary."""
+
+    global profiler
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(os.path.join(output_path, "profile.prof"))
+        profiler = None
+
+    stages, all_counters = collect()
+    wall_time = stages.pop("pipeline_wall", 0)
+    work_time = stages.pop("pipeline_work", 0)
+    report = {"total_seconds": total_time,
+              "stages": {name: round(seconds, 6) for name, seconds in sorted(stages.items(), key=lambda x: -x[1])},
+              "counters": dict(sorted(all_counters.items()))}
+    if wall_time > 0:
+        report["pipeline"] = {"wall_seconds": round(wall_time, 6), "work_seconds": round(work_time, 6), "speedup": round(work_time/wall_time, 3)}
+    os.makedirs(output_path, exist_ok=True)
+    with open(os.path.join(output_path, "profile.json"), mode="w") as f:
+        json.dump(report, f, indent=2)
+
+    print("Total {:.2f} s".format(total_time))
+    if wall_time > 0:
+        print("  Pipeline: {:.2f} s of work in {:.2f} s, speedup {:.2f}".format(work_time, wall_time, work_time/wall_time))
+    for name, seconds in report["stages"].items():
+        print("  {:24} {:10.3f} s".format(name, seconds))
+    for name, n in report["counters"].items():
+        print("  {:24} {:10}".format(name, n))
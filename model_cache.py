@@ -0,0 +1,249 @@
+import hashlib, json, os, pickle, shutil, sys
+
+from data import *
+import db, instrumentation
+from util import file_hash
+
+# The contacts, the recipients and the messages read from the database can be
+# kept in a cache on disk, so that exporting again from the same backup (for
+# example after editing the names or the colors of the contacts in the
+# config) does not read the database at all. The entries of a backup are kept
+# in a directory of the cache named after the version of the cache format and
+# the size and the content hash of the database file. The hash is computed
+# again only when the size or the modification time of the file changes.
+
+# The version of the format of the cache. The entries of other versions are
+# removed.
+CACHE_VERSION = 1
+
+# The classes of the attachments by their number in the cached messages.
+attachment_types = (Attachment, Audio, Image, Video)
+
+def write_pickle(file_name, value):
+    # Several export processes may write the same entry.
+    temp_file_name = "{}.{}.tmp".format(file_name, os.getpid())
+    with open(temp_file_name, mode="wb") as f:
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_file_name, file_name)
+
+def encode_message(message):
+    """Return the given message as a tuple of plain values in which the
+    contacts are replaced by their ids and the dates are in milliseconds."""
+
+    reactions = tuple((reaction.contact.id, reaction.emoji, round(reaction.date*1000)) for reaction in message.reactions)
+    attachments = tuple((attachment_types.index(type(attachment)), attachment.file_name, attachment.timestamp, attachment.content_type) for attachment in message.attachments)
+    quote = None
+    if message.quote is not None:
+        quote = (message.quote.sender.id, round(message.quote.date*1000), message.quote.message)
+    mentions = tuple((contact.id, start, length) for contact, (start, length) in message.mentions)
+
+    return (message.id, message.sender.id, round(message.date*1000), message.message, reactions, attachments, quote, mentions)
+
+def decode_message(row, contacts):
+    """Return the Message of a tuple made by encode_message. The contacts are
+    given by id."""
+
+    id, sender, date, body, reactions, attachments, quote, mentions = row
+    if reactions:
+        reactions = tuple(Reaction(contact=contacts[contact], emoji=sys.intern(emoji), date=date/1000) for contact, emoji, date in reactions)
+    if attachments:
+        attachments = tuple(attachment_types[kind](file_name=file_name, timestamp=timestamp, content_type=sys.intern(content_type))
+                            for kind, file_name, timestamp, content_type in attachments)
+    if quote is not None:
+        quote = Message(id=-1, sender=contacts[quote[0]], date=quote[1]/1000, message=quote[2])
+    if mentions:
+        mentions = tuple((contacts[contact], (start, length)) for contact, start, length in mentions)
+
+    return Message(id=id, sender=contacts[sender], date=date/1000, message=body, reactions=reactions, attachments=attachments, quote=quote, mentions=mentions)
+
+class ModelCache:
+    """Reads the main backup of the config through the cache if the config
+    has the key cache, and directly from the database otherwise. The database
+    is opened only when something is not found in the cache. At most
+    cache_size megabytes are kept in the cache: the entries of the backups
+    used least recently are removed first."""
+
+    def __init__(self, config):
+        self.db_file_name = os.path.join(config["data_path"], config["db_file_name"])
+        if not os.path.exists(self.db_file_name):
+            raise SystemExit("Database file '{}' does not exist.".format(self.db_file_name))
+        self.database_cursor = None
+
+        self.directory = None
+        cache = config.get("cache", False)
+        if cache:
+            self.cache_path = cache if isinstance(cache, str) else os.path.join(config["output_path"], ".cache")
+            self.max_size = config.get("cache_size", 1000)*2**20
+            self.warned = False
+            os.makedirs(self.cache_path, exist_ok=True)
+            self.directory = os.path.join(self.cache_path, self.fingerprint())
+            os.makedirs(self.directory, exist_ok=True)
+            # Mark the entry as the most recently used one.
+            os.utime(self.directory)
+
+    def cursor(self):
+        """Return the cursor of the database, opening it if needed."""
+
+        if self.database_cursor is None:
+            self.database_cursor = db.setup_db(self.db_file_name)
+        return self.database_cursor
+
+    def fingerprint(self):
+        """Return the name of the directory of the entry of the database and
+        remove the entries of older versions of the database file and of the
+        cache format. The hashes of the database files are kept in the file
+        databases.json of the cache by the path, the size and the modification
+        time of the files."""
+
+        index_file_name = os.path.join(self.cache_path, "databases.json")
+        databases = {}
+        if os.path.exists(index_file_name):
+            with open(index_file_name) as f:
+                databases = json.load(f)
+
+        path = os.path.realpath(self.db_file_name)
+        stat = os.stat(path)
+        previous = databases.get(path, None)
+        if previous is not None and previous["size"] == stat.st_size and previous["mtime"] == stat.st_mtime_ns:
+            content_hash = previous["hash"]
+        else:
+            with instrumentation.stage("cache_hash"):
+                content_hash = file_hash(path)
+            databases[path] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": content_hash}
+            temp_file_name = "{}.{}.tmp".format(index_file_name, os.getpid())
+            with open(temp_file_name, mode="w") as f:
+                json.dump(databases, f)
+            os.replace(temp_file_name, index_file_name)
+
+        entries = {"{}-{}-{}".format(CACHE_VERSION, database["size"], database["hash"]) for database in databases.values()}
+        for name in os.listdir(self.cache_path):
+            if name not in entries and os.path.isdir(os.path.join(self.cache_path, name)):
+                shutil.rmtree(os.path.join(self.cache_path, name), ignore_errors=True)
+
+        return "{}-{}-{}".format(CACHE_VERSION, stat.st_size, content_hash)
+
+    def trim(self):
+        """Remove the entries used least recently until the cache is at most
+        max_size bytes. The current entry is kept."""
+
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_path):
+            directory = os.path.join(self.cache_path, name)
+            if not os.path.isdir(directory): continue
+            size = 0
+            for file_name in os.listdir(directory):
+                try:
+                    size += os.path.getsize(os.path.join(directory, file_name))
+                except FileNotFoundError:
+                    pass
+            entries.append((os.path.getmtime(directory), directory, size))
+            total += size
+
+        for _, directory, size in sorted(entries):
+            if total <= self.max_size: break
+            if directory == self.directory: continue
+            shutil.rmtree(directory, ignore_errors=True)
+            total -= size
+        if total > self.max_size and not self.warned:
+            self.warned = True
+            print("The cache of the backup is larger than the cache size of {} MB.".format(self.max_size//2**20))
+
+    def load(self, key, function):
+        """Return the cached value of the given key, a tuple of strings and
+        numbers. If it is not cached, the value is computed by calling the
+        function with the cursor of the database and then cached."""
+
+        if self.directory is None:
+            return function(self.cursor())
+
+        file_name = os.path.join(self.directory, "{}.pickle".format(hashlib.sha1(repr(key).encode("utf-8")).hexdigest()))
+        if os.path.exists(file_name):
+            instrumentation.count("cache_hits")
+            with open(file_name, mode="rb") as f:
+                return pickle.load(f)
+
+        instrumentation.count("cache_misses")
+        value = function(self.cursor())
+        write_pickle(file_name, value)
+        self.trim()
+        return value
+
+    def find_thread(self, recipient):
+        """Set the thread id of the given recipient."""
+
+        def thread_id(cursor):
+            db.find_thread_recipient(cursor, recipient)
+            return recipient.thread_id
+
+        recipient.thread_id = self.load(("thread", recipient.id), thread_id)
+
+    def iter_messages(self, recipient, address_book, default_recipient, after=None, date_range=None, chunk_size=500):
+        """Yield the messages of the given recipient as db.iter_messages does.
+        The messages of the whole conversation are cached in chunks of
+        chunk_size messages while they are read from the database, so the
+        memory use does not depend on the number of messages. If date_range is
+        a pair of date_sent values (either can be None), only the messages
+        sent from the first up to but not including the second are yielded,
+        and they are cached separately unless the whole conversation has been
+        cached. As the senders of the messages depend on the default
+        recipient, the messages are cached separately for each default
+        recipient."""
+
+        if recipient.thread_id is None:
+            self.find_thread(recipient)
+        start, end = date_range if date_range is not None else (None, None)
+        if start is not None:
+            after = (start, -1)
+        if self.directory is None:
+            yield from db.iter_messages(self.cursor(), recipient, address_book, default_recipient=default_recipient, after=after, before=end)
+            return
+
+        file_names = [os.path.join(self.directory, "thread-{}-{}.pickle".format(recipient.thread_id, default_recipient.id))]
+        if date_range is not None:
+            file_names.append(os.path.join(self.directory, "thread-{}-{}-{}-{}.pickle".format(recipient.thread_id, default_recipient.id, start, end)))
+        for file_name in file_names:
+            if not os.path.exists(file_name): continue
+            instrumentation.count("cache_hits")
+            contacts = dict(address_book.contacts)
+            contacts[default_recipient.id] = default_recipient
+            with open(file_name, mode="rb") as f:
+                while True:
+                    with instrumentation.stage("cache"):
+                        try:
+                            rows = pickle.load(f)
+                        except EOFError:
+                            break
+                        # The rows are ordered by date and id.
+                        if end is not None and rows[0][2] >= end:
+                            break
+                        messages = [decode_message(row, contacts) for row in rows if (after is None or (row[2], row[0]) > after) and (end is None or row[2] < end)]
+                    yield from messages
+            return
+
+        if after is not None and date_range is None:
+            # Only the whole conversation or date ranges of it are cached.
+            yield from db.iter_messages(self.cursor(), recipient, address_book, default_recipient=default_recipient, after=after)
+            return
+
+        instrumentation.count("cache_misses")
+        file_name = file_names[-1]
+        temp_file_name = "{}.{}.tmp".format(file_name, os.getpid())
+        complete = False
+        try:
+            with open(temp_file_name, mode="wb") as f:
+                rows = []
+                for message in db.iter_messages(self.cursor(), recipient, address_book, default_recipient=default_recipient, after=after, before=end):
+                    rows.append(encode_message(message))
+                    if len(rows) >= chunk_size:
+                        pickle.dump(rows, f, protocol=pickle.HIGHEST_PROTOCOL)
+                        rows = []
+                    yield message
+                if len(rows) > 0:
+                    pickle.dump(rows, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_file_name, file_name)
+            complete = True
+        finally:
+            if not complete and os.path.exists(temp_file_name):
+                os.remove(temp_file_name)
+        self.trim()
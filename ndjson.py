@@ -0,0 +1,145 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""Machine-readable export of the messages as newline-delimited JSON. The
+first line of the file is a header and each further line is one message as
+processed for the output: the display names of the contacts, the mentions
+replaced and the paths of the attachments in the output directory. The file
+can be gzip-compressed. Run ./ndjson.py <file> to print a summary of an
+exported file; see NDJSONReader for reading the messages in other tools."""
+
+import argparse, collections, gzip, io, json, time
+
+FORMAT = "signal-archive-messages"
+VERSION = 1
+
+# The lines of the messages are formatted from these templates. The objects
+# have the following keys (the dates are in milliseconds since the epoch):
+# message: id, sender (contact), date, body, quote (null or quote),
+#          reactions (list of reactions), attachments (list of attachments)
+# contact: id, name
+# quote: sender, date, body
+# reaction: sender, emoji, date
+# attachment: path, content_type, thumbnail (path or null)
+message_line = '{{"id":{},"sender":{},"date":{},"body":{},"quote":{},"reactions":[{}],"attachments":[{}]}}\n'.format
+contact_object = '{{"id":{},"name":{}}}'.format
+quote_object = '{{"sender":{},"date":{},"body":{}}}'.format
+reaction_object = '{{"sender":{},"emoji":{},"date":{}}}'.format
+attachment_object = '{{"path":{},"content_type":{},"thumbnail":{}}}'.format
+
+def export_file_name(compress):
+    """Return the name of the export file in the output directory."""
+
+    return "messages.ndjson.gz" if compress else "messages.ndjson"
+
+def open_file(file_name, mode, compress):
+    """Open the export file for writing text in the given mode ("w" or "a").
+    An appended gzip file has several gzip members, which gzip readers read
+    as one stream."""
+
+    if compress:
+        return gzip.open(file_name, mode=mode + "t", encoding="utf-8", compresslevel=6)
+    return open(file_name, mode=mode, encoding="utf-8")
+
+class NDJSONWriter:
+    """Writes the messages of one thread as JSON lines to the given file
+    object (see open_file). The header is written unless the messages are
+    appended to an existing file. The JSON of each contact is made once, so
+    the contacts must not be edited while writing."""
+
+    def __init__(self, out, recipient, timezone_name, append=False):
+        self.out = out
+        self.dumps = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+        self.contacts = {}
+        if not append:
+            header = {"format": FORMAT, "version": VERSION, "recipient": {"id": recipient.id, "name": recipient.name}, "timezone": timezone_name}
+            self.out.write(self.dumps(header) + "\n")
+
+    def contact(self, contact):
+        text = self.contacts.get(contact.id, None)
+        if text is None:
+            text = contact_object(contact.id, self.dumps(contact.name))
+            self.contacts[contact.id] = text
+        return text
+
+    def add(self, message, attachment_file_names, thumbnail_file_names):
+        """Write a message. The mentions of the message must have been
+        replaced, and attachment_file_names and thumbnail_file_names are the
+        paths of the attachments of the message and their thumbnails (or
+        None) relative to the output directory."""
+
+        dumps = self.dumps
+        quote = "null"
+        if message.quote is not None:
+            quote = quote_object(self.contact(message.quote.sender), round(message.quote.date*1000), dumps(message.quote.message))
+        reactions = ",".join(reaction_object(self.contact(reaction.contact), dumps(reaction.emoji), round(reaction.date*1000)) for reaction in message.reactions)
+        attachments = ""
+        if message.attachments:
+            attachments = ",".join(attachment_object(dumps(file_name), dumps(attachment.content_type), dumps(thumbnail))
+                                   for attachment, file_name, thumbnail in zip(message.attachments, attachment_file_names, thumbnail_file_names))
+        self.out.write(message_line(message.id, self.contact(message.sender), round(message.date*1000), dumps(message.message), quote, reactions, attachments))
+
+    def close(self):
+        self.out.close()
+
+class NDJSONReader:
+    """Reads an exported file one message at a time, so the memory use does
+    not depend on the number of messages. Gzip-compressed files are
+    recognized by their content. The header is in the attribute header, and
+    iterating over the reader gives the messages as dictionaries."""
+
+    def __init__(self, file_name):
+        self.raw = open(file_name, mode="rb")
+        if self.raw.peek(2)[:2] == b"\x1f\x8b":
+            self.file = io.TextIOWrapper(gzip.GzipFile(fileobj=self.raw), encoding="utf-8")
+        else:
+            self.file = io.TextIOWrapper(self.raw, encoding="utf-8")
+        try:
+            self.header = json.loads(self.file.readline())
+        except ValueError:
+            self.header = None
+        if not isinstance(self.header, dict) or self.header.get("format", None) != FORMAT:
+            self.close()
+            raise SystemExit("File '{}' is not an export of messages.".format(file_name))
+        if self.header["version"] > VERSION:
+            self.close()
+            raise SystemExit("File '{}' has the unsupported version {}.".format(file_name, self.header["version"]))
+
+    def __iter__(self):
+        for line in self.file:
+            yield json.loads(line)
+
+    def close(self):
+        self.file.close()
+        self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print a summary of an NDJSON export of messages.")
+    parser.add_argument("file", help="messages.ndjson or messages.ndjson.gz file")
+    args = parser.parse_args()
+
+    with NDJSONReader(args.file) as reader:
+        count = 0
+        first = None
+        last = None
+        senders = collections.Counter()
+        attachments = 0
+        for message in reader:
+            count += 1
+            first = message["date"] if first is None else min(first, message["date"])
+            last = message["date"] if last is None else max(last, message["date"])
+            senders[message["sender"]["name"]] += 1
+            attachments += len(message["attachments"])
+
+        print("{} (version {}), timezone {}".format(reader.header["recipient"]["name"], reader.header["version"], reader.header["timezone"]))
+        print("{} messages with {} attachments".format(count, attachments))
+        if count > 0:
+            print("From {} to {} (UTC)".format(*(time.strftime("%Y-%m-%d %H.%M.%S", time.gmtime(date/1000)) for date in (first, last))))
+        for name, n in senders.most_common():
+            print("  {:30} {}".format(name, n))
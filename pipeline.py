@@ -0,0 +1,124 @@
+import queue, threading, time
+
+# The export runs in stages connected by bounded queues. The messages are read
+# from the database and built in a background thread, rendered in the main
+# thread and written to the output files in another background thread, while
+# the attachments are copied by AttachmentCopier. Only the stages which mostly
+# wait for SQLite or the disk run in threads, as Python code in several
+# threads does not run in parallel.
+
+class Prefetcher:
+    """Iterates over the given iterable in a background thread. The items are
+    passed in chunks of chunk_size items through a queue of at most
+    queue_size chunks, so that the thread stays at most that far ahead. The
+    CPU time spent by the thread in the iterable is in seconds, and the
+    stages recorded by the thread are reported as message_reader/<stage>."""
+
+    def __init__(self, iterable, queue_size=8, chunk_size=256):
+        self.iterator = iter(iterable)
+        self.queue = queue.Queue(queue_size)
+        self.chunk_size = chunk_size
+        self.stopped = False
+        self.seconds = 0
+        self.thread = threading.Thread(target=self.run, name="message_reader", daemon=True)
+        self.thread.start()
+
+    def put(self, item):
+        # Give up if the consumer has stopped so that the thread does not wait
+        # forever for space in the queue.
+        while not self.stopped:
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run(self):
+        try:
+            chunk = []
+            start = time.thread_time()
+            for item in self.iterator:
+                chunk.append(item)
+                if len(chunk) >= self.chunk_size:
+                    self.seconds += time.thread_time() - start
+                    if not self.put(chunk): return
+                    chunk = []
+                    start = time.thread_time()
+            self.seconds += time.thread_time() - start
+            if len(chunk) > 0 and not self.put(chunk): return
+            self.put(None)
+        except BaseException as e:
+            # The exception is raised in the consumer.
+            self.put(e)
+
+    def __iter__(self):
+        try:
+            while True:
+                chunk = self.queue.get()
+                if chunk is None:
+                    return
+                if isinstance(chunk, BaseException):
+                    raise chunk
+                yield from chunk
+        finally:
+            self.stopped = True
+            self.thread.join()
+
+class BackgroundWriter:
+    """Writes to the given file in a background thread. The written strings
+    are joined to blocks of at least block_size characters, and at most
+    queue_size blocks wait to be written, after which write waits for the
+    disk. The CPU time spent by the thread writing is in seconds."""
+
+    def __init__(self, out, queue_size=4, block_size=2**20):
+        self.out = out
+        self.queue = queue.Queue(queue_size)
+        self.block_size = block_size
+        self.parts = []
+        self.size = 0
+        self.error = None
+        self.seconds = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, s):
+        self.parts.append(s)
+        self.size += len(s)
+        if self.size >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        if self.error is not None:
+            raise self.error
+        if len(self.parts) > 0:
+            self.queue.put("".join(self.parts))
+            self.parts = []
+            self.size = 0
+
+    def run(self):
+        while True:
+            block = self.queue.get()
+            if block is None:
+                return
+            if self.error is not None:
+                continue
+            start = time.thread_time()
+            try:
+                self.out.write(block)
+            except BaseException as e:
+                # The exception is raised in the next flush or in close.
+                self.error = e
+            self.seconds += time.thread_time() - start
+
+    def close(self):
+        """Write the rest of the data and close the file."""
+
+        try:
+            self.flush()
+        finally:
+            self.queue.put(None)
+            self.thread.join()
+            self.out.close()
+        if self.error is not None:
+            raise self.error
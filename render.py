@@ -0,0 +1,327 @@
+import colorsys, datetime, heapq, html, json, math, os, re, time
+from bisect import bisect_right
+
+from data import *
+from db import types as content_types
+
+# Notice: all output file formatting is here.
+
+HEADER = """
+    <!DOCTYPE html>
+    <html>
+    <head>
+    <title>{0}</title>
+    <meta name="viewport" content="width=device-width, initial-scale=1" />
+    <meta charset="utf-8" />
+    <link rel="stylesheet" href="other/style.css" />
+    </head>
+    <body>
+
+    <div id="reaction-overlay" onclick="disable_reaction_overlay(event)">
+      <div id="reaction-box"></div>
+    </div>
+
+    <div id="group-avatar">
+      <h1>{0}</h1>
+      {1}
+    </div>
+
+    <div id="messages">
+    """
+
+FOOTER = """
+    </div>
+
+    <div id="search-box">
+      Search: <input type="search" id="search-input" />
+      From: <input type="date" id="search-date-from" min="{0}" max="{1}" onchange="live_search()" />
+      To: <input type="date" id="search-date-to" min="{0}" max="{1}" onchange="live_search()" />{2}
+    </div>
+{3}
+    <script src="other/script.js"></script>
+
+    </body>
+    </html>
+    """
+
+# The beginning of the footer of the output file. Incremental exports remove
+# the footer starting from here and append the new messages.
+FOOTER_START = b'\n    </div>\n\n    <div id="search-box">'
+
+# Templates of the parts of a message. The format methods are bound here so
+# that they are not looked up for every message.
+message_box_start = '<div class="message-box" data="{}">\n'.format
+avatar_image = '<div class="avatar"><img src="{}" /></div>\n'.format
+sender_line = '<div class="sender">{} ({})</div>\n'.format
+quote_box = '<div class="quote">{} ({}): {}</div>\n'.format
+# The images are loaded and the videos and audio fetched only when needed. A
+# thumbnail links to the full image, which is also shown if the thumbnail is
+# missing.
+image_element = '<img src="{}" loading="lazy" style="max-width: 100%" />\n'.format
+thumbnail_element = '<a href="{0}" target="_blank"><img src="{1}" loading="lazy" style="max-width: 100%" onerror="this.onerror = null; this.src = \'{0}\'" /></a>\n'.format
+video_element = '<video controls preload="none"{2} style="width: 100%"><source src="{0}" type="{1}">Video of type {1} <span><a href="{0}" type="{1}">&#x2913;</a></span></video>\n'.format
+audio_element = '<audio controls preload="none"><source src="{0}" type="{1}">Video of type {1} <span><a href="{0}" type="{1}">&#x2913;</a></span></audio>\n'.format
+reaction_bar_start = '<div class="reaction" data="{}">\n'.format
+reaction_span = '<span onclick="enable_reaction_overlay(event)">{} {}</span>\n'.format
+
+url_regex = re.compile(r"(?i)\b((?:[a-z][\w-]+:(?:/{1,3}|[a-z0-9%])|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:'\".,<>?«»“”‘’]))", re.MULTILINE|re.UNICODE)
+
+def edit_avatar_file_name(file_name):
+    """Return the name of the given avatar file in the output directory."""
+
+    return ".".join(file_name.split(".")[:-1]) + ".jpg"
+
+def avatar_text(name):
+    """Return the letters shown in the avatar of a contact without an avatar
+    image."""
+
+    return "".join(x[0] for x in name.split(" ")).upper()
+
+# The avatar of a contact without an avatar image is the letters of the name
+# on a circle of the color of the contact as made by
+# https://github.com/gilbitron/ui-avatar-svg. It is written once per contact to
+# the file given by letter_avatar_file_name, and the messages refer to it like
+# to the avatar images.
+AVATAR_SVG = """<svg xmlns="http://www.w3.org/2000/svg" width="64px" height="64px" viewBox="0 0 64 64" version="1.1"><circle fill="{1}" cx="32" cy="32" r="32"/><text x="50%" y="50%" style="color: #ffffff;line-height: 1;font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', 'Roboto', 'Oxygen', 'Ubuntu', 'Fira Sans', 'Droid Sans', 'Helvetica Neue', sans-serif;" alignment-baseline="middle" text-anchor="middle" font-size="26" font-weight="normal" dy=".1em" dominant-baseline="middle" fill="#ffffff">{0}</text></svg>
+"""
+
+def letter_avatar_file_name(contact):
+    """Return the name of the avatar file of the given contact without an
+    avatar image in the output directory."""
+
+    return "avatar-{}.svg".format(contact.id)
+
+def letter_avatar(contact):
+    """Return the SVG of the avatar of the given contact without an avatar
+    image."""
+
+    return AVATAR_SVG.format(html.escape(avatar_text(contact.name)), html.escape(contact.color))
+
+def avatar_path(contact):
+    """Return the path of the avatar of the given contact relative to the
+    output file."""
+
+    if contact.avatar_file_name is not None:
+        return os.path.join("other", edit_avatar_file_name(contact.avatar_file_name))
+    return os.path.join("other", letter_avatar_file_name(contact))
+
+# The colors of the first senders without an avatar image. The hues of the
+# colors of further senders step around the color wheel by the golden angle so
+# that consecutive colors differ, and the lightness keeps the letters readable.
+avatar_colors = ["#36389d", "#6c3483", "#922b21", "#28b463", "#d4ac0d", "#5f6a6a", "#92a8d1"]
+
+def avatar_color(n):
+    """Return the color of the nth sender (counting from 0) without an avatar
+    image."""
+
+    if n < len(avatar_colors):
+        return avatar_colors[n]
+    r, g, b = colorsys.hls_to_rgb((n*0.618033988749895) % 1, 0.4, 0.6)
+    return "#{:02x}{:02x}{:02x}".format(round(r*255), round(g*255), round(b*255))
+
+link_template = '<a href="{0}" target="_blank">{0}</a>'.format
+
+def replace_url_to_link(s):
+    return url_regex.sub(lambda match: link_template(match.group(1)), s)
+
+def may_contain_url(s):
+    """Return False if url_regex cannot match the given text. A match needs a
+    colon (scheme), a slash (domain and path) or "www" followed by a period,
+    and none of these is introduced or removed by html.escape."""
+
+    return ":" in s or "/" in s or ("." in s and "www" in s.lower())
+
+def replace_mentions(text, mentions):
+    """Return the given text with the mentions replaced with the names of the
+    mentioned contacts. The mentions are pairs of contacts and ranges (start,
+    length). Only the positions of the mentions and the positions to be
+    skipped are visited, so the time is linear in the length of the text."""
+
+    mention_map = {mention[1][0]:(mention[0], mention[1][1]) for mention in mentions}
+    parts = []
+    # The position up to which the text has been copied to parts.
+    copied = 0
+    # This is for skipping extra spaces that are sometimes introduced.
+    skip = set()
+    positions = [n for n in mention_map if 0 <= n < len(text)]
+    heapq.heapify(positions)
+    previous = None
+    while len(positions) > 0:
+        n = heapq.heappop(positions)
+        if n == previous or n >= len(text): continue
+        previous = n
+        parts.append(text[copied:n])
+        copied = n
+        if n in skip and text[n] == " ":
+            copied = n + 1
+            continue
+        if n in mention_map:
+            contact, length = mention_map[n]
+            if length == 1:
+                parts.append("@{}".format(contact.name))
+                copied = n + 1
+                if len(text) > n + 2 and text[n + 1] == " " and text[n + 2] in [" ", ".", ",", "!", "?"]:
+                    skip.add(n + 1)
+                    heapq.heappush(positions, n + 1)
+            elif length > 0:
+                skip.add(n + length)
+                heapq.heappush(positions, n + length)
+    parts.append(text[copied:])
+
+    return "".join(parts)
+
+def format_body(text, mentions):
+    """Process the body of a message for output. Returns the body with the
+    mentions replaced (see replace_mentions) and the HTML of this body with
+    the special characters escaped and the URLs replaced with links."""
+
+    if len(mentions) > 0:
+        text = replace_mentions(text, mentions)
+    body = html.escape(text)
+    if may_contain_url(text):
+        body = replace_url_to_link(body)
+
+    return text, body
+
+def attachment_file_name(attachment):
+    """Return the name of the given attachment file in the output
+    directory. The id of an attachment of another backup is offset as the
+    ids of its messages so that the names of the attachments of different
+    backups do not collide."""
+
+    if attachment.timestamp == 0:
+        # Use the current timestamp to minimize collisions.
+        timestamp = int(time.time())
+    else:
+        timestamp = attachment.timestamp
+    id = attachment.file_name.split(".")[0].split("_")[1]
+    if attachment.id_offset != 0:
+        id = str(int(id) + attachment.id_offset)
+    base = str(timestamp) + "_" + id
+    return base + "." + content_types[attachment.content_type][1]
+
+class TimestampFormatter:
+    """Formats timestamps as local times of a timezone like
+    datetime.datetime.fromtimestamp(timestamp, tz=timezone).strftime("%Y-%m-%d %H.%M.%S")
+    but without creating datetime objects. For pytz timezones, the UTC offset
+    of a timestamp is found by a binary search over the transition times of
+    the timezone, and the dates of the days are cached."""
+
+    def __init__(self, timezone):
+        self.timezone = timezone
+        self.transitions = None
+        self.offsets = None
+        self.days = {}
+
+        epoch = datetime.datetime(1970, 1, 1)
+        if hasattr(timezone, "_utc_transition_times") and hasattr(timezone, "_transition_info"):
+            # pytz timezone with daylight saving time.
+            self.transitions = [(t - epoch).total_seconds() for t in timezone._utc_transition_times]
+            self.offsets = [info[0].total_seconds() for info in timezone._transition_info]
+        elif timezone.utcoffset(None) is not None:
+            # Timezone with a fixed offset.
+            self.transitions = [-math.inf]
+            self.offsets = [timezone.utcoffset(None).total_seconds()]
+
+    def format(self, timestamp):
+        if self.transitions is None:
+            return datetime.datetime.fromtimestamp(timestamp, tz=self.timezone).strftime("%Y-%m-%d %H.%M.%S")
+
+        n = max(0, bisect_right(self.transitions, timestamp) - 1)
+        local = math.floor(timestamp + self.offsets[n])
+        day, seconds = divmod(local, 86400)
+        date = self.days.get(day, None)
+        if date is None:
+            date = time.strftime("%Y-%m-%d", time.gmtime(day*86400))
+            self.days[day] = date
+        hours, seconds = divmod(seconds, 3600)
+        minutes, seconds = divmod(seconds, 60)
+
+        return "%s %02d.%02d.%02d" % (date, hours, minutes, seconds)
+
+class MessageRenderer:
+    """Renders messages to HTML. A message is rendered into a single string so
+    that there is one write per message to the output file. The names, the
+    quotes and the paths are escaped as in html/virtual.js. The avatars and
+    the names are rendered once per sender, so the senders must not be edited
+    while rendering."""
+
+    def __init__(self):
+        self.avatars = {}
+        self.names = {}
+
+    def avatar(self, sender):
+        avatar = self.avatars.get(sender.id, None)
+        if avatar is None:
+            avatar = avatar_image(html.escape(avatar_path(sender)))
+            self.avatars[sender.id] = avatar
+        return avatar
+
+    def name(self, contact):
+        name = self.names.get(contact.id, None)
+        if name is None:
+            name = html.escape(contact.name)
+            self.names[contact.id] = name
+        return name
+
+    def render(self, message, date, quote_date, body, attachment_file_names, thumbnail_file_names=None):
+        """Return the HTML of the given message. The parameters date and
+        quote_date are the formatted dates of the message and the quoted
+        message, body is the HTML of the body of the message (see format_body)
+        or None, and attachment_file_names lists the paths of the attachments
+        of the message relative to the output file. The paths of the
+        thumbnails of the attachments (or None for attachments without one)
+        are given in thumbnail_file_names."""
+
+        parts = [message_box_start(message.date*1000), self.avatar(message.sender)]
+
+        # Sender.
+        parts.append(sender_line(self.name(message.sender), date))
+
+        parts.append('<div class="message">')
+
+        # Quote.
+        if message.quote is not None:
+            parts.append(quote_box(self.name(message.quote.sender), quote_date, html.escape(message.quote.message or "")))
+
+        # Message.
+        if body is not None:
+            parts.append(body)
+
+        # Attachments.
+        for n, (attachment, file_name) in enumerate(zip(message.attachments or (), attachment_file_names)):
+            thumbnail = thumbnail_file_names[n] if thumbnail_file_names is not None else None
+            file_name = html.escape(file_name)
+            if thumbnail is not None:
+                thumbnail = html.escape(thumbnail)
+            if isinstance(attachment, Image):
+                parts.append(image_element(file_name) if thumbnail is None else thumbnail_element(file_name, thumbnail))
+            elif isinstance(attachment, Video):
+                parts.append(video_element(file_name, html.escape(attachment.content_type), "" if thumbnail is None else ' poster="{}"'.format(thumbnail)))
+            elif isinstance(attachment, Audio):
+                parts.append(audio_element(file_name, html.escape(attachment.content_type)))
+
+        parts.append('</div>\n')
+
+        # Reactions.
+        if len(message.reactions) > 0:
+            # Group the reactions.
+            reactions = {}
+            reaction_data = []
+            for reaction in message.reactions:
+                if not reaction.emoji in reactions:
+                    reactions[reaction.emoji] = [reaction.contact.name]
+                else:
+                    reactions[reaction.emoji].append(reaction.contact.name)
+                reaction_data.append((reaction.contact.name, reaction.emoji))
+            reaction_data.sort(key=lambda x: x[0])
+
+            # Display the reaction bar.
+            parts.append(reaction_bar_start(html.escape(json.dumps(reaction_data))))
+            for emoji, authors in reactions.items():
+                parts.append(reaction_span(html.escape(emoji), "" if len(authors) == 1 else str(len(authors))))
+            parts.append("</div>")
+
+        parts.append("</div>\n\n")
+
+        return "".join(parts)
@@ -0,0 +1,69 @@
+import collections, json, re
+
+# Words are maximal runs of word characters. The same definition is used for
+# the search queries in html/script.js.
+word_regex = re.compile(r"\w+")
+
+# The start of a chunk of an index file up to its base.
+chunk_start = re.compile(r'\(window\.search_chunks = window\.search_chunks \|\| \[\]\)\.push\(\{"base":(\d+),')
+
+class SearchIndexWriter:
+    """Writes a search index for the messages of one output file so that the
+    search in html/script.js does not need to read the text of every message.
+    The index is a JavaScript file adding one object to the array
+    search_chunks for each chunk of chunk_size messages. Each chunk gives the
+    dates of its messages and maps each lowercase word to the positions of the
+    messages containing it (delta encoded). As the chunks are independent, an
+    index can be appended to when more messages are appended to its output
+    file. In this case base is the number of messages already in the output
+    file."""
+
+    def __init__(self, file_name, base=0, append=False, chunk_size=10000):
+        self.out = open(file_name, mode="a" if append else "w")
+        self.base = base
+        self.chunk_size = chunk_size
+        self.dates = []
+        self.words = collections.defaultdict(list)
+
+    def add(self, date, text):
+        """Add a message with the given date (in milliseconds) and searchable
+        text to the index."""
+
+        n = len(self.dates)
+        words = self.words
+        for word in dict.fromkeys(word_regex.findall(text.lower())):
+            words[word].append(n)
+        self.dates.append(date)
+
+        if len(self.dates) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Write the current chunk to the index file."""
+
+        if len(self.dates) == 0: return
+
+        words = {}
+        for word, positions in self.words.items():
+            words[word] = [positions[0]] + [positions[i] - positions[i - 1] for i in range(1, len(positions))]
+        chunk = {"base": self.base, "dates": self.dates, "words": words}
+        self.out.write("(window.search_chunks = window.search_chunks || []).push({});\n".format(json.dumps(chunk, ensure_ascii=False, separators=(",", ":"))))
+
+        self.base += len(self.dates)
+        self.dates = []
+        self.words = collections.defaultdict(list)
+
+    def close(self):
+        self.flush()
+        self.out.close()
+
+def append_index(out, file_name, offset):
+    """Append the chunks of the given index file to the file object out with
+    their bases increased by offset. This joins the indexes of consecutive
+    parts of an output file."""
+
+    with open(file_name) as f:
+        for line in f:
+            match = chunk_start.match(line)
+            out.write('(window.search_chunks = window.search_chunks || []).push({{"base":{},'.format(int(match.group(1)) + offset))
+            out.write(line[match.end():])
@@ -0,0 +1,206 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""Serve the archives written by ./signal-archive.py with "archive": true for
+browsing in a web browser. Run ./server.py <file> where <file> is the JSON
+config file of the export and open http://localhost:8000/. The messages are
+shown in pages of a fixed number of messages and searched with the full text
+index of the archive, so a page opens as fast regardless of the size of the
+thread."""
+
+import argparse, functools, html, http.server, os, urllib.parse
+
+import pytz
+
+from archive import ARCHIVE_FILE_NAME, ArchiveReader
+import render
+from util import get_config
+
+PAGE_FOOTER = """
+    </div>
+
+    <div id="search-box">
+      <form method="get" action="">
+      Search: <input type="search" id="search-input" name="q" value="{0}" />
+      From: <input type="date" id="search-date-from" name="from" min="{1}" max="{2}" value="{3}" />
+      To: <input type="date" id="search-date-to" name="to" min="{1}" max="{2}" value="{4}" />
+      <input type="submit" value="Search" />
+      <span id="page-nav">{5}</span>
+      </form>
+    </div>
+
+    <script src="other/script.js"></script>
+
+    </body>
+    </html>
+    """
+
+INDEX_HEADER = """
+    <!DOCTYPE html>
+    <html>
+    <head>
+    <title>Conversations</title>
+    <meta name="viewport" content="width=device-width, initial-scale=1" />
+    <meta charset="utf-8" />
+    <link rel="stylesheet" href="{}/other/style.css" />
+    </head>
+    <body>
+
+    <div id="messages" class="index">
+    """
+
+INDEX_FOOTER = """
+    </div>
+
+    </body>
+    </html>
+    """
+
+context_link = '<div class="message-box"><a href="?{}#m{}">Show in context</a></div>\n'.format
+
+class ArchiveRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves the pages of the archives under the directory of the handler.
+    The archive in the directory <path> is served at /<path>/ and the files
+    in <path>/other, <path>/attachment and <path>/thumbnail are served as
+    they are."""
+
+    def __init__(self, *args, page_size=200, **kwargs):
+        self.page_size = page_size
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        path = urllib.parse.unquote(url.path)
+        parts = path.split("/")
+        archive_file_name = os.path.join(self.translate_path(path), ARCHIVE_FILE_NAME)
+
+        if path.endswith("/") and os.path.exists(archive_file_name):
+            params = dict(urllib.parse.parse_qsl(url.query))
+            self.send_page(self.archive_page(archive_file_name, params))
+        elif path == "/":
+            self.send_page(self.index_page())
+        elif os.path.exists(archive_file_name):
+            self.send_response(301)
+            self.send_header("Location", url.path + "/")
+            self.end_headers()
+        elif len(parts) > 2 and parts[-2] in ("other", "attachment", "thumbnail"):
+            super().do_GET()
+        else:
+            self.send_error(404)
+
+    def send_page(self, page):
+        data = page.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def archive_page(self, file_name, params):
+        """Return a page of the messages of the given archive. The parameter
+        start gives the position of the first message. If the parameters q,
+        from or to are given, only the messages containing the words of q
+        between the dates from and to are shown."""
+
+        reader = ArchiveReader(file_name)
+        try:
+            count = reader.count()
+            min_date, max_date = reader.date_range()
+            query = params.get("q", "")
+            from_date = params.get("from", "")
+            to_date = params.get("to", "")
+            searching = len(query) > 0 or len(from_date) > 0 or len(to_date) > 0
+            first = reader.day_position(from_date) if len(from_date) > 0 else 0
+            end = reader.day_position(to_date, after=True) if len(to_date) > 0 else count
+            try:
+                start = max(first, int(params.get("start", first)))
+            except ValueError:
+                start = first
+
+            # One message more than shown is read to find out if there is a
+            # next page.
+            messages = reader.search(query, start, end, self.page_size + 1)
+            next_start = messages[self.page_size][0] if len(messages) > self.page_size else None
+            messages = messages[:self.page_size]
+
+            format_timestamp = render.TimestampFormatter(pytz.timezone(reader.timezone_name)).format
+            renderer = render.MessageRenderer()
+            avatar = '<img src="other/{}" />'.format(render.edit_avatar_file_name(reader.avatar_file_name)) if reader.avatar_file_name is not None else ""
+            parts = [render.HEADER.format(html.escape(reader.name), avatar) + "\n"]
+            for position, message, attachment_file_names, thumbnail_file_names in messages:
+                date = format_timestamp(message.date)
+                quote_date = format_timestamp(message.quote.date) if message.quote is not None else None
+                body = render.format_body(message.message, ())[1] if message.message is not None else None
+                parts.append('<a id="m{}"></a>\n'.format(position))
+                parts.append(renderer.render(message, date, quote_date, body, attachment_file_names, thumbnail_file_names))
+                if searching and len(query) > 0:
+                    parts.append(context_link(urllib.parse.urlencode({"start": max(0, position - self.page_size // 2)}), position))
+
+            # Links to the other pages of the messages or of the search
+            # results. The search results are only paged forwards.
+            search = {"q": query, "from": from_date, "to": to_date} if searching else {}
+            link = lambda start, text: '<a href="?{}">{}</a>'.format(urllib.parse.urlencode(dict(search, start=start)), text)
+            nav = []
+            if start > first:
+                nav.append(link(first, "&laquo; First"))
+                if not searching:
+                    nav.append(link(max(first, start - self.page_size), "Previous"))
+            if len(messages) > 0 and searching:
+                nav.append("{} found in messages {} &ndash; {} of {}".format(len(messages), messages[0][0] + 1, messages[-1][0] + 1, count))
+            elif len(messages) > 0:
+                nav.append("{} &ndash; {} of {}".format(messages[0][0] + 1, messages[-1][0] + 1, count))
+            else:
+                nav.append("No messages")
+            if next_start is not None:
+                nav.append(link(next_start, "Next"))
+                if not searching:
+                    nav.append(link(max(next_start, count - self.page_size), "Last &raquo;"))
+
+            parts.append(PAGE_FOOTER.format(html.escape(query), min_date or "", max_date or "", html.escape(from_date), html.escape(to_date), " ".join(nav)))
+        finally:
+            reader.close()
+
+        return "".join(parts)
+
+    def index_page(self):
+        """Return a page linking to the archives in the directories under the
+        directory of the handler."""
+
+        archives = []
+        for name in sorted(os.listdir(self.directory)):
+            file_name = os.path.join(self.directory, name, ARCHIVE_FILE_NAME)
+            if os.path.exists(file_name):
+                reader = ArchiveReader(file_name)
+                archives.append((reader.name, name, reader.count()))
+                reader.close()
+
+        # Use the style of any of the archives.
+        parts = [INDEX_HEADER.format(urllib.parse.quote(archives[0][1]) if len(archives) > 0 else "") + "\n"]
+        for name, directory, count in sorted(archives, key=lambda x: x[0].lower()):
+            parts.append('<div class="message-box"><div class="message"><a href="{}/">{}</a> ({} messages)</div></div>\n'.format(urllib.parse.quote(directory), html.escape(name), count))
+        if len(archives) == 0:
+            parts.append('<div class="message-box"><div class="message">No archives found. Set "archive": true in the config and export again.</div></div>\n')
+        parts.append(INDEX_FOOTER)
+
+        return "".join(parts)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the archives of an export for browsing.")
+    parser.add_argument("config", help="JSON config file of the export")
+    parser.add_argument("--host", default="localhost", help="host name or address to listen on (default localhost)")
+    parser.add_argument("--port", type=int, default=8000, help="port to listen on (default 8000)")
+    parser.add_argument("--page-size", type=int, default=200, help="number of messages on a page (default 200)")
+    args = parser.parse_args()
+
+    config = get_config(args.config)
+    if not os.path.isdir(config["output_path"]):
+        raise SystemExit("Output path '{}' does not exist.".format(config["output_path"]))
+
+    handler = functools.partial(ArchiveRequestHandler, directory=config["output_path"], page_size=args.page_size)
+    server = http.server.ThreadingHTTPServer((args.host, args.port), handler)
+    print("Serving '{}' at http://{}:{}/".format(config["output_path"], args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
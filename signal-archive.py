@@ -1,271 +1,980 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
-import datetime, html, json, os, shutil, re, time
-from functools import partial
+import html, itertools, json, multiprocessing, os, pickle, shutil, re, sys, time
 
 import pytz
 
+from archive import ARCHIVE_FILE_NAME, ARCHIVE_VERSION, ArchiveWriter, archive_version
+from attachments import AttachmentCopier, AttachmentStore, copy_summary
 from data import *
-import db
-from db import types as content_types
-from util import get_config
+from model_cache import ModelCache
+from ndjson import NDJSONWriter
+from pipeline import BackgroundWriter, Prefetcher
+from render import FOOTER_START
+from search import SearchIndexWriter, append_index
+from sources import attachment_source_file_name, load_sources, merge_messages, cursors as source_cursors
+from thumbnails import ThumbnailGenerator
+from virtual import MessageDataWriter
+import db, instrumentation, ndjson, render
+from util import get_config, load_state, save_state
+
+# The size of the write buffer of the output files.
+OUTPUT_BUFFER_SIZE = 2**20
+
+# The version of the format of the output files. Incremental exports do not
+# append to output files of other versions. Version 2 escapes the names and
+# the quotes.
+OUTPUT_VERSION = 2
+
+def search_index_file_name(page):
+    return os.path.join("other", page["file"][:-len(".html")] + ".search.js")
+
+def message_data_file_name(page):
+    return os.path.join("other", page["file"][:-len(".html")] + ".messages.js")
+
+def footer_scripts(page, virtual_list):
+    # The messages are rendered in the browser if virtual_list is set.
+    scripts = '\n    <script src="{}"></script>'.format(search_index_file_name(page))
+    if virtual_list:
+        scripts += '\n    <script src="{}"></script>'.format(message_data_file_name(page))
+        scripts += '\n    <script src="other/virtual.js"></script>'
+    return scripts
+
+def attachment_copier(config):
+    """Return an AttachmentCopier for the config. The attachments are stored
+    in the attachment store if the config has attachment_store set."""
+
+    store = AttachmentStore(config["attachment_store"]) if "attachment_store" in config else None
+    return AttachmentCopier(threads=config.get("attachment_threads", 8), link=config.get("attachment_link", False), store=store)
+
+def copy_attachments(config, message, copier, thumbnails):
+    """Copy the attachments of the given message to the output path with the
+    copier and make their thumbnails if thumbnails is not None. Returns the
+    paths of the attachments and of their thumbnails (or None) relative to
+    the output path."""
+
+    attachment_file_names = []
+    thumbnail_file_names = []
+    if message.attachments is not None:
+        for attachment in message.attachments:
+            file_name = render.attachment_file_name(attachment)
+            source_file_name = attachment_source_file_name(config["data_path"], attachment)
+            copier.copy(source_file_name, os.path.join(config["output_path"], "attachment", file_name))
+            attachment_file_names.append(os.path.join("attachment", file_name))
+            thumbnail_file_name = os.path.join("thumbnail", os.path.splitext(file_name)[0] + ".jpg")
+            if thumbnails is not None and thumbnails.make(attachment, source_file_name, os.path.join(config["output_path"], thumbnail_file_name)):
+                thumbnail_file_names.append(thumbnail_file_name)
+            else:
+                thumbnail_file_names.append(None)
+
+    return attachment_file_names, thumbnail_file_names
+
+def search_text(message, date, quote_date):
+    """Return the text shown for the given message for the search index."""
+
+    text = [message.sender.name, date]
+    if message.quote is not None:
+        text += [message.quote.sender.name, quote_date, message.quote.message or ""]
+    if message.message is not None:
+        text.append(message.message)
+    return " ".join(text)
+
+def copy_other_files(config, copy_avatars, letter_avatars):
+    """Copy the style sheet, the scripts and the given avatar files to the
+    directory other of the output path and write the avatars of the given
+    contacts without an avatar file."""
 
-def produce_output_file(config, recipient, messages, timezone, address_book, default_recipient):
-    """Produce a single HTML output file based on the given data."""
-
-    # Notice: all output file formatting is here.
-
-    # The below code is perhaps not very nice but it is simple.
+    other_path = os.path.join(config["output_path"], "other")
+    shutil.copy("html/style.css", other_path)
+    shutil.copy("html/script.js", other_path)
+    if config.get("virtual_list", False):
+        shutil.copy("html/virtual.js", other_path)
+    for file_name in copy_avatars:
+        try:
+            shutil.copy(os.path.join(config["data_path"], file_name), os.path.join(other_path, render.edit_avatar_file_name(file_name)))
+        except FileNotFoundError:
+            print("Could not find avatar file '{}'.".format(file_name))
+    for contact in letter_avatars:
+        with open(os.path.join(other_path, render.letter_avatar_file_name(contact)), mode="w", encoding="utf-8") as out:
+            out.write(render.letter_avatar(contact))
+
+def produce_output_file(config, recipient, messages, timezone, address_book, default_recipient, state):
+    """Produce a single HTML output file based on the given data. If the config
+    has paginate set to "month" or to a number N, the messages are instead
+    split to one output file per month or per N messages, and the file out.html
+    is an index of these pages. The export state (see util.load_state) is
+    updated for the exported messages. If the state has an entry for the thread
+    of the recipient, the messages are appended to the existing output files.
+    If the config has archive set, the messages are also written to an
+    archive for server.py, and if it has ndjson set, to a JSON lines file
+    (see ndjson.py). If the config has virtual_list set, the output files do
+    not contain the messages but load them from data files for the virtual
+    list of html/virtual.js. Returns the number of messages in the output
+    files."""
+
+    # Notice: the formatting of the messages is in render.py.
+
+    # State of the previous export.
+    thread_state = state["threads"].get(str(recipient.thread_id))
+
+    paginate = config.get("paginate", None)
+    if not (paginate is None or paginate == "month" or (isinstance(paginate, int) and paginate > 0)):
+        raise SystemExit("The value of paginate must be \"month\" or a positive integer.")
+
+    def page_key(n, date):
+        # The page of the nth message (counting from 0) with the given date.
+        if paginate is None:
+            return None
+        elif paginate == "month":
+            return date[:7]
+        else:
+            return n // paginate
 
-    edit_avatar_file_name = lambda x: ".".join(x.split(".")[:-1]) + ".jpg"
+    def page_file_name(key):
+        if paginate is None:
+            return "out.html"
+        elif paginate == "month":
+            return "out-{}.html".format(key)
+        else:
+            return "out-{:04d}.html".format(key + 1)
 
     os.makedirs(config["output_path"], exist_ok=True)
-    out = open(os.path.join(config["output_path"], "out.html"), mode="w")
     os.makedirs(os.path.join(config["output_path"], "attachment"), exist_ok=True)
     os.makedirs(os.path.join(config["output_path"], "other"), exist_ok=True)
 
-    header = """
-    <!DOCTYPE html>
-    <html>
-    <head>
-    <title>{0}</title>
-    <meta name="viewport" content="width=device-width, initial-scale=1" />
-    <meta charset="utf-8" />
-    <link rel="stylesheet" href="other/style.css" />
-    </head>
-    <body>
-
-    <div id="reaction-overlay" onclick="disable_reaction_overlay(event)">
-      <div id="reaction-box"></div>
-    </div>
+    header = render.HEADER.format(html.escape(recipient.name), '<img src="other/{}" />'.format(html.escape(render.edit_avatar_file_name(recipient.avatar_file_name))) if recipient.avatar_file_name is not None else "")
 
-    <div id="group-avatar">
-      <h1>{0}</h1>
-      {1}
-    </div>
+    # The attachments are copied in the background.
+    copier = attachment_copier(config)
 
-    <div id="messages">
-    """.format(recipient.name, '<img src="other/{}" />'.format(edit_avatar_file_name(recipient.avatar_file_name)) if recipient.avatar_file_name is not None else "")
+    # The thumbnails of the images and videos are made in the background too.
+    thumbnails = None
+    if config.get("thumbnails", False):
+        os.makedirs(os.path.join(config["output_path"], "thumbnail"), exist_ok=True)
+        thumbnails = ThumbnailGenerator(processes=config.get("thumbnail_processes", None), size=config.get("thumbnail_size", 480))
 
     copy_avatars = set()
     if recipient.avatar_file_name is not None:
         copy_avatars.add(recipient.avatar_file_name)
-
-    def replace_url_to_link(s):
-        regex = r"(?i)\b((?:[a-z][\w-]+:(?:/{1,3}|[a-z0-9%])|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:'\".,<>?«»“”‘’]))"
-        urls = re.compile(regex, re.MULTILINE|re.UNICODE)
-        s = urls.sub(r'<a href="\1" target="_blank">\1</a>', s)
-        return s
-
-    out.write(header + "\n")
-
-    # TODO: Add a mechanism to produce arbitrarily many colors.
-    color_list = ["#36389d", "#6c3483", "#922b21", "#28b463", "#d4ac0d", "#5f6a6a", "#92a8d1"]
-    color_idx = 0
-
-    min_date = None
+    # The senders without an avatar image by id.
+    letter_avatars = {}
+
+    # The message dates are formatted without creating datetime objects.
+    format_timestamp = render.TimestampFormatter(timezone).format
+    renderer = render.MessageRenderer()
+
+    # The messages are rendered in the browser if virtual_list is set.
+    virtual_list = config.get("virtual_list", False)
+    message_data = None
+
+    # The messages are read from the database and the output files are
+    # written in background threads (see pipeline.py) unless pipeline is false.
+    pipelined = config.get("pipeline", True)
+    writers = []
+
+    def open_output_file(file_name, mode):
+        # The output is written in large blocks.
+        out = open(os.path.join(config["output_path"], file_name), mode=mode, buffering=OUTPUT_BUFFER_SIZE)
+        if pipelined:
+            out = BackgroundWriter(out)
+            writers.append(out)
+        return out
+
+    def write_footer(out, page, previous_page, next_page):
+        scripts = footer_scripts(page, virtual_list)
+        if paginate is None:
+            out.write(render.FOOTER.format(page["min_date"], page["max_date"], "", scripts))
+            return
+
+        # Links to the previous and next pages and to the index of the pages.
+        nav = '<a href="{}">&laquo; Previous</a> '.format(previous_page["file"]) if previous_page is not None else ""
+        nav += '<a href="out.html">Index</a>'
+        nav += ' <a href="{}">Next &raquo;</a>'.format(next_page["file"]) if next_page is not None else ""
+        nav = '\n      <span id="page-nav">{}</span>'.format(nav)
+        scripts += '\n    <script src="other/pages.js"></script>'
+        out.write(render.FOOTER.format(page["min_date"], page["max_date"], nav, scripts))
+
+    if thread_state is None:
+        thread_state = {"messages": 0, "colors": {}, "paginate": paginate, "pages": [], "version": OUTPUT_VERSION}
+        page = None
+        out = None
+        appended_size = 0
+    else:
+        # Use the same colors as in the previous export.
+        for id, color in thread_state["colors"].items():
+            contact = address_book.contacts.get(int(id), None)
+            if contact is not None and contact.color is None:
+                contact.color = color
+
+        # Continue the last page.
+        page = thread_state["pages"][-1]
+        appended_size = truncate_footer(os.path.join(config["output_path"], page["file"]))
+        out = open_output_file(page["file"], "a")
+        search_index = SearchIndexWriter(os.path.join(config["output_path"], search_index_file_name(page)), base=page["messages"], append=True)
+        if virtual_list:
+            message_data = MessageDataWriter(os.path.join(config["output_path"], message_data_file_name(page)), append=True)
+
+    archive = None
+    if config.get("archive", False):
+        archive = ArchiveWriter(os.path.join(config["output_path"], ARCHIVE_FILE_NAME), recipient, str(timezone), append=page is not None)
+
+    # The value "gzip" of ndjson compresses the file.
+    messages_json = None
+    if config.get("ndjson", False):
+        if config["ndjson"] not in (True, "gzip"):
+            raise SystemExit("The value of ndjson must be true or \"gzip\".")
+        compress = config["ndjson"] == "gzip"
+        out_json = ndjson.open_file(os.path.join(config["output_path"], ndjson.export_file_name(compress)), "a" if page is not None else "w", compress)
+        if pipelined:
+            out_json = BackgroundWriter(out_json)
+            writers.append(out_json)
+        messages_json = NDJSONWriter(out_json, recipient, str(timezone), append=page is not None)
+
+    colors = thread_state["colors"]
+    color_idx = len(colors)
+
+    pages = thread_state["pages"]
+    n_messages = thread_state["messages"]
+    first_page = max(0, len(pages) - 1)
+    first_message = n_messages
+
+    if pipelined:
+        messages = Prefetcher(messages)
+
+    # The time of each message is split into the stages below (if profiling).
+    loop_start = time.perf_counter()
+    loop_thread_time = time.thread_time()
+    lap = instrumentation.timer().lap
 
     for message in messages:
-        if min_date is None: min_date = datetime.datetime.fromtimestamp(message.date, tz=timezone).strftime("%Y-%m-%d")
-        date = datetime.datetime.fromtimestamp(message.date, tz=timezone).strftime("%Y-%m-%d %H.%M.%S")
-        out.write('<div class="message-box" data="{}">\n'.format(message.date*1000))
+        lap("read_messages")
+        date = format_timestamp(message.date)
+
+        # Start a new page if needed.
+        key = page_key(n_messages, date)
+        if page is None or key != page["key"]:
+            next_page = {"file": page_file_name(key), "key": key, "messages": 0, "min_date": date[:10], "max_date": None}
+            if page is not None:
+                write_footer(out, page, pages[-2] if len(pages) > 1 else None, next_page)
+                out.close()
+                search_index.close()
+                if message_data is not None:
+                    message_data.close()
+            pages.append(next_page)
+            page = next_page
+            out = open_output_file(page["file"], "w")
+            out.write(header + "\n")
+            search_index = SearchIndexWriter(os.path.join(config["output_path"], search_index_file_name(page)))
+            if virtual_list:
+                message_data = MessageDataWriter(os.path.join(config["output_path"], message_data_file_name(page)))
+
+        n_messages += 1
+        page["messages"] += 1
+        page["max_date"] = date[:10]
 
         # Avatar.
         if message.sender.avatar_file_name is not None:
             copy_avatars.add(message.sender.avatar_file_name)
-            out.write('<div class="avatar"><img src="{}" /></div>\n'.format(os.path.join("other", edit_avatar_file_name(message.sender.avatar_file_name))))
-        else:
+        elif message.sender.id not in letter_avatars:
             if message.sender.color is None:
-                message.sender.color = color_list[color_idx]
+                message.sender.color = render.avatar_color(color_idx)
+                colors[str(message.sender.id)] = message.sender.color
                 color_idx += 1
-            color = message.sender.color
-            text = "".join(x[0] for x in message.sender.name.split(" ")).upper()
-            out.write('<div class="avatar"><span data="{}" color="{}"></span></div>\n'.format(text, color))
-
-        # Sender.
-        out.write('<div class="sender">{} ({})</div>\n'.format(message.sender.name, date))
-
-        out.write('<div class="message">')
+            letter_avatars[message.sender.id] = message.sender
 
         # Quote.
-        if message.quote is not None:
-            quote_date = datetime.datetime.fromtimestamp(message.quote.date, tz=timezone).strftime("%Y-%m-%d %H.%M.%S")
-            out.write('<div class="quote">{} ({}): {}</div>\n'.format(message.quote.sender.name, quote_date, message.quote.message))
+        quote_date = format_timestamp(message.quote.date) if message.quote is not None else None
+        lap("render")
 
-        # Message.
-        out.write('{}'.format(replace_url_to_link(html.escape(message.message)) if message.message is not None else ""))
+        # Message. The mentions are replaced here as the names of the contacts
+        # could have been edited based on the config.
+        body = None
+        if message.message is not None:
+            message.message, body = render.format_body(message.message, message.mentions)
+        lap("format_body")
 
         # Attachments.
-        if hasattr(message, "attachments") and len(message.attachments) > 0:
-            for attachment in message.attachments:
-                source_file_name = os.path.join(config["data_path"], attachment.file_name)
-                if attachment.timestamp == 0:
-                    # Use the current timestamp to minimize collisions.
-                    timestamp = int(time.time())
-                else:
-                    timestamp = attachment.timestamp
-                base = str(timestamp) + "_" + attachment.file_name.split(".")[0].split("_")[1]
-                target_file_name = os.path.join(config["output_path"], "attachment", base + "." + content_types[attachment.content_type][1])
-
-                if os.path.exists(source_file_name):
-                    try:
-                        shutil.copy(source_file_name, target_file_name)
-                    except FileExistsError:
-                        pass
-                else:
-                    print("Copying attachment '{}' failed. File does not exist.".format(source_file_name))
-
-                file_name = os.path.join("attachment", os.path.basename(target_file_name))
-                if isinstance(attachment, Image):
-                    out.write('<img src="{}" style="max-width: 100%" />\n'.format(file_name))
-                elif isinstance(attachment, Video):
-                    out.write('<video controls style="width: 100%"><source src="{0}" type="{1}">Video of type {1} <span><a href="{0}" type="{1}">&#x2913;</a></span></video>\n'.format(file_name, attachment.content_type))
-                elif isinstance(attachment, Audio):
-                    out.write('<audio controls><source src="{0}" type="{1}">Video of type {1} <span><a href="{0}" type="{1}">&#x2913;</a></span></audio>\n'.format(file_name, attachment.content_type))
-
-        out.write('</div>\n')
-        
-        # Reactions.
-        if len(message.reactions) > 0:
-            # Group the reactions.
-            reactions = {}
-            reaction_data = []
-            for reaction in message.reactions:
-                if not reaction.emoji in reactions:
-                    reactions[reaction.emoji] = [reaction.contact.name]
-                else:
-                    reactions[reaction.emoji].append(reaction.contact.name)
-                reaction_data.append((reaction.contact.name, reaction.emoji))
-            reaction_data.sort(key=lambda x: x[0])
-
-            # Display the reaction bar.
-            out.write('<div class="reaction" data="{}">\n'.format(html.escape(json.dumps(reaction_data))))
-            for emoji, authors in reactions.items():
-                out.write('<span onclick="enable_reaction_overlay(event)">{} {}</span>\n'.format(emoji, "" if len(authors) == 1 else str(len(authors))))
-            out.write("</div>")
-
-        out.write("</div>\n\n")
-
-    max_date = datetime.datetime.fromtimestamp(message.date, tz=timezone).strftime("%Y-%m-%d")
-
-    footer = """
-    </div>
+        attachment_file_names, thumbnail_file_names = copy_attachments(config, message, copier, thumbnails)
+        lap("copy_attachments")
 
-    <div id="search-box">
-      Search: <input type="search" id="search-input" />
-      From: <input type="date" id="search-date-from" min="{0}" max="{1}" onchange="live_search()" />
-      To: <input type="date" id="search-date-to" min="{0}" max="{1}" onchange="live_search()" />
-    </div>
+        if message_data is not None:
+            message_data.add(message, date, quote_date, body, attachment_file_names, thumbnail_file_names)
+        else:
+            out.write(renderer.render(message, date, quote_date, body, attachment_file_names, thumbnail_file_names))
+        lap("render")
+
+        # Add the text shown for the message to the search index.
+        text = search_text(message, date, quote_date)
+        search_index.add(round(message.date*1000), text)
+        lap("search_index")
+
+        if archive is not None:
+            archive.add(n_messages - 1, message, date[:10], text, attachment_file_names, thumbnail_file_names)
+            lap("archive")
+
+        if messages_json is not None:
+            messages_json.add(message, attachment_file_names, thumbnail_file_names)
+            lap("ndjson")
+
+    write_footer(out, page, pages[-2] if len(pages) > 1 else None, None)
+    out.close()
+    search_index.close()
+    if message_data is not None:
+        message_data.close()
+    if archive is not None:
+        with instrumentation.stage("archive"):
+            archive.close()
+    if messages_json is not None:
+        with instrumentation.stage("ndjson"):
+            messages_json.close()
+
+    with instrumentation.stage("copy_attachments"):
+        copier.close()
+    print(copier)
+    if thumbnails is not None:
+        with instrumentation.stage("thumbnails"):
+            thumbnails.close()
+        print(thumbnails)
+    if instrumentation.enabled:
+        instrumentation.count("messages_rendered", n_messages - first_message)
+        instrumentation.count("html_bytes", sum(os.path.getsize(os.path.join(config["output_path"], page["file"])) for page in pages[first_page:]) - appended_size)
+        instrumentation.count("attachments_copied", copier.files_copied)
+        instrumentation.count("attachment_bytes_copied", copier.bytes_copied)
+        instrumentation.count("attachments_skipped", copier.files_skipped)
+        instrumentation.count("attachments_linked", copier.files_linked)
+        instrumentation.times["attachment_threads"] += copier.seconds
+        # The work of the stages is the CPU time of the main thread and the
+        # time of the background threads and processes. The main thread
+        # waits for the messages (in read_messages) if pipelined.
+        work = (time.thread_time() - loop_thread_time) + copier.seconds
+        if thumbnails is not None:
+            instrumentation.count("thumbnails_made", thumbnails.made)
+            instrumentation.count("thumbnails_skipped", thumbnails.skipped)
+            instrumentation.count("thumbnails_failed", thumbnails.failed)
+            instrumentation.times["thumbnail_workers"] += thumbnails.seconds
+            work += thumbnails.seconds
+        if pipelined:
+            instrumentation.times["message_reader"] += messages.seconds
+            instrumentation.times["output_writers"] += sum(writer.seconds for writer in writers)
+            work += messages.seconds + sum(writer.seconds for writer in writers)
+        instrumentation.overlap(time.perf_counter() - loop_start, work)
+
+    copy_other_files(config, copy_avatars, letter_avatars.values())
+
+    if paginate is not None:
+        produce_page_index(config, recipient, pages)
+
+    # Save the state for incremental exports.
+    thread_state["last_date_sent"] = round(message.date*1000)
+    thread_state["last_id"] = message.id
+    thread_state["messages"] = n_messages
+    thread_state["archive"] = archive is not None
+    thread_state["ndjson"] = config.get("ndjson", False)
+    thread_state["virtual_list"] = virtual_list
+    thread_state["sources"] = [source["data_path"] for source in config.get("sources", [])]
+    state["threads"][str(recipient.thread_id)] = thread_state
+
+    return n_messages
+
+def shard_file_name(config, n, name):
+    return os.path.join(config["output_path"], "shards", "{}-{}".format(n, name))
+
+def render_shard(config, cache, recipient, timezone, address_book, default_recipient, sources, n, date_range, thumbnail_processes):
+    """Render the messages of the given recipient sent in the given date range
+    (see ModelCache.iter_messages) to the files of the nth shard of the
+    output file (see produce_sharded_output_file). The attachments are copied
+    and their thumbnails made as in produce_output_file. Returns the number of
+    messages, their first and last dates, the last message, the avatar files
+    used, the ids of the senders without an avatar file in the order of their
+    first messages and the counts of the copied attachments."""
+
+    virtual_list = config.get("virtual_list", False)
+    out = open(shard_file_name(config, n, "out.html"), mode="w", buffering=OUTPUT_BUFFER_SIZE)
+    search_index = SearchIndexWriter(shard_file_name(config, n, "search.js"))
+    message_data = MessageDataWriter(shard_file_name(config, n, "messages.js")) if virtual_list else None
+    messages_json = None
+    if config.get("ndjson", False):
+        out_json = ndjson.open_file(shard_file_name(config, n, "messages.ndjson"), "w", config["ndjson"] == "gzip")
+        messages_json = NDJSONWriter(out_json, recipient, str(timezone), append=True)
+
+    copier = attachment_copier(config)
+    thumbnails = None
+    if config.get("thumbnails", False):
+        thumbnails = ThumbnailGenerator(processes=thumbnail_processes, size=config.get("thumbnail_size", 480), warn=False)
+
+    format_timestamp = render.TimestampFormatter(timezone).format
+    renderer = render.MessageRenderer()
+    result = {"messages": 0, "first_date": None, "last_date": None, "last_date_sent": None, "last_id": None, "avatars": set(), "letter_avatars": {}}
+    lap = instrumentation.timer().lap
+
+    for message in read_messages(config, cache, recipient, address_book, default_recipient, sources, date_range=date_range):
+        lap("read_messages")
+        date = format_timestamp(message.date)
+        if result["first_date"] is None:
+            result["first_date"] = date
+        result["last_date"] = date
+        result["messages"] += 1
+
+        # The colors of the senders are assigned when the shards are joined.
+        if message.sender.avatar_file_name is not None:
+            result["avatars"].add(message.sender.avatar_file_name)
+        else:
+            result["letter_avatars"][message.sender.id] = None
+
+        quote_date = format_timestamp(message.quote.date) if message.quote is not None else None
+        body = None
+        if message.message is not None:
+            message.message, body = render.format_body(message.message, message.mentions)
+        lap("format_body")
 
-    <script src="other/script.js"></script>
+        attachment_file_names, thumbnail_file_names = copy_attachments(config, message, copier, thumbnails)
+        lap("copy_attachments")
+
+        if message_data is not None:
+            message_data.add(message, date, quote_date, body, attachment_file_names, thumbnail_file_names)
+        else:
+            out.write(renderer.render(message, date, quote_date, body, attachment_file_names, thumbnail_file_names))
+        lap("render")
+
+        search_index.add(round(message.date*1000), search_text(message, date, quote_date))
+        lap("search_index")
+
+        if messages_json is not None:
+            messages_json.add(message, attachment_file_names, thumbnail_file_names)
+            lap("ndjson")
+
+        result["last_date_sent"] = round(message.date*1000)
+        result["last_id"] = message.id
+
+    out.close()
+    search_index.close()
+    if message_data is not None:
+        message_data.close()
+    if messages_json is not None:
+        messages_json.close()
+    with instrumentation.stage("copy_attachments"):
+        copier.close()
+    if thumbnails is not None:
+        with instrumentation.stage("thumbnails"):
+            thumbnails.close()
+
+    result["avatars"] = sorted(result["avatars"])
+    result["letter_avatars"] = list(result["letter_avatars"])
+    result["copier"] = copier.counts()
+    if thumbnails is not None:
+        result["thumbnails"] = (thumbnails.made, thumbnails.skipped, thumbnails.failed)
+    if instrumentation.enabled:
+        instrumentation.count("messages_rendered", result["messages"])
+        instrumentation.count("html_bytes", os.path.getsize(shard_file_name(config, n, "out.html")))
+        instrumentation.count("attachments_copied", copier.files_copied)
+        instrumentation.count("attachment_bytes_copied", copier.bytes_copied)
+        instrumentation.count("attachments_skipped", copier.files_skipped)
+        instrumentation.count("attachments_linked", copier.files_linked)
+        instrumentation.times["attachment_threads"] += copier.seconds
+        if thumbnails is not None:
+            instrumentation.count("thumbnails_made", thumbnails.made)
+            instrumentation.count("thumbnails_skipped", thumbnails.skipped)
+            instrumentation.count("thumbnails_failed", thumbnails.failed)
+            instrumentation.times["thumbnail_workers"] += thumbnails.seconds
+
+    return result
+
+def append_file(out, file_name):
+    """Append the content of the given file to the binary file object out and
+    remove the file."""
+
+    with open(file_name, mode="rb") as f:
+        shutil.copyfileobj(f, out, OUTPUT_BUFFER_SIZE)
+    os.remove(file_name)
+
+def produce_sharded_output_file(config, cache, recipient, timezone, address_book, default_recipient, sources, state, processes):
+    """Produce a new output file for the given recipient as produce_output_file
+    does, rendering the messages in the given number of processes. The
+    conversation is split into shards of about the same number of messages by
+    date, and each process renders the messages of one shard at a time with
+    its own connection to the database (see render_shard). The shards are
+    joined in order between the header and the footer of the output file as
+    they are finished. The colors of the senders are assigned in the order of
+    their first messages in the whole conversation, as when rendering in one
+    process. Pagination and archive are not supported. Returns the number of
+    messages in the output file."""
+
+    os.makedirs(os.path.join(config["output_path"], "attachment"), exist_ok=True)
+    os.makedirs(os.path.join(config["output_path"], "other"), exist_ok=True)
+    os.makedirs(os.path.join(config["output_path"], "shards"), exist_ok=True)
+    if config.get("thumbnails", False):
+        os.makedirs(os.path.join(config["output_path"], "thumbnail"), exist_ok=True)
+        # Report the missing tools once instead of in every shard.
+        ThumbnailGenerator()
+
+    # Each process renders several shards so that a shard which takes longer
+    # than the others does not leave the other processes idle at the end.
+    n_shards = 4*processes
+    count, bounds = cache.load(("date_bounds", recipient.thread_id, n_shards), lambda cursor: db.thread_date_bounds(cursor, recipient, n_shards))
+    date_ranges = list(zip([None] + bounds, bounds + [None]))
+    # The thumbnail processes are shared by the processes.
+    thumbnail_processes = max(1, (config.get("thumbnail_processes", None) or os.cpu_count()) // processes)
+
+    virtual_list = config.get("virtual_list", False)
+    page = {"file": "out.html", "key": None, "messages": 0, "min_date": None, "max_date": None}
+    header = render.HEADER.format(html.escape(recipient.name), '<img src="other/{}" />'.format(html.escape(render.edit_avatar_file_name(recipient.avatar_file_name))) if recipient.avatar_file_name is not None else "")
+    out = open(os.path.join(config["output_path"], page["file"]), mode="wb")
+    out.write((header + "\n").encode("utf-8"))
+    search_index = open(os.path.join(config["output_path"], search_index_file_name(page)), mode="w")
+    message_data = open(os.path.join(config["output_path"], message_data_file_name(page)), mode="wb") if virtual_list else None
+    messages_json = None
+    if config.get("ndjson", False):
+        if config["ndjson"] not in (True, "gzip"):
+            raise SystemExit("The value of ndjson must be true or \"gzip\".")
+        json_file_name = os.path.join(config["output_path"], ndjson.export_file_name(config["ndjson"] == "gzip"))
+        # The header is written by itself, and the shards are appended to it.
+        NDJSONWriter(ndjson.open_file(json_file_name, "w", config["ndjson"] == "gzip"), recipient, str(timezone)).close()
+        messages_json = open(json_file_name, mode="ab")
+
+    copy_avatars = set()
+    if recipient.avatar_file_name is not None:
+        copy_avatars.add(recipient.avatar_file_name)
+    letter_avatars = {}
+    copier_counts = [0]*6
+    thumbnail_counts = [0, 0, 0]
+    last = None
+
+    contacts = pickle.dumps((address_book, default_recipient, sources, recipient))
+    with multiprocessing.Pool(processes, initializer=init_export_worker, initargs=(config, contacts)) as pool:
+        for n, (result, profile) in enumerate(pool.imap(shard_worker, [(n, date_range, thumbnail_processes) for n, date_range in enumerate(date_ranges)])):
+            if profile is not None:
+                instrumentation.merge(profile)
+            with instrumentation.stage("join_shards"):
+                append_file(out, shard_file_name(config, n, "out.html"))
+                append_index(search_index, shard_file_name(config, n, "search.js"), page["messages"])
+                os.remove(shard_file_name(config, n, "search.js"))
+                if message_data is not None:
+                    append_file(message_data, shard_file_name(config, n, "messages.js"))
+                if messages_json is not None:
+                    append_file(messages_json, shard_file_name(config, n, "messages.ndjson"))
+
+            if result["messages"] > 0:
+                page["messages"] += result["messages"]
+                if page["min_date"] is None:
+                    page["min_date"] = result["first_date"][:10]
+                page["max_date"] = result["last_date"][:10]
+                last = result
+            copy_avatars.update(result["avatars"])
+            for id in result["letter_avatars"]:
+                letter_avatars.setdefault(id, None)
+            copier_counts = [a + b for a, b in zip(copier_counts, result["copier"])]
+            if "thumbnails" in result:
+                thumbnail_counts = [a + b for a, b in zip(thumbnail_counts, result["thumbnails"])]
+
+    out.write(render.FOOTER.format(page["min_date"], page["max_date"], "", footer_scripts(page, virtual_list)).encode("utf-8"))
+    out.close()
+    search_index.close()
+    if message_data is not None:
+        message_data.close()
+    if messages_json is not None:
+        messages_json.close()
+    os.rmdir(os.path.join(config["output_path"], "shards"))
+
+    print(copy_summary(copier_counts))
+    if config.get("thumbnails", False):
+        print("Made {} thumbnails, skipped {} unchanged thumbnails, {} failed.".format(*thumbnail_counts))
+
+    # Assign the colors in the order of the first messages of the senders.
+    colors = {}
+    color_idx = 0
+    senders = dict(address_book.contacts)
+    senders[default_recipient.id] = default_recipient
+    for id in letter_avatars:
+        sender = senders[id]
+        if sender.color is None:
+            sender.color = render.avatar_color(color_idx)
+            colors[str(id)] = sender.color
+            color_idx += 1
+        letter_avatars[id] = sender
+    copy_other_files(config, copy_avatars, letter_avatars.values())
+
+    if last is None:
+        return 0
+
+    # Save the state for incremental exports.
+    thread_state = {"messages": page["messages"], "colors": colors, "paginate": None, "pages": [page], "version": OUTPUT_VERSION}
+    thread_state["last_date_sent"] = last["last_date_sent"]
+    thread_state["last_id"] = last["last_id"]
+    thread_state["archive"] = False
+    thread_state["ndjson"] = config.get("ndjson", False)
+    thread_state["virtual_list"] = virtual_list
+    thread_state["sources"] = [source["data_path"] for source in config.get("sources", [])]
+    state["threads"][str(recipient.thread_id)] = thread_state
+
+    return page["messages"]
+
+def produce_page_index(config, recipient, pages):
+    """Produce the index file out.html of paginated output and the file
+    other/pages.js which lists the pages with their date ranges for the date
+    search."""
+
+    out = open(os.path.join(config["output_path"], "out.html"), mode="w")
+
+    out.write("""
+    <!DOCTYPE html>
+    <html>
+    <head>
+    <title>{0}</title>
+    <meta name="viewport" content="width=device-width, initial-scale=1" />
+    <meta charset="utf-8" />
+    <link rel="stylesheet" href="other/style.css" />
+    </head>
+    <body>
+
+    <div id="messages" class="index">
+    <h1>{0}</h1>
+    """.format(html.escape(recipient.name)) + "\n")
+
+    for page in pages:
+        date_range = page["min_date"] if page["min_date"] == page["max_date"] else "{} &ndash; {}".format(page["min_date"], page["max_date"])
+        out.write('<div class="message-box"><div class="message"><a href="{}">{}</a> ({} messages)</div></div>\n'.format(page["file"], date_range, page["messages"]))
+
+    out.write("""
+    </div>
 
     </body>
     </html>
-    """.format(min_date, max_date)
-
-    out.write(footer)
+    """)
 
     out.close()
 
-    other_path = os.path.join(config["output_path"], "other")
-    shutil.copy("html/style.css", other_path)
-    shutil.copy("html/script.js", other_path)
-    for file_name in copy_avatars:
-        try:
-            shutil.copy(os.path.join(config["data_path"], file_name), os.path.join(other_path, edit_avatar_file_name(file_name)))
-        except FileNotFoundError:
-            print("Could not find avatar file '{}'.".format(file_name))
+    with open(os.path.join(config["output_path"], "other", "pages.js"), mode="w") as f:
+        f.write("var pages = {};\n".format(json.dumps([[page["file"], page["min_date"], page["max_date"]] for page in pages])))
 
-if __name__ == "__main__":
-    config = get_config()
+def truncate_footer(file_name):
+    """Remove the footer from the given output file so that more messages can
+    be appended to it. Returns the new size of the file."""
 
-    # Database connection and utility functions.
-    cursor = db.setup_db(os.path.join(config["data_path"], config["db_file_name"]))
-    get_messages = partial(db.get_messages, cursor)
-    find_group = partial(db.find_group, cursor)
-    find_contact = partial(db.find_contact, cursor)
+    with open(file_name, mode="rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        f.seek(max(0, size - 4096))
+        tail = f.read()
+        n = tail.rfind(FOOTER_START)
+        if n < 0:
+            raise SystemExit("Could not find the footer of the output file '{}'.".format(file_name))
+        return f.truncate(size - len(tail) + n)
 
-    # Timezone.
-    if not "timezone" in config:
-        config["timezone"] = "UTC"
-    timezone = pytz.timezone(config["timezone"])
+def read_contacts(config, cursor):
+    """Build the address book from the database and find the avatars of the
+    recipients. Returns the address book and a map from recipient ids to
+    avatar file names."""
 
-    # Contacts.
     address_book = AddressBook.from_db_cursor(cursor)
+    avatar_files = [x for x in os.listdir(config["data_path"]) if x.startswith("Avatar") and x.endswith(".bin")]
+    get_id = lambda x: int(x.split("_")[-1].split(".")[0])
+    avatar_map = {get_id(x):x for x in avatar_files}
+
+    return address_book, avatar_map
+
+def load_contacts(config, cache):
+    """Load the address book and the avatars of the contacts with the given
+    model cache and find the default recipient. Returns the address book, the
+    default recipient and a map from recipient ids to avatar file names."""
+
+    address_book, avatar_map = cache.load(("contacts", config["data_path"]), lambda cursor: read_contacts(config, cursor))
     default_recipient = address_book.get_contact(name=config["default_recipient"])
     if len(default_recipient) == 0:
         raise SystemExit("Default recipient with name '{}' not found.".format(config["default_recipient"]))
     default_recipient = default_recipient[0]
-    # Find avatars for contacts.
-    avatar_files = [x for x in os.listdir(config["data_path"]) if x.startswith("Avatar") and x.endswith(".bin")]
-    get_id = lambda x: int(x.split("_")[-1].split(".")[0])
-    avatar_map = {get_id(x):x for x in avatar_files}
+    # Set the avatars of the contacts.
     for contact in address_book.contacts.values():
         if contact.id in avatar_map:
             contact.avatar_file_name = avatar_map[contact.id]
 
-    # Figure out the recipient (contact or group) whose messages we are after.
-    if "contact" in config:
-        try:
-            _recipient = find_contact(config["contact"])[0]
-            recipient = address_book.get_contact(ids=_recipient.id)[0]
-        except IndexError:
-            raise SystemExit("No contact '{}'.".format(config["contact"]))
-    elif "group" in config:
-        try:
-            recipient = find_group(config["group"])[0]
-        except IndexError:
-            raise SystemExit("No group '{}'.".format(config["group"]))
-    else:
-        raise SystemExit("No contact or group defined for which to load messages.")
-
-    # Find avatar for group (if applicable).
-    if isinstance(recipient, Group) and recipient.id in avatar_map:
-        recipient.avatar_file_name = avatar_map[recipient.id]
+    return address_book, default_recipient, avatar_map
 
-    # Get messages and produce an output file.
-    messages = get_messages(recipient, address_book, default_recipient=default_recipient)
-    if len(messages) == 0:
-        raise SystemExit("No messages found.")
+def edit_contacts(config, address_book):
+    """Edit the contacts of the address book based on the config."""
 
-    # Edit the recipient based on the config.
     if not "contacts" in config:
         config["contacts"] = {}
-    if "avatar_file_name" in config:
-        recipient.avatar_file_name = config["avatar_file_name"]
-    # Edit contacts based on the config.
     for _recipient, recipient_data in config["contacts"].items():
         contacts = address_book.get_contact(name=_recipient)
         if len(contacts) > 0:
             contact = contacts[0]
             if "display_name" in recipient_data:
-                contact.name = recipient_data["display_name"]
+                address_book.rename_contact(contact, name=recipient_data["display_name"])
             if "avatar_file_name" in recipient_data:
                 contact.avatar_file_name = recipient_data["avatar_file_name"]
             if "color" in recipient_data:
                 contact.color = recipient_data["color"]
-    # Edit the messages for mentions (this must be here as the names could have
-    # changed above).
-    for message in messages:
-        if len(message.mentions) > 0:
-            mention_map = {mention[1][0]:[mention[0], mention[1][1]] for mention in message.mentions}
-            modified_message = ""
-            # This is for skipping extra spaces that are sometimes introduced.
-            skip = []
-            for n, c in enumerate(message.message):
-              if n in skip and c == " ": continue
-              if n in mention_map:
-                  if mention_map[n][1] == 1:
-                      modified_message += "@{}".format(mention_map[n][0].name)
-                      if len(message.message) > n + 2 and message.message[n + 1] == " " and message.message[n + 2] in [" ", ".", ",", "!", "?"]:
-                          skip.append(n + 1)
-                  else:
-                      modified_message += c
-                      skip.append(n + mention_map[n][1])
-              else:
-                  modified_message += c
-            message.message = modified_message
-
-    produce_output_file(config, recipient, messages, timezone, address_book, default_recipient)
 
+def find_recipient(cache, target, address_book, avatar_map):
+    """Find the recipient (contact or group) described by the given dictionary
+    which has the key contact or group."""
+
+    if "contact" in target:
+        try:
+            _recipient = cache.load(("find_contact", target["contact"]), lambda cursor: db.find_contact(cursor, target["contact"]))[0]
+            recipient = address_book.get_contact(ids=_recipient.id)[0]
+        except IndexError:
+            raise SystemExit("No contact '{}'.".format(target["contact"]))
+    elif "group" in target:
+        try:
+            recipient = cache.load(("find_group", target["group"]), lambda cursor: db.find_group(cursor, target["group"]))[0]
+        except IndexError:
+            raise SystemExit("No group '{}'.".format(target["group"]))
+    else:
+        raise SystemExit("No contact or group defined for which to load messages.")
+
+    # Find avatar for group (if applicable).
+    if isinstance(recipient, Group) and recipient.id in avatar_map:
+        recipient.avatar_file_name = avatar_map[recipient.id]
+
+    return recipient
+
+def other_outputs_exist(config, thread_state):
+    """Return True if the archive and the JSON lines file requested by the
+    config were written by the previous export of the thread so that the new
+    messages can be appended to them. An archive of another version is
+    written again."""
+
+    if config.get("archive", False):
+        archive_file_name = os.path.join(config["output_path"], ARCHIVE_FILE_NAME)
+        if not thread_state.get("archive", False) or not os.path.exists(archive_file_name) or archive_version(archive_file_name) != ARCHIVE_VERSION:
+            return False
+    if config.get("ndjson", False):
+        if thread_state.get("ndjson", False) != config["ndjson"] or not os.path.exists(os.path.join(config["output_path"], ndjson.export_file_name(config["ndjson"] == "gzip"))):
+            return False
+
+    return True
+
+def read_messages(config, cache, recipient, address_book, default_recipient, sources, after=None, date_range=None):
+    """Return an iterator over the messages of the given recipient read with
+    the model cache and merged with the messages of the sources. The
+    parameters after and date_range are as in ModelCache.iter_messages."""
+
+    if len(sources) == 0:
+        return cache.iter_messages(recipient, address_book, default_recipient, after=after, date_range=date_range)
+
+    # The messages on the date of the last exported message are read again to
+    # recognize their duplicates.
+    source_after = (after[0], -1) if after is not None else None
+    start, end = date_range if date_range is not None else (None, None)
+    if start is not None:
+        source_after = (start, -1)
+    streams = [cache.iter_messages(recipient, address_book, default_recipient, after=source_after, date_range=date_range)]
+    streams += [source.iter_messages(cache.cursor(), recipient, address_book, after=source_after, before=end) for source in sources]
+    return merge_messages(config["data_path"], streams, after=after)
+
+def export_recipient(config, cache, recipient, timezone, address_book, default_recipient, sources=()):
+    """Produce the output file for the given recipient. If the config has
+    incremental set, only the messages newer than the ones exported previously
+    to the output path are exported. The messages of the conversation in the
+    given other sources (see sources.py) are merged with the messages of the
+    main backup. The main backup is read with the given model cache. Returns
+    the number of messages in the output file."""
+
+    # State of the previous export.
+    state = load_state(config["output_path"])
+    if recipient.thread_id is None:
+        cache.find_thread(recipient)
+    thread_state = state["threads"].get(str(recipient.thread_id))
+    if not config.get("incremental", False) or not os.path.exists(os.path.join(config["output_path"], "out.html")) \
+            or thread_state is not None and ("pages" not in thread_state or thread_state["paginate"] != config.get("paginate", None)) \
+            or thread_state is not None and thread_state.get("virtual_list", False) != config.get("virtual_list", False) \
+            or thread_state is not None and thread_state.get("version", 0) != OUTPUT_VERSION \
+            or thread_state is not None and thread_state.get("sources", []) != [source["data_path"] for source in config.get("sources", [])] \
+            or thread_state is not None and not other_outputs_exist(config, thread_state):
+        thread_state = None
+        state["threads"].pop(str(recipient.thread_id), None)
+    after = (thread_state["last_date_sent"], thread_state["last_id"]) if thread_state is not None else None
+
+    # A large conversation can be rendered in several processes when it is
+    # exported to a single new output file.
+    processes = config.get("render_processes", 1)
+    if thread_state is None and processes > 1 and not multiprocessing.current_process().daemon:
+        if config.get("paginate", None) is not None or config.get("archive", False):
+            print("The messages are rendered in one process with paginate or archive.")
+        else:
+            n_messages = produce_sharded_output_file(config, cache, recipient, timezone, address_book, default_recipient, sources, state, processes)
+            save_state(config["output_path"], state)
+            return n_messages
+
+    # Get messages and produce an output file. The messages are streamed from
+    # the database to the output file.
+    messages = read_messages(config, cache, recipient, address_book, default_recipient, sources, after=after)
+    try:
+        first_message = next(messages)
+    except StopIteration:
+        if thread_state is not None:
+            print("No new messages for '{}'.".format(recipient.name))
+            return thread_state["messages"]
+        return 0
+    messages = itertools.chain([first_message], messages)
+
+    n_messages = produce_output_file(config, recipient, messages, timezone, address_book, default_recipient, state)
+    save_state(config["output_path"], state)
+
+    return n_messages
+
+def recipient_directory(recipient):
+    """Return the name of the output directory of the given recipient when
+    several recipients are exported."""
+
+    name = re.sub(r"[^\w\-]+", "_", recipient.name).strip("_")
+    return "{}_{}".format(name, recipient.id)
+
+def init_export_worker(config, contacts):
+    """Initialize a worker process for exporting recipients or rendering
+    shards. The address book, the default recipient and the sources (and the
+    recipient for shards) are given pickled as each export edits them."""
+
+    global worker_config, worker_cache, worker_contacts
+    if config.get("profile", False):
+        instrumentation.enable()
+        # Forget what was recorded by the parent process before the worker
+        # was forked.
+        instrumentation.snapshot()
+    worker_config = config
+    # Each worker has database connections of its own.
+    worker_cache = ModelCache(config)
+    source_cursors.clear()
+    worker_contacts = contacts
+
+def export_worker(recipient):
+    """Export the given recipient in a worker process. Returns the number of
+    exported messages and the recorded times and counters (if profiling)."""
+
+    address_book, default_recipient, sources = pickle.loads(worker_contacts)
+    if isinstance(recipient, Contact):
+        recipient = address_book.get_contact(ids=recipient.id)[0]
+
+    config = dict(worker_config)
+    config["output_path"] = os.path.join(worker_config["output_path"], recipient_directory(recipient))
+    timezone = pytz.timezone(config["timezone"])
+
+    count = export_recipient(config, worker_cache, recipient, timezone, address_book, default_recipient, sources)
+    return count, instrumentation.snapshot() if instrumentation.enabled else None
+
+def shard_worker(shard):
+    """Render the given shard of an output file in a worker process. Returns
+    the result of render_shard and the recorded times and counters (if
+    profiling)."""
+
+    n, date_range, thumbnail_processes = shard
+    address_book, default_recipient, sources, recipient = pickle.loads(worker_contacts)
+    timezone = pytz.timezone(worker_config["timezone"])
+
+    result = render_shard(worker_config, worker_cache, recipient, timezone, address_book, default_recipient, sources, n, date_range, thumbnail_processes)
+    return result, instrumentation.snapshot() if instrumentation.enabled else None
+
+def export_all(config, recipients, address_book, default_recipient, sources):
+    """Export the given recipients to their own directories under the output
+    path using a pool of worker processes and produce an index file linking to
+    the exported recipients."""
+
+    contacts = pickle.dumps((address_book, default_recipient, sources))
+    processes = config.get("processes", os.cpu_count())
+    with multiprocessing.Pool(processes, initializer=init_export_worker, initargs=(config, contacts)) as pool:
+        counts = []
+        for recipient, (count, profile) in zip(recipients, pool.imap(export_worker, recipients)):
+            print("Exported {} messages for '{}'.".format(count, recipient.name))
+            counts.append(count)
+            if profile is not None:
+                instrumentation.merge(profile)
+
+    produce_index_file(config, [(recipient, count) for recipient, count in zip(recipients, counts) if count > 0])
+
+def produce_index_file(config, recipients):
+    """Produce an HTML file linking to the output files of the given
+    recipients. The recipients are given as pairs of recipients and message
+    counts."""
+
+    os.makedirs(os.path.join(config["output_path"], "other"), exist_ok=True)
+    out = open(os.path.join(config["output_path"], "index.html"), mode="w")
+
+    out.write("""
+    <!DOCTYPE html>
+    <html>
+    <head>
+    <title>Conversations</title>
+    <meta name="viewport" content="width=device-width, initial-scale=1" />
+    <meta charset="utf-8" />
+    <link rel="stylesheet" href="other/style.css" />
+    </head>
+    <body>
+
+    <div id="messages" class="index">
+    """ + "\n")
+
+    for recipient, count in sorted(recipients, key=lambda x: x[0].name.lower()):
+        out.write('<div class="message-box"><div class="message"><a href="{}/out.html">{}</a> ({} messages)</div></div>\n'.format(recipient_directory(recipient), html.escape(recipient.name), count))
+
+    out.write("""
+    </div>
+
+    </body>
+    </html>
+    """)
+
+    out.close()
+
+    shutil.copy("html/style.css", os.path.join(config["output_path"], "other"))
+
+if __name__ == "__main__":
+    config = get_config()
+    for option in sys.argv[2:]:
+        if option == "--profile":
+            config["profile"] = True
+        elif option == "--cprofile":
+            config["cprofile"] = True
+        else:
+            raise SystemExit("Unknown option '{}'.".format(option))
+
+    # Profiling.
+    start_time = time.perf_counter()
+    if config.get("profile", False) or config.get("cprofile", False):
+        config["profile"] = True
+        instrumentation.enable(cprofile=config.get("cprofile", False))
+
+    # Database connection, which is opened only when the model cache does not
+    # have what is read.
+    cache = ModelCache(config)
+
+    # Timezone.
+    if not "timezone" in config:
+        config["timezone"] = "UTC"
+    timezone = pytz.timezone(config["timezone"])
+
+    # Contacts.
+    with instrumentation.stage("load_contacts"):
+        address_book, default_recipient, avatar_map = load_contacts(config, cache)
+        sources = load_sources(config, address_book)
+
+    if config.get("export_all", False) or "targets" in config:
+        # Figure out the recipients whose messages we are after. Either all
+        # contacts and groups with messages or the ones listed in the config.
+        if config.get("export_all", False):
+            contacts = cache.load(("list_contacts", ), db.list_contacts)
+            recipients = [address_book.get_contact(ids=contact.id)[0] for contact in contacts if contact.id in address_book.contacts]
+            recipients += cache.load(("list_groups", ), db.list_groups)
+            for recipient in recipients:
+                if isinstance(recipient, Group) and recipient.id in avatar_map:
+                    recipient.avatar_file_name = avatar_map[recipient.id]
+        else:
+            recipients = [find_recipient(cache, target, address_book, avatar_map) for target in config["targets"]]
+
+        edit_contacts(config, address_book)
+        export_all(config, recipients, address_book, default_recipient, sources)
+    else:
+        # Figure out the recipient (contact or group) whose messages we are
+        # after.
+        recipient = find_recipient(cache, config, address_book, avatar_map)
+
+        # Edit the recipient and the contacts based on the config.
+        if "avatar_file_name" in config:
+            recipient.avatar_file_name = config["avatar_file_name"]
+        edit_contacts(config, address_book)
+
+        if export_recipient(config, cache, recipient, timezone, address_book, default_recipient, sources) == 0:
+            raise SystemExit("No messages found.")
+
+    if instrumentation.enabled:
+        instrumentation.write_report(config["output_path"], time.perf_counter() - start_time)
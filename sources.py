@@ -0,0 +1,192 @@
+import hashlib, heapq, itertools, os
+
+from data import *
+import db
+
+# Several decrypted backups (for example from several phones or dates) can be
+# merged into one export. The backup given by data_path and db_file_name of
+# the config is the main backup: its contacts and conversations are exported.
+# The other backups are the sources listed in the config, and their messages
+# of the same conversations are merged with the messages of the main backup.
+
+# The messages and the contacts of the nth source get ids of their own by
+# adding n times this offset to their ids in the source. Then the order of the
+# merged messages by date and id is the same in every export.
+SOURCE_ID_OFFSET = 10**12
+
+# Database cursors of the sources by file name. These are opened once per
+# process.
+cursors = {}
+
+class Source:
+    """Another backup to be merged with the main backup. The contacts of the
+    backup are matched to the contacts of the main backup by name, and the
+    contacts which are not in the main backup are added to its address book.
+    The messages sent from the phone of the backup are attributed to the
+    contact with the id default_recipient_id. The sources are pickled to the
+    export worker processes."""
+
+    def __init__(self, number, data_path, db_file_name):
+        self.number = number
+        self.offset = number*SOURCE_ID_OFFSET
+        self.data_path = data_path
+        self.db_file_name = db_file_name
+        self.default_recipient_id = None
+        # Map from the recipient ids of the source to the ids of the contacts
+        # in the address book of the main backup.
+        self.contact_ids = {}
+
+    def cursor(self):
+        file_name = os.path.join(self.data_path, self.db_file_name)
+        if file_name not in cursors:
+            cursors[file_name] = db.setup_db(file_name)
+        return cursors[file_name]
+
+    def match_contacts(self, address_book):
+        """Match the contacts of the source to the contacts of the given
+        address book of the main backup and add the other contacts to it."""
+
+        names = {}
+        for contact in address_book.contacts.values():
+            for name in (contact.name, contact.alternate_name):
+                if name:
+                    names.setdefault(name, contact.id)
+
+        for contact in AddressBook.from_db_cursor(self.cursor()).contacts.values():
+            id = names.get(contact.name, None)
+            if id is None and contact.alternate_name:
+                id = names.get(contact.alternate_name, None)
+            if id is None:
+                id = contact.id + self.offset
+                address_book.add_contact(id=id, name=contact.name, alternate_name=contact.alternate_name)
+            self.contact_ids[contact.id] = id
+
+    def find_recipient(self, cursor, recipient):
+        """Return the recipient of the source for the given recipient of the
+        main backup (with the given cursor) or None if the source does not
+        have the conversation. Groups are matched by their group id."""
+
+        source_cursor = self.cursor()
+        source_id = None
+        if isinstance(recipient, Group):
+            row = cursor.execute("SELECT group_id FROM recipient WHERE _id = ?", (recipient.id, )).fetchone()
+            if row is not None and row["group_id"] is not None:
+                row = source_cursor.execute("SELECT _id FROM recipient WHERE group_id = ?", (row["group_id"], )).fetchone()
+                source_id = row["_id"] if row is not None else None
+        else:
+            source_id = next((id for id, main_id in self.contact_ids.items() if main_id == recipient.id), None)
+        if source_id is None:
+            return None
+
+        source_recipient = type(recipient)(id=source_id, name=recipient.name)
+        try:
+            db.find_thread_recipient(source_cursor, source_recipient)
+        except IndexError:
+            return None
+        return source_recipient
+
+    def iter_messages(self, cursor, recipient, address_book, after=None, before=None):
+        """Yield the messages of the conversation of the given recipient of
+        the main backup from this source as db.iter_messages does. The ids of
+        the messages and the attachments are offset and the attachments are
+        read from the data path of the source. The parameters after and
+        before are given for the merged messages."""
+
+        source_recipient = self.find_recipient(cursor, recipient)
+        if source_recipient is None:
+            return
+
+        contacts = AddressBook()
+        contacts.contacts = {id: address_book.contacts[main_id] for id, main_id in self.contact_ids.items()}
+        default_recipient = address_book.contacts[self.default_recipient_id]
+        if after is not None:
+            after = (after[0], after[1] - self.offset)
+
+        for message in db.iter_messages(self.cursor(), source_recipient, contacts, default_recipient=default_recipient, after=after, before=before):
+            message.id += self.offset
+            for attachment in message.attachments:
+                attachment.data_path = self.data_path
+                attachment.id_offset = self.offset
+            yield message
+
+def load_sources(config, address_book):
+    """Return the sources listed in the config and match their contacts to
+    the given address book of the main backup."""
+
+    sources = []
+    for n, source_config in enumerate(config.get("sources", [])):
+        if "data_path" not in source_config:
+            raise SystemExit("Each source must have a data_path.")
+        source = Source(n + 1, source_config["data_path"], source_config.get("db_file_name", config["db_file_name"]))
+        source.match_contacts(address_book)
+        # The owner of the phone of the backup.
+        name = source_config.get("default_recipient", config["default_recipient"])
+        default_recipient = address_book.get_contact(name=name)
+        if len(default_recipient) == 0:
+            raise SystemExit("Default recipient with name '{}' not found.".format(name))
+        source.default_recipient_id = default_recipient[0].id
+        sources.append(source)
+
+    return sources
+
+def attachment_source_file_name(data_path, attachment):
+    """Return the name of the file of the given attachment in its backup. The
+    data path of the main backup is given."""
+
+    return os.path.join(attachment.data_path or data_path, attachment.file_name)
+
+def message_key(message):
+    # The date of the messages compared is the same.
+    body = hashlib.sha1(message.message.encode("utf-8")).digest() if message.message is not None else None
+    return message.sender.id, body
+
+def resolve_attachments(data_path, message, duplicate):
+    """Replace the attachments of the message which are missing from its
+    backup with the attachments of the duplicate found in its backup."""
+
+    if not duplicate.attachments:
+        return
+    if not message.attachments:
+        message.attachments = duplicate.attachments
+        return
+    if len(message.attachments) != len(duplicate.attachments):
+        return
+
+    attachments = list(message.attachments)
+    for n, (attachment, other) in enumerate(zip(message.attachments, duplicate.attachments)):
+        if not os.path.exists(attachment_source_file_name(data_path, attachment)) and os.path.exists(attachment_source_file_name(data_path, other)):
+            attachments[n] = other
+    message.attachments = tuple(attachments)
+
+def merge_messages(data_path, streams, after=None):
+    """Merge the given streams of messages, each ordered by date and id, into
+    one stream ordered by date and id. Only the next message of each stream is
+    held in the heap of the merge, so the memory use does not depend on the
+    number of messages. Messages with the same date, sender and body are
+    duplicates of which the first (from the main backup or the first source
+    having it) is kept, with the attachments missing from its backup taken
+    from the duplicates. The data path of the main backup is given. If after
+    is given as in db.iter_messages, the streams must start from the date of
+    after so that the duplicates of the messages up to after are
+    recognized, and only the messages after it are yielded."""
+
+    after = (after[0]/1000, after[1]) if after is not None else None
+    merged = heapq.merge(*streams, key=lambda message: (message.date, message.id))
+    for date, messages in itertools.groupby(merged, key=lambda message: message.date):
+        first = next(messages)
+        second = next(messages, None)
+        if second is None:
+            if after is None or (first.date, first.id) > after:
+                yield first
+            continue
+
+        kept = {}
+        for message in itertools.chain((first, second), messages):
+            key = message_key(message)
+            if key in kept:
+                resolve_attachments(data_path, kept[key], message)
+            else:
+                kept[key] = message
+        for message in kept.values():
+            if after is None or (message.date, message.id) > after:
+                yield message
@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""Generate a synthetic Signal database for testing and benchmarking. Run
+./synthetic.py <path> <messages> to create the database file database.sqlite,
+dummy attachment and avatar files and the config file config.json which
+exports the group of the database with ./signal-archive.py."""
+
+import argparse, json, os, random, sqlite3
+
+# The tables and columns used by db.py. The indexes are the ones Signal
+# creates for these columns.
+SCHEMA = """
+CREATE TABLE recipient (_id INTEGER PRIMARY KEY, group_id TEXT, profile_joined_name TEXT, system_joined_name TEXT);
+CREATE TABLE groups (_id INTEGER PRIMARY KEY, group_id TEXT, title TEXT);
+CREATE TABLE thread (_id INTEGER PRIMARY KEY, recipient_id INTEGER);
+CREATE TABLE message (_id INTEGER PRIMARY KEY, thread_id INTEGER, date_sent INTEGER, date_server INTEGER, from_recipient_id INTEGER, body TEXT, quote_id INTEGER, quote_author INTEGER, quote_body TEXT);
+CREATE TABLE reaction (_id INTEGER PRIMARY KEY, message_id INTEGER, author_id INTEGER, emoji TEXT, date_sent INTEGER);
+CREATE TABLE attachment (_id INTEGER PRIMARY KEY, message_id INTEGER, content_type TEXT, upload_timestamp INTEGER);
+CREATE TABLE mention (_id INTEGER PRIMARY KEY, thread_id INTEGER, message_id INTEGER, recipient_id INTEGER, range_start INTEGER, range_length INTEGER);
+CREATE INDEX message_thread_date_index ON message (thread_id, date_sent);
+"""
+
+INDEXES = """
+CREATE INDEX reaction_message_id_index ON reaction (message_id);
+CREATE INDEX attachment_message_id_index ON attachment (message_id);
+CREATE INDEX mention_message_id_index ON mention (message_id);
+"""
+
+GROUP = "Family"
+
+first_names = ["Jane", "John", "Alice", "Bob", "Carol", "Dave", "Eve", "Frank", "Grace", "Heidi", "Ivan", "Judy"]
+last_names = ["Doe", "Smith", "Jones", "Brown", "Miller", "Virtanen", "Müller"]
+words = ["hello", "world", "foo", "bar", "baz", "ok", ".", ",", "!", "it's", "\"quoted\"", "<tag>", "a&b", "https://example.com/x?a=1&b=2", "www.example.org", "😀"]
+content_types = ["image/jpeg", "image/png", "video/mp4", "audio/aac", "application/pdf"]
+emojis = ["👍", "❤️", "😂", "😮"]
+
+def contact_name(id):
+    return "{} {} {}".format(first_names[id % len(first_names)], last_names[id % len(last_names)], id)
+
+def generate(path, messages, contacts=8, reactions=None, attachments=None, mentions=None, seed=1, indexes=True):
+    """Generate a database with the given number of messages, contacts,
+    reactions, attachments and mentions to the given path. By default, there
+    are half as many reactions and a tenth as many attachments and mentions as
+    messages. Most messages are in a group of all contacts and the rest in
+    private threads with the contacts. The first contact is the default
+    recipient. Returns the config for exporting the group."""
+
+    rnd = random.Random(seed)
+    reactions = messages // 2 if reactions is None else reactions
+    attachments = messages // 10 if attachments is None else attachments
+    mentions = messages // 10 if mentions is None else mentions
+
+    os.makedirs(path, exist_ok=True)
+    db_file_name = os.path.join(path, "database.sqlite")
+    if os.path.exists(db_file_name):
+        os.remove(db_file_name)
+    db = sqlite3.connect(db_file_name)
+    db.executescript(SCHEMA)
+    if indexes:
+        db.executescript(INDEXES)
+
+    # Recipients and threads. The group is recipient contacts + 1 and its
+    # thread is thread 1. The private thread with contact i is thread i + 1.
+    group_id = contacts + 1
+    db.executemany("INSERT INTO recipient VALUES (?, NULL, ?, ?)", ((id, contact_name(id), "System {}".format(id) if id % 3 == 0 else None) for id in range(1, contacts + 1)))
+    db.execute("INSERT INTO recipient VALUES (?, 'group1', NULL, NULL)", (group_id, ))
+    db.execute("INSERT INTO groups VALUES (1, 'group1', ?)", (GROUP, ))
+    db.execute("INSERT INTO thread VALUES (1, ?)", (group_id, ))
+    db.executemany("INSERT INTO thread VALUES (?, ?)", ((id + 1, id) for id in range(2, contacts + 1)))
+
+    # The messages with reactions, attachments and mentions.
+    reaction_counts = {}
+    for _ in range(reactions):
+        id = rnd.randint(1, messages)
+        reaction_counts[id] = reaction_counts.get(id, 0) + 1
+    attachment_messages = set(rnd.sample(range(1, messages + 1), min(attachments, messages)))
+    mention_messages = set(rnd.sample(range(1, messages + 1), min(mentions, messages)))
+
+    def message_rows():
+        date = 1600000000000
+        n_attachments = 0
+        for id in range(1, messages + 1):
+            date += rnd.randint(0, 120000)
+            if contacts < 2 or rnd.random() < 0.9:
+                thread_id = 1
+                sender = rnd.randint(1, contacts)
+            else:
+                thread_id = rnd.randint(3, contacts + 1)
+                sender = thread_id - 1
+            # In private threads, date_server is -1 for the messages sent by
+            # the default recipient.
+            date_server = -1 if thread_id > 1 and rnd.random() < 0.5 else date + rnd.randint(0, 1000)
+            body = " ".join(rnd.choice(words) for _ in range(rnd.randint(1, 20)))
+            if id in mention_messages:
+                position = rnd.randint(0, len(body))
+                body = body[:position] + "￼" + body[position:]
+                mention_rows.append((thread_id, id, rnd.randint(1, contacts), position, 1))
+            elif rnd.random() < 0.05:
+                body = None
+            if rnd.random() < 0.05:
+                quote = (date - rnd.randint(1000, 10**7), rnd.randint(1, contacts), " ".join(rnd.choice(words) for _ in range(rnd.randint(1, 10))))
+            else:
+                quote = (0, None, None)
+            # Some dates are out of order as in real databases.
+            date_sent = date if rnd.random() < 0.98 else date - rnd.randint(0, 600000)
+            yield (id, thread_id, date_sent, date_server, sender, body) + quote
+
+            for _ in range(reaction_counts.get(id, 0)):
+                reaction_rows.append((id, rnd.randint(1, contacts), rnd.choice(emojis), date_sent + rnd.randint(0, 10**6)))
+            if id in attachment_messages:
+                n_attachments += 1
+                attachment_rows.append((n_attachments, id, rnd.choice(content_types), date_sent))
+                with open(os.path.join(path, "Attachment_{}_-1.bin".format(n_attachments)), mode="wb") as f:
+                    f.write(rnd.randbytes(rnd.randint(100, 5000)))
+
+    reaction_rows = []
+    attachment_rows = []
+    mention_rows = []
+    db.executemany("INSERT INTO message VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", message_rows())
+    db.executemany("INSERT INTO reaction (message_id, author_id, emoji, date_sent) VALUES (?, ?, ?, ?)", reaction_rows)
+    db.executemany("INSERT INTO attachment VALUES (?, ?, ?, ?)", attachment_rows)
+    db.executemany("INSERT INTO mention (thread_id, message_id, recipient_id, range_start, range_length) VALUES (?, ?, ?, ?, ?)", mention_rows)
+    db.commit()
+    db.close()
+
+    # Avatars for some contacts and for the group.
+    for id in list(range(1, contacts + 1, 2)) + [group_id]:
+        with open(os.path.join(path, "Avatar_{}.bin".format(id)), mode="wb") as f:
+            f.write(rnd.randbytes(1000))
+
+    config = {"group": GROUP,
+              "data_path": path,
+              "db_file_name": "database.sqlite",
+              "output_path": os.path.join(path, "archived"),
+              "timezone": "Europe/Helsinki",
+              "default_recipient": contact_name(1),
+              "contacts": {contact_name(2): {"display_name": "Renamed <b>", "color": "#123456"}}}
+    with open(os.path.join(path, "config.json"), mode="w") as f:
+        json.dump(config, f, indent=2, ensure_ascii=False)
+
+    return config
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic Signal database.")
+    parser.add_argument("path", help="directory for the database and the attachment files")
+    parser.add_argument("messages", type=int, help="number of messages")
+    parser.add_argument("--contacts", type=int, default=8, help="number of contacts (default 8)")
+    parser.add_argument("--reactions", type=int, help="number of reactions (default messages/2)")
+    parser.add_argument("--attachments", type=int, help="number of attachments (default messages/10)")
+    parser.add_argument("--mentions", type=int, help="number of mentions (default messages/10)")
+    parser.add_argument("--seed", type=int, default=1, help="random seed (default 1)")
+    parser.add_argument("--no-indexes", action="store_true", help="do not index the message ids of the reactions, attachments and mentions")
+    args = parser.parse_args()
+
+    generate(args.path, args.messages, contacts=args.contacts, reactions=args.reactions, attachments=args.attachments, mentions=args.mentions, seed=args.seed, indexes=not args.no_indexes)
@@ -0,0 +1,11 @@
+from data import *
+import render
+
+def test_names_and_quotes_escaped():
+    sender = Contact(id=1, name="Bobby <b>", color="#000000")
+    quote = Message(id=-1, sender=sender, date=0, message="<i>quoted</i>")
+    message = Message(id=1, sender=sender, date=0, message="Hello", reactions=(), quote=quote)
+    page = render.MessageRenderer().render(message, "1970-01-01 00.00.00", "1970-01-01 00.00.00", "Hello", [])
+    assert "<b>" not in page and "<i>" not in page
+    assert '<div class="sender">Bobby &lt;b&gt; (1970-01-01 00.00.00)</div>' in page
+    assert '<div class="quote">Bobby &lt;b&gt; (1970-01-01 00.00.00): &lt;i&gt;quoted&lt;/i&gt;</div>' in page
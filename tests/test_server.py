@@ -0,0 +1,65 @@
+import functools, http.server, re, threading, urllib.error, urllib.request
+
+import pytest
+
+from archive import ARCHIVE_FILE_NAME, ArchiveWriter
+from data import *
+from server import ArchiveRequestHandler
+
+@pytest.fixture
+def output_path(tmp_path):
+    """An output path with an archive of an image message and a text message
+    in the directory conversation and the files of the image and its
+    thumbnail."""
+
+    directory = tmp_path / "conversation"
+    for name in ("attachment", "thumbnail", "other"):
+        (directory / name).mkdir(parents=True)
+    (directory / "attachment" / "1.jpg").write_bytes(b"image")
+    (directory / "thumbnail" / "1.jpg").write_bytes(b"thumbnail")
+
+    sender = Contact(id=1, name="Sender", color="#000000")
+    message = Message(id=1, sender=sender, date=1700000000, message="Hello", reactions=(), attachments=(Image("1.jpg", 0, "image/jpeg"), ))
+    writer = ArchiveWriter(str(directory / ARCHIVE_FILE_NAME), Contact(id=2, name="Conversation"), "UTC")
+    writer.add(0, message, "2023-11-14", "Hello", ["attachment/1.jpg"], ["thumbnail/1.jpg"])
+    message = Message(id=2, sender=sender, date=1700000060, message="How are you?", reactions=())
+    writer.add(1, message, "2023-11-14", "How are you?", [], [])
+    writer.close()
+    return tmp_path
+
+@pytest.fixture
+def server_url(output_path):
+    handler = functools.partial(ArchiveRequestHandler, directory=str(output_path))
+    server = http.server.ThreadingHTTPServer(("localhost", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://localhost:{}".format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+def fetch(url):
+    with urllib.request.urlopen(url) as response:
+        return response.read()
+
+def test_thumbnail_served(server_url):
+    page = fetch(server_url + "/conversation/").decode("utf-8")
+    thumbnail = re.search(r'<img src="(thumbnail/[^"]*)"', page).group(1)
+    assert fetch(server_url + "/conversation/" + thumbnail) == b"thumbnail"
+    assert fetch(server_url + "/conversation/attachment/1.jpg") == b"image"
+
+def test_other_directories_not_served(server_url, output_path):
+    (output_path / "conversation" / "secret").mkdir()
+    (output_path / "conversation" / "secret" / "file").write_bytes(b"secret")
+    with pytest.raises(urllib.error.HTTPError) as error:
+        fetch(server_url + "/conversation/secret/file")
+    assert error.value.code == 404
+
+def test_search_without_words(server_url):
+    page = fetch(server_url + "/conversation/?q=%3F").decode("utf-8")
+    assert "How are you?" in page
+    assert "Hello" not in page
+    assert "1 found in messages 2 &ndash; 2 of 2" in page
+
+    page = fetch(server_url + "/conversation/?q=%23").decode("utf-8")
+    assert "Hello" not in page and "How are you?" not in page
+    assert "No messages" in page
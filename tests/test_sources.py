@@ -0,0 +1,50 @@
+import json, os, sqlite3, subprocess, sys
+
+import synthetic
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def group_attachment_contents(path):
+    """Return the contents of the attachment files of the messages of the
+    group of the synthetic database in the given path."""
+
+    db = sqlite3.connect(os.path.join(path, "database.sqlite"))
+    ids = [id for id, in db.execute("SELECT attachment._id FROM attachment JOIN message ON message._id = attachment.message_id WHERE message.thread_id = 1")]
+    db.close()
+    contents = set()
+    for id in ids:
+        with open(os.path.join(path, "Attachment_{}_-1.bin".format(id)), mode="rb") as f:
+            contents.add(f.read())
+    return contents
+
+def test_colliding_attachment_ids(tmp_path):
+    # The other backup has the same attachment ids and timestamps as the
+    # main backup but other messages and attachment files.
+    main_path = str(tmp_path / "main")
+    other_path = str(tmp_path / "other")
+    config = synthetic.generate(main_path, 200, attachments=40)
+    synthetic.generate(other_path, 200, attachments=40)
+    db = sqlite3.connect(os.path.join(other_path, "database.sqlite"))
+    db.execute("UPDATE message SET body = 'other ' || _id")
+    db.commit()
+    db.close()
+    for file_name in os.listdir(other_path):
+        if file_name.startswith("Attachment_"):
+            with open(os.path.join(other_path, file_name), mode="ab") as f:
+                f.write(b"other")
+
+    config["output_path"] = str(tmp_path / "output")
+    config["sources"] = [{"data_path": other_path}]
+    config_file_name = str(tmp_path / "config.json")
+    with open(config_file_name, mode="w") as f:
+        json.dump(config, f)
+    subprocess.run([sys.executable, os.path.join(REPOSITORY, "signal-archive.py"), config_file_name], cwd=REPOSITORY, check=True, stdout=subprocess.DEVNULL)
+
+    attachment_path = os.path.join(config["output_path"], "attachment")
+    contents = set()
+    for file_name in os.listdir(attachment_path):
+        with open(os.path.join(attachment_path, file_name), mode="rb") as f:
+            contents.add(f.read())
+    expected = group_attachment_contents(main_path) | group_attachment_contents(other_path)
+    assert len(expected) > 40
+    assert contents == expected
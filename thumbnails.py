@@ -0,0 +1,146 @@
+import collections, multiprocessing, os, shutil, subprocess, time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from data import *
+
+# Thumbnails of images are made with Pillow and poster frames of videos with
+# ffmpeg. Both are optional: without them the attachments are shown as they
+# are.
+try:
+    from PIL import Image as PILImage, ImageOps
+except ImportError:
+    PILImage = None
+
+def image_thumbnail(source_file_name, target_file_name, size):
+    with PILImage.open(source_file_name) as image:
+        # JPEG images are decoded directly at a reduced scale.
+        image.draft("RGB", (size, size))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size))
+        if image.mode in ("RGBA", "LA", "P"):
+            # Transparent areas are shown on white.
+            image = image.convert("RGBA")
+            background = PILImage.new("RGBA", image.size, "white")
+            image = PILImage.alpha_composite(background, image)
+        image.convert("RGB").save(target_file_name, "JPEG", quality=80)
+
+def video_poster(ffmpeg, source_file_name, target_file_name, size):
+    # The filter thumbnail picks a representative frame of the first frames.
+    scale = "thumbnail,scale={0}:{0}:force_original_aspect_ratio=decrease".format(size)
+    subprocess.run([ffmpeg, "-v", "error", "-y", "-i", source_file_name, "-vf", scale, "-frames:v", "1", "-f", "image2", "-c:v", "mjpeg", target_file_name],
+                   stdin=subprocess.DEVNULL, capture_output=True, check=True, timeout=120)
+
+def make_thumbnail(kind, source_file_name, target_file_name, size, ffmpeg):
+    """Make a thumbnail of the given kind ("image" or "video") of the source
+    file unless the target file is newer than the source file. Returns the
+    result ("made", "skipped" or an error message) and the time taken. This
+    is run in the worker processes of ThumbnailGenerator."""
+
+    start = time.perf_counter()
+    try:
+        stat = os.stat(source_file_name)
+        try:
+            if os.stat(target_file_name).st_mtime_ns >= stat.st_mtime_ns:
+                return "skipped", time.perf_counter() - start
+        except FileNotFoundError:
+            pass
+
+        # The thumbnail is written to a temporary file first so that an
+        # interrupted export does not leave a partial thumbnail behind.
+        temp_file_name = target_file_name + ".tmp"
+        if kind == "image":
+            image_thumbnail(source_file_name, temp_file_name, size)
+        else:
+            video_poster(ffmpeg, source_file_name, temp_file_name, size)
+        os.replace(temp_file_name, target_file_name)
+        return "made", time.perf_counter() - start
+    except subprocess.CalledProcessError as e:
+        error = e.stderr.decode("utf-8", errors="replace").strip().split("\n")[-1]
+        return "ffmpeg: {}".format(error), time.perf_counter() - start
+    except Exception as e:
+        return "{}: {}".format(type(e).__name__, e), time.perf_counter() - start
+
+class ThumbnailGenerator:
+    """Makes thumbnails of images and poster frames of videos in a pool of
+    processes so that producing the output does not wait for decoding them.
+    A thumbnail which is newer than its attachment is not made again. The
+    thumbnails fit in a square of size pixels. Missing Pillow and ffmpeg are
+    reported unless warn is False."""
+
+    def __init__(self, processes=None, size=480, warn=True):
+        self.processes = processes or os.cpu_count()
+        self.size = size
+        self.images = PILImage is not None
+        self.ffmpeg = shutil.which("ffmpeg")
+        if not self.images and warn:
+            print("Pillow is not installed, so no thumbnails of images are made.")
+        if self.ffmpeg is None and warn:
+            print("ffmpeg is not installed, so no poster frames of videos are made.")
+        # The pool is started when the first thumbnail is made.
+        self.executor = None
+        self.pending = collections.deque()
+        self.max_pending = 4*self.processes
+        self.made = 0
+        self.skipped = 0
+        self.failed = 0
+        # Total time of the workers.
+        self.seconds = 0
+
+    def kind(self, attachment):
+        """Return the kind of thumbnail made of the attachment or None if no
+        thumbnail is made of it."""
+
+        # Animated GIF images would lose their animation.
+        if isinstance(attachment, Image) and self.images and attachment.content_type != "image/gif":
+            return "image"
+        elif isinstance(attachment, Video) and self.ffmpeg is not None:
+            return "video"
+        return None
+
+    def make(self, attachment, source_file_name, target_file_name):
+        """Make a thumbnail of the attachment in the source file to the target
+        file in the background. Returns False if no thumbnail is made of the
+        attachment."""
+
+        kind = self.kind(attachment)
+        if kind is None:
+            return False
+
+        if self.executor is None:
+            # Worker processes of multiprocessing.Pool cannot start processes
+            # of their own, so threads are used in them. Pillow and ffmpeg do
+            # most of the work without holding the GIL.
+            if multiprocessing.current_process().daemon:
+                self.executor = ThreadPoolExecutor(self.processes)
+            else:
+                self.executor = ProcessPoolExecutor(self.processes)
+
+        while len(self.pending) >= self.max_pending:
+            self._collect(self.pending.popleft())
+
+        future = self.executor.submit(make_thumbnail, kind, source_file_name, target_file_name, self.size, self.ffmpeg)
+        self.pending.append((source_file_name, future))
+        return True
+
+    def _collect(self, pending):
+        source_file_name, future = pending
+        result, seconds = future.result()
+        self.seconds += seconds
+        if result == "made":
+            self.made += 1
+        elif result == "skipped":
+            self.skipped += 1
+        else:
+            self.failed += 1
+            print("Making a thumbnail of '{}' failed. {}".format(source_file_name, result))
+
+    def close(self):
+        """Wait for all thumbnails to be made."""
+
+        while len(self.pending) > 0:
+            self._collect(self.pending.popleft())
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def __str__(self):
+        return "Made {} thumbnails, skipped {} unchanged thumbnails, {} failed.".format(self.made, self.skipped, self.failed)
@@ -1,10 +1,11 @@
-import json, os, sys
+import hashlib, json, os, sys
 
-def get_config():
-    try:
-        config_file_name = sys.argv[1]
-    except IndexError:
-        raise SystemExit("Please provide a JSON config file name as a command line paramater.")
+def get_config(config_file_name=None):
+    if config_file_name is None:
+        try:
+            config_file_name = sys.argv[1]
+        except IndexError:
+            raise SystemExit("Please provide a JSON config file name as a command line paramater.")
 
     if not os.path.exists(config_file_name):
         raise SystemExit("File '{}' does not exist.".format(config_file_name))
@@ -14,3 +15,40 @@ def get_config():
 
     return config
 
+
+def load_state(output_path):
+    """Load the state of previous exports to the given output path. The state
+    records for each exported thread (by thread id) the last exported message,
+    the number of messages, the date range and the assigned colors."""
+
+    file_name = os.path.join(output_path, "state.json")
+    if not os.path.exists(file_name):
+        return {"version": 1, "threads": {}}
+
+    with open(file_name) as f:
+        state = json.load(f)
+    # Older exports listed the copied attachment files, which are found by
+    # their size and modification time instead.
+    state.pop("attachments", None)
+
+    return state
+
+def save_state(output_path, state):
+    """Save the given export state to the output path."""
+
+    file_name = os.path.join(output_path, "state.json")
+    with open(file_name + ".tmp", mode="w") as f:
+        json.dump(state, f)
+    os.replace(file_name + ".tmp", file_name)
+
+def file_hash(file_name):
+    """Return the hexadecimal BLAKE2 hash of the content of the given file."""
+
+    h = hashlib.blake2b(digest_size=16)
+    with open(file_name, mode="rb") as f:
+        while True:
+            block = f.read(2**20)
+            if len(block) == 0: break
+            h.update(block)
+
+    return h.hexdigest()
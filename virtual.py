@@ -0,0 +1,82 @@
+import json
+
+from data import *
+import render
+
+# The kinds of attachments shown by html/virtual.js. Other attachments are not
+# shown, as in render.MessageRenderer.
+attachment_kinds = ((Image, "image"), (Video, "video"), (Audio, "audio"))
+
+class MessageDataWriter:
+    """Writes the messages of one output file as data for the virtual list of
+    html/virtual.js, which renders only the messages near the viewport so
+    that the browser does not build the elements of every message. The data
+    is a JavaScript file adding one object to the array message_chunks for
+    each chunk of chunk_size messages. Each chunk maps the ids of the
+    contacts appearing in it to [name, avatar path] and lists its messages
+    as arrays
+
+    [date (ms), sender id, date text, body HTML, quote, attachments, reactions]
+
+    where the quote is [sender id, date text, text], the attachments are
+    [kind, path, content type, thumbnail path] and the reactions are
+    [contact id, emoji]. Trailing nulls of the arrays are left out. As in
+    SearchIndexWriter, the chunks are independent so that the file can be
+    appended to."""
+
+    def __init__(self, file_name, append=False, chunk_size=2000):
+        self.out = open(file_name, mode="a" if append else "w", encoding="utf-8")
+        self.dumps = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+        self.chunk_size = chunk_size
+        self.contacts = {}
+        self.messages = []
+
+    def add(self, message, date, quote_date, body, attachment_file_names, thumbnail_file_names):
+        """Add a message. The parameters are as in render.MessageRenderer.render
+        and the mentions of the message must have been replaced."""
+
+        contacts = self.contacts
+        contacts[message.sender.id] = message.sender
+        row = [round(message.date*1000), message.sender.id, date, body, None, None, None]
+
+        if message.quote is not None:
+            contacts[message.quote.sender.id] = message.quote.sender
+            row[4] = [message.quote.sender.id, quote_date, message.quote.message]
+
+        if message.attachments:
+            attachments = []
+            for attachment, file_name, thumbnail in zip(message.attachments, attachment_file_names, thumbnail_file_names):
+                for attachment_type, kind in attachment_kinds:
+                    if isinstance(attachment, attachment_type):
+                        attachments.append([kind, file_name, attachment.content_type] + ([thumbnail] if thumbnail is not None else []))
+                        break
+            if len(attachments) > 0:
+                row[5] = attachments
+
+        if len(message.reactions) > 0:
+            for reaction in message.reactions:
+                contacts[reaction.contact.id] = reaction.contact
+            row[6] = [[reaction.contact.id, reaction.emoji] for reaction in message.reactions]
+
+        while row[-1] is None:
+            row.pop()
+        self.messages.append(row)
+
+        if len(self.messages) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Write the current chunk to the data file."""
+
+        if len(self.messages) == 0: return
+
+        contacts = {id: [contact.name, render.avatar_path(contact)] for id, contact in self.contacts.items()}
+        chunk = {"contacts": contacts, "messages": self.messages}
+        self.out.write("(window.message_chunks = window.message_chunks || []).push({});\n".format(self.dumps(chunk)))
+
+        self.contacts = {}
+        self.messages = []
+
+    def close(self):
+        self.flush()
+        self.out.close()